@@ -5,15 +5,32 @@ from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
 import logging
 import smtplib
+from email.utils import getaddresses
+from email.generator import BytesGenerator
+import copy
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from email.mime.application import MIMEApplication
 import time as time_module
 import textwrap
 import base64
+import hashlib
 import re
-from googleapiclient.http import MediaIoBaseUpload
+from googleapiclient.http import MediaFileUpload
+from googleapiclient.errors import HttpError
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
 import io
-st.cache_data.clear()
+import threading
+import collections
+import random
+import socket
+import ssl
+import os
+import json
+import sqlite3
+import contextlib
+import uuid
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -211,10 +228,61 @@ div[data-baseweb="popover"] li:hover { background-color: #2F6F7E !important; }
 SCOPES_SHEETS = ['https://www.googleapis.com/auth/spreadsheets']
 SCOPES_DRIVE  = ['https://www.googleapis.com/auth/drive']
 
+# ============================================================
+# 🔌 عملاء Google المشتركة (عميل واحد لكل خيط)
+# ============================================================
+API_HTTP_TIMEOUT = 60
+GOOGLE_CLIENT_POOL_SIZE = 8   # عملاء خاملون محفوظون لكل نوع
+
+class GoogleClientPool:
+    """عملاء Google مشتركة بين الخيوط: كل خيط يستعير عميلاً لا يستعمله غيره (httplib2 غير آمن بين الخيوط)،
+    وحين ينتهي الخيط يعود العميل إلى المخزن — إعادة تشغيل السكربت التالية (خيط جديد) تستعمله بدل بناء اتصال جديد."""
+    def __init__(self, size=GOOGLE_CLIENT_POOL_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._idle = collections.defaultdict(list)   # name -> [عميل]
+        self._leases = {}                             # (خيط، name) -> عميل
+
+    def _reclaim(self):
+        for key in [k for k in self._leases if not k[0].is_alive()]:
+            client = self._leases.pop(key)
+            if len(self._idle[key[1]]) < self.size: self._idle[key[1]].append(client)
+
+    def get(self, name):
+        thread = threading.current_thread()
+        with self._lock:
+            client = self._leases.get((thread, name))
+            if client is not None: return client
+            self._reclaim()
+            client = self._idle[name].pop() if self._idle[name] else None
+        if client is None:
+            client = _build_google_client(name)   # خارج القفل: البناء يقرأ وثيقة الاكتشاف
+        with self._lock:
+            self._leases[(thread, name)] = client
+        return client
+
+@st.cache_resource(show_spinner=False)
+def _google_client_pool():
+    """مخزن عملاء Google — يبقى حياً عبر إعادة تشغيل السكربت"""
+    return GoogleClientPool()
+
+def _build_google_client(name):
+    """بناء عميل من وثيقة الاكتشاف المضمّنة مع اتصال HTTP دائم"""
+    if name == "sheets":     api, version, creds = 'sheets', 'v4', credentials
+    elif name == "drive":    api, version, creds = 'drive', 'v3', drive_credentials
+    elif name == "revision": api, version, creds = 'drive', 'v3', credentials.with_scopes(SCOPES_SHEETS + SCOPES_REVISION)
+    else: raise ValueError(f"عميل غير معروف: {name}")
+    http = AuthorizedHttp(creds, http=httplib2.Http(timeout=API_HTTP_TIMEOUT))
+    return build(api, version, http=http, cache_discovery=False, static_discovery=True)
+
+def get_google_client(name):
+    """عميل Google (sheets / drive / revision) مُعار للخيط الحالي وحده — httplib2 غير آمن بين الخيوط"""
+    return _google_client_pool().get(name)
+
 try:
     info = st.secrets["service_account"]
     credentials = Credentials.from_service_account_info(info, scopes=SCOPES_SHEETS)
-    sheets_service = build('sheets', 'v4', credentials=credentials)
+    sheets_service = get_google_client("sheets")
 except Exception as e:
     st.error("⚠️ خطأ في الاتصال بـ Google Sheets"); st.stop()
 
@@ -222,18 +290,38 @@ DRIVE_UPLOAD_FOLDER_ID = "1fvckcOGegVD4Ofs-UnVZbVCbYBQlToWs"
 try:
     drive_info = st.secrets["drive_service_account"]
     drive_credentials = Credentials.from_service_account_info(drive_info, scopes=SCOPES_DRIVE)
-    drive_service = build('drive', 'v3', credentials=drive_credentials)
+    drive_service = get_google_client("drive")
 except:
     drive_service = None
 
+# فحص نسخة الشيتات عبر Drive (بيانات وصفية فقط) قبل إعادة التحميل
+SCOPES_REVISION = ['https://www.googleapis.com/auth/drive.metadata.readonly']
+REVISION_PROBE_TTL = 10
+try:
+    revision_service = get_google_client("revision")
+except:
+    revision_service = None
+
 STUDENTS_SHEET_ID   = "1_uhwdyOERttICR6uqftU9eyJrmetpA6idL3vz5WtWX4"
 MEMOS_SHEET_ID      = "1LNJMBAye4QIQy7JHz6F8mQ6-XNC1weZx1ozDZFfjD5s"
 PROF_MEMOS_SHEET_ID = "1OnZi1o-oPMUI_W_Ew-op0a1uOhSj006hw_2jrMD6FSE"
 REQUESTS_SHEET_ID   = "1sTJ6BZRM4Qgt0w2xUkpFZqquL-hfriMYTSN3x1_12_o"
 STUDENTS_RANGE  = "Feuille 1!A1:V1000"  # K=البريد المهني included
-MEMOS_RANGE     = "Feuille 1!A1:AI1000"
+MEMOS_RANGE     = "Feuille 1!A1:AV1000"
 PROF_MEMOS_RANGE= "Feuille 1!A1:S1000"
 REQUESTS_RANGE  = "Feuille 1!A1:K1000"
+MEMO_EXC_RANGE  = "استثناءات_مذكرات!A1:G1000"
+PROF_EXC_RANGE  = "استثناءات_أساتذة!A1:L1000"
+DAYS_RANGE      = "الأيام!A1:D1000"
+SLOTS_RANGE     = "التوقيت!A1:A100"
+ROOMS_RANGE     = "القاعات!A1:A100"
+# كل النطاقات التي تُقرأ من كل شيت — تُجلب معاً في طلب batchGet واحد
+SHEET_BATCH_RANGES = {
+    STUDENTS_SHEET_ID:   [STUDENTS_RANGE],
+    MEMOS_SHEET_ID:      [MEMOS_RANGE, MEMO_EXC_RANGE, PROF_EXC_RANGE, DAYS_RANGE, SLOTS_RANGE, ROOMS_RANGE],
+    PROF_MEMOS_SHEET_ID: [PROF_MEMOS_RANGE],
+    REQUESTS_SHEET_ID:   [REQUESTS_RANGE],
+}
 ADMIN_CREDENTIALS = {"admin": "admin2026", "dsp": "dsp@2026"}
 PRINTER_CREDENTIALS  = {"mem": "1234"}   # فضاء المحاضر فقط
 LIBRARY_CREDENTIALS  = {"bib": "1234"}   # مسؤول المكتبة — غيّر كلمة السر هنا
@@ -364,11 +452,551 @@ def get_student_info_from_memo(memo_row, df_students):
             if not s.empty: s2_email = get_email_smart(s.iloc[0]); s2_reg = reg2
     return {"s1_name":s1_name,"s1_email":s1_email,"s1_reg":s1_reg,"s2_name":s2_name,"s2_email":s2_email,"s2_reg":s2_reg}
 
+# ================================================================
+# 🚦 تنفيذ طلبات Google: إعادة المحاولة + ميزانية الطلبات في الدقيقة
+# ================================================================
+API_BUDGET_PER_MINUTE = {"sheets": 55, "drive": 150}   # أقل قليلاً من حصة حساب الخدمة
+API_URGENT_RESERVE = 10     # طلبات محجوزة للمستخدمين — الخلفية تنتظر حين تقترب الميزانية من النفاد
+API_MAX_RETRIES = 5
+API_RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+class RequestBudget:
+    """نافذة منزلقة لعدد الطلبات في آخر 60 ثانية"""
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self._calls = collections.deque()
+        self._lock = threading.Lock()
+
+    def acquire(self, urgent=True, max_wait=60):
+        limit = self.per_minute if urgent else max(1, self.per_minute - API_URGENT_RESERVE)
+        deadline = time_module.time() + max_wait
+        while True:
+            with self._lock:
+                now = time_module.time()
+                while self._calls and now - self._calls[0] >= 60: self._calls.popleft()
+                if len(self._calls) < limit:
+                    self._calls.append(now); return
+                wait = 60 - (now - self._calls[0])
+            # الطلبات العاجلة لا تُحجب طويلاً: بعد max_wait تمر وتتكفل إعادة المحاولة بـ 429
+            if urgent and time_module.time() >= deadline: return
+            time_module.sleep(min(max(wait, 0.05), 1.0))
+
+    def remaining(self):
+        with self._lock:
+            now = time_module.time()
+            return self.per_minute - sum(1 for t in self._calls if now - t < 60)
+
+@st.cache_resource(show_spinner=False)
+def get_api_budgets():
+    return {api: RequestBudget(n) for api, n in API_BUDGET_PER_MINUTE.items()}
+
+def _never_sent(e):
+    """الطلب لم يصل إلى الخادم أصلاً (فشل DNS أو رفض الاتصال)"""
+    return isinstance(e, (httplib2.ServerNotFoundError, socket.gaierror, ConnectionRefusedError))
+
+def _is_retryable(e, idempotent=True):
+    """الطلبات غير المتكررة الأثر (مثل append) لا تُعاد إلا على 429 أو إذا لم تصل إلى الخادم:
+    المهلة أو 5xx لا تعني أن الصف لم يُضف"""
+    if isinstance(e, HttpError):
+        status = getattr(e.resp, "status", None)
+        return status in API_RETRY_STATUSES if idempotent else status == 429
+    if not idempotent:
+        return _never_sent(e)
+    return isinstance(e, (TimeoutError, ConnectionError, socket.timeout, ssl.SSLError, httplib2.ServerNotFoundError))
+
+def api_execute(request, api="sheets", urgent=True, idempotent=True):
+    """تنفيذ طلب Google مع backoff أسي + jitter على أخطاء الحصة/الخادم واحترام الميزانية.
+    idempotent=False للطلبات التي تضيف بيانات عند كل تنفيذ (values().append)"""
+    budget = get_api_budgets()[api]
+    for attempt in range(API_MAX_RETRIES + 1):
+        budget.acquire(urgent)
+        try:
+            return request.execute()
+        except Exception as e:
+            if attempt >= API_MAX_RETRIES or not _is_retryable(e, idempotent): raise
+            delay = min(32, 2 ** attempt) + random.uniform(0, 1)
+            logger.warning(f"طلب {api} فشل ({e}) — إعادة المحاولة {attempt+1} بعد {delay:.1f}ث")
+            time_module.sleep(delay)
+
+def _is_missing_range(e):
+    """400 "Unable to parse range": الورقة محذوفة أو لم تُنشأ بعد"""
+    return isinstance(e, HttpError) and getattr(e.resp, "status", None) == 400 and "Unable to parse range" in str(e)
+
+def fetch_sheet_ranges(spreadsheet_id, service=None, urgent=True, failed=None):
+    """جلب كل نطاقات الشيت في طلب batchGet واحد → {النطاق: القيم}.
+    failed: قائمة تُملأ بالنطاقات التي تعذّرت قراءتها (تُحذف من النتيجة) بدل رفع الخطأ"""
+    service = service or get_google_client("sheets")
+    ranges = SHEET_BATCH_RANGES[spreadsheet_id]
+    try:
+        result = api_execute(service.spreadsheets().values().batchGet(spreadsheetId=spreadsheet_id, ranges=ranges), urgent=urgent)
+    except Exception as e:
+        # ورقة ناقصة تُفشل الطلب كله → نرجع للقراءة نطاقاً بنطاق حتى لا تتعطل بقية البيانات
+        if len(ranges) == 1: raise
+        logger.warning(f"batchGet فشل، قراءة منفردة: {e}")
+        out = {}
+        for rng in ranges:
+            try: out[rng] = api_execute(service.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=rng), urgent=urgent).get('values', [])
+            except Exception as e2:
+                # الورقة غير موجودة فعلاً → نطاق فارغ؛ أي خطأ آخر لا يُحوَّل إلى بيانات فارغة
+                if _is_missing_range(e2):
+                    logger.warning(f"النطاق {rng} غير موجود: {e2}"); out[rng] = []
+                elif failed is None: raise
+                else: logger.error(f"خطأ قراءة {rng}: {e2}"); failed.append(rng)
+        # كل النطاقات فشلت → عطل في الخدمة لا ورقة ناقصة
+        if failed and len(failed) == len(ranges): raise e
+        return out
+    value_ranges = result.get('valueRanges', [])
+    # تُعاد النطاقات بنفس ترتيب الطلب (أسماؤها قد تتغير: اقتباس الورقة، قص الحدود)
+    return {rng: (value_ranges[i].get('values', []) if i < len(value_ranges) else []) for i, rng in enumerate(ranges)}
+
+def probe_sheet_revision(spreadsheet_id, service=None, urgent=True):
+    """نسخة الشيت من Drive (version + modifiedTime) — None إذا تعذّر الفحص"""
+    try:
+        service = service or get_google_client("revision")
+        meta = api_execute(service.files().get(fileId=spreadsheet_id, fields="version,modifiedTime", supportsAllDrives=True), api="drive", urgent=urgent)
+        return f"{meta.get('version','')}|{meta.get('modifiedTime','')}"
+    except Exception as e:
+        logger.warning(f"تعذّر فحص نسخة الشيت {spreadsheet_id}: {e}"); return None
+
+# ── حفظ اللقطات على القرص: إقلاع سريع + قراءة عند تعطل Google ──
+LOCAL_DATA_DIR = "local_data"
+SNAPSHOT_DB = os.path.join(LOCAL_DATA_DIR, "snapshots.sqlite3")
+
+def add_missing_columns(conn, table, columns):
+    """أعمدة أُضيفت بعد إنشاء الجدول: CREATE IF NOT EXISTS لا يعدّل قاعدة قديمة"""
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    for column, kind in columns:
+        if column not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {kind}")
+
+def _snapshot_db():
+    # اللقطات تحوي ورقة الطلبة كاملة (كلمات السر، أرقام التسجيل) → المجلد والملف لمالك العملية فقط
+    os.makedirs(LOCAL_DATA_DIR, exist_ok=True)
+    os.chmod(LOCAL_DATA_DIR, 0o700)
+    os.close(os.open(SNAPSHOT_DB, os.O_CREAT | os.O_RDWR, 0o600))
+    os.chmod(SNAPSHOT_DB, 0o600)
+    conn = sqlite3.connect(SNAPSHOT_DB, timeout=10)
+    conn.execute("CREATE TABLE IF NOT EXISTS snapshots (sid TEXT PRIMARY KEY, revision TEXT, fetched_at REAL, data TEXT)")
+    return conn
+
+def load_disk_snapshots():
+    """آخر لقطة محفوظة لكل شيت — {sid: {"revision", "data", "at"}}"""
+    try:
+        with _snapshot_db() as conn:
+            rows = conn.execute("SELECT sid, revision, fetched_at, data FROM snapshots").fetchall()
+        return {sid: {"revision": rev, "data": json.loads(data), "at": at, "source": "disk"} for sid, rev, at, data in rows if sid in SHEET_BATCH_RANGES}
+    except Exception as e:
+        logger.warning(f"تعذّرت قراءة اللقطات المحلية: {e}"); return {}
+
+def save_disk_snapshot(sid, snap):
+    try:
+        with _snapshot_db() as conn:
+            conn.execute("INSERT OR REPLACE INTO snapshots VALUES (?,?,?,?)", (sid, snap["revision"], snap["at"], json.dumps(snap["data"], ensure_ascii=False)))
+    except Exception as e:
+        logger.warning(f"تعذّر حفظ اللقطة المحلية: {e}")
+
+# ================================================================
+# 🔄 لقطات الشيتات — تحديث في الخلفية (stale-while-revalidate) + طلب واحد مشترك
+# ================================================================
+SNAPSHOT_MAX_AGE = 60      # عمر اللقطة الأقصى حين يتعذّر فحص النسخة
+SNAPSHOT_REFRESH_LEAD = 10 # نحدّث قبل انتهاء الصلاحية بهذه المدة
+
+class SheetSnapshotStore:
+    """آخر لقطة ناجحة لكل شيت، مشتركة بين الجلسات.
+    القراءة لا تنتظر الشبكة ما دامت هناك لقطة؛ خيط في الخلفية يفحص النسخة ويحدّث.
+    الجلسات التي تطلب نفس الشيت معاً تنتظر طلباً واحداً (single-flight)."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        # الإقلاع من القرص: الصفحة تُعرض فوراً والجلب الحي يتم في الخلفية
+        self._snapshots = load_disk_snapshots()   # spreadsheet_id -> {"revision", "data", "at", "source"}
+        for sid, snap in self._snapshots.items():
+            snap["data"] = apply_cell_writes(sid, snap["data"], pending_cell_writes(sid))
+        self._flights = {}     # spreadsheet_id -> Lock (يُمسك طوال الجلب)
+        self._data_lock = threading.Lock()   # قصير: تعديل بيانات اللقطات في الذاكرة فقط
+        self._dirty = set()      # يُقرأ ويُعدَّل تحت _lock فقط
+        self._changed = set()    # لقطات تغيّرت ولم تُبطل تحليلاتها المخزنة بعد
+        self._thread = None
+
+    def _flight(self, sid):
+        with self._lock: return self._flights.setdefault(sid, threading.Lock())
+
+    def _is_dirty(self, sid):
+        with self._lock: return sid in self._dirty
+
+    def get(self, sid):
+        snap = self._snapshots.get(sid)
+        self._ensure_refresher()
+        # آخر جلب فشل (degraded) → العلامة باقية وخيط الخلفية يعيد المحاولة؛ لا نحجز الصفحة في كل قراءة
+        if snap is None or (self._is_dirty(sid) and snap.get("source") != "degraded"):
+            try: return self.refresh(sid)["data"]
+            except Exception:
+                # Google غير متاح → آخر لقطة (ولو محلية) أفضل من صفحة فارغة
+                if snap is None: raise
+                return snap["data"]
+        # الخيط متوقف واللقطة قديمة جداً → تحديث متزامن كما كان
+        if not self._refresher_alive() and time_module.time()-snap["at"] >= SNAPSHOT_MAX_AGE:
+            return self.refresh(sid)["data"]
+        return snap["data"]
+
+    def refresh(self, sid, sheets=None, drive=None, urgent=True):
+        started = time_module.time()
+        with self._flight(sid):
+            snap = self._snapshots.get(sid)
+            # جلسة أخرى أكملت الجلب أثناء الانتظار → نستعمل نتيجتها
+            if snap and snap["at"] >= started and not self._is_dirty(sid): return snap
+            # نُزيل العلامة قبل الجلب كي تبقى أي علامة جديدة تصل أثناءه، ونعيدها إن لم يكتمل
+            with self._lock: self._dirty.discard(sid)
+            revision = probe_sheet_revision(sid, drive, urgent)
+            failed = [] if snap else None
+            try:
+                data = fetch_sheet_ranges(sid, sheets, urgent, failed)
+            except Exception as e:
+                self.mark_dirty(sid)
+                if snap is None: raise
+                logger.error(f"تعذّر تحديث الشيت {sid}، نستمر على اللقطة السابقة: {e}")
+                snap["source"] = "degraded"
+                return snap
+            if failed:
+                # قراءة جزئية: النطاقات الفاشلة من اللقطة السابقة، ولا نسجّل النسخة الجديدة ولا نحفظ على القرص
+                # → تبقى اللقطة degraded ويعيد خيط الخلفية جلبها
+                logger.error(f"قراءة جزئية للشيت {sid}، نطاقات من اللقطة السابقة: {failed}")
+                self.mark_dirty(sid)
+                data.update({rng: snap["data"].get(rng, []) for rng in failed})
+                snap = {"revision": snap["revision"], "data": data, "at": snap["at"], "source": "degraded"}
+            else:
+                snap = {"revision": revision, "data": data, "at": time_module.time(), "source": "live"}
+                save_disk_snapshot(sid, snap)
+            # كتابات محلية لم تُزامن بعد تبقى ظاهرة فوق البيانات الجديدة
+            with self._data_lock:
+                snap["data"] = apply_cell_writes(sid, data, pending_cell_writes(sid))
+                self._snapshots[sid] = snap
+            with self._lock: self._changed.add(sid)
+            return snap
+
+    def apply_local_writes(self, sid, cells, persist=None):
+        """تطبيق كتابات محلية على اللقطة في الذاكرة — يعيد القيم السابقة (أساس كشف التعارض).
+        لا ينتظر جلباً جارياً؛ persist(bases) تحفظ الكتابات تحت القفل نفسه كي لا تفوت refresh"""
+        with self._data_lock:
+            snap = self._snapshots.get(sid)
+            bases = {}
+            if snap is not None:
+                snap["data"] = apply_cell_writes(sid, snap["data"], cells, bases)
+            if persist: persist(bases)
+            return bases
+
+    def stale_since(self):
+        """أقدم وقت جلب بين اللقطات غير الحية (قرص/تعطل) — None إذا كانت كلها حية"""
+        times = [snap["at"] for snap in self._snapshots.values() if snap.get("source") != "live"]
+        return min(times) if times else None
+
+    def mark_dirty(self, *sids):
+        with self._lock: self._dirty.update(sids)
+
+    def take_changed(self):
+        """الشيتات التي تغيّرت لقطتها منذ آخر استدعاء"""
+        with self._lock:
+            changed, self._changed = self._changed, set()
+        return changed
+
+    def _refresher_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _ensure_refresher(self):
+        if self._refresher_alive(): return
+        with self._lock:
+            if self._refresher_alive(): return
+            self._thread = threading.Thread(target=self._refresh_loop, name="sheets-refresher", daemon=True)
+            self._thread.start()
+
+    def _refresh_loop(self):
+        sheets = drive = None
+        while True:
+            # تعذّر إنشاء العملاء (شبكة/اعتماد) → نعيد المحاولة في الدورة التالية بدل موت الخيط
+            try:
+                sheets = sheets or get_google_client("sheets")
+                drive = drive or get_google_client("revision")
+            except Exception as e:
+                logger.error(f"تعذّر تهيئة عملاء Google لخيط التحديث: {e}")
+                time_module.sleep(REVISION_PROBE_TTL); continue
+            for sid, snap in list(self._snapshots.items()):
+                try:
+                    revision = probe_sheet_revision(sid, drive, urgent=False)
+                    if snap.get("source") != "live" and revision is not None and revision == snap["revision"]:
+                        snap["source"] = "live"   # لقطة القرص مطابقة للنسخة الحالية
+                        continue
+                    if snap.get("source") != "live": stale = True
+                    elif revision is not None: stale = revision != snap["revision"]
+                    else: stale = time_module.time()-snap["at"] >= SNAPSHOT_MAX_AGE - SNAPSHOT_REFRESH_LEAD
+                    if stale: self.refresh(sid, sheets, drive, urgent=False)
+                except Exception as e:
+                    logger.error(f"خطأ تحديث الخلفية ({sid}): {e}")
+            time_module.sleep(REVISION_PROBE_TTL)
+
+@st.cache_resource
+def get_snapshot_store():
+    return SheetSnapshotStore()
+
+def get_sheet_values(spreadsheet_id, rng):
+    return get_snapshot_store().get(spreadsheet_id).get(rng, [])
+
+# ================================================================
+# 🔁 كتابة محلية فورية + مزامنة لاحقة مع Google Sheets
+# ================================================================
+SYNC_DB = os.path.join(LOCAL_DATA_DIR, "sync.sqlite3")
+SYNC_INTERVAL = 3      # ثوانٍ بين دفعات المزامنة
+SYNC_BATCH = 500       # أقصى عدد خلايا في الدفعة الواحدة
+SYNC_MAX_ATTEMPTS = 8  # بعدها تُنقل الكتابة إلى المتعثرة (dead-letter) لمراجعة الإدارة
+_CELL_RE = re.compile(r"^'?(?P<tab>[^!']+)'?!(?P<col>[A-Z]+)(?P<row>\d+)$")
+
+def parse_cell(rng):
+    """'Feuille 1!T12' → ('Feuille 1', 12, 20) — None إذا لم يكن خلية واحدة"""
+    m = _CELL_RE.match(rng.strip())
+    if not m: return None
+    col = 0
+    for ch in m.group("col"): col = col*26 + ord(ch) - 64
+    return m.group("tab"), int(m.group("row")), col
+
+def apply_cell_writes(sid, data, cells, bases=None):
+    """نسخة من بيانات الشيت مع تطبيق الخلايا [(range, value)] — تملأ bases بالقيم السابقة"""
+    if not cells: return data
+    data = dict(data)
+    for rng, value in cells:
+        cell = parse_cell(rng)
+        if cell is None: continue
+        tab, row, col = cell
+        key = next((k for k in data if k.split("!")[0].strip("'") == tab and k.split("!")[1].startswith("A1:")), None)
+        if key is None: continue
+        values = data[key]
+        # لا نتجاوز حدود الرأس (pandas يرفض صفاً أطول من الأعمدة)
+        if not values or col > len(values[0]): continue
+        values = data[key] = list(values)
+        while len(values) < row: values.append([])
+        r = values[row-1] = list(values[row-1])
+        if bases is not None and rng not in bases: bases[rng] = r[col-1] if col <= len(r) else ""
+        while len(r) < col: r.append("")
+        r[col-1] = "" if value is None else str(value)
+    return data
+
+def _sync_db():
+    os.makedirs(LOCAL_DATA_DIR, exist_ok=True)
+    conn = sqlite3.connect(SYNC_DB, timeout=10)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS pending_writes (id INTEGER PRIMARY KEY AUTOINCREMENT, sid TEXT, rng TEXT, value TEXT, base TEXT, created_at REAL, attempts INTEGER DEFAULT 0, last_error TEXT)")
+    conn.execute("CREATE TABLE IF NOT EXISTS sync_conflicts (id INTEGER PRIMARY KEY AUTOINCREMENT, sid TEXT, rng TEXT, local_value TEXT, remote_value TEXT, base_value TEXT, detected_at REAL)")
+    # آخر قيمة دفعناها لكل خلية وكيف قرأها الشيت بعد الدفع (تنسيق التواريخ والأرقام)
+    conn.execute("CREATE TABLE IF NOT EXISTS synced_cells (sid TEXT, rng TEXT, pushed TEXT, readback TEXT, PRIMARY KEY (sid, rng))")
+    add_missing_columns(conn, "pending_writes", (("author", "TEXT"), ("next_attempt_at", "REAL"), ("dead", "INTEGER DEFAULT 0")))
+    add_missing_columns(conn, "sync_conflicts", (("author", "TEXT"), ("seen", "INTEGER DEFAULT 0")))
+    return conn
+
+def current_editor():
+    """هوية مستخدم الجلسة الحالية لنسب الكتابات إليه — "" خارج الجلسات (عمّال الخلفية)"""
+    try:
+        ss = st.session_state
+        if ss.get("admin_user"): return f"admin:{ss.admin_user}"
+        if ss.get("professor"): return f"professor:{normalize_text(ss.professor.get('إسم المستخدم', ''))}"
+        if ss.get("student1"): return f"student:{normalize_text(ss.student1.get('اسم المستخدم', ''))}"
+    except Exception:
+        pass
+    return ""
+
+def pending_cell_writes(sid):
+    """الكتابات المحلية غير المزامنة لشيت معيّن بترتيب حدوثها"""
+    try:
+        with _sync_db() as conn:
+            rows = conn.execute("SELECT rng, value FROM pending_writes WHERE sid=? AND dead=0 ORDER BY id", (sid,)).fetchall()
+        return [(rng, json.loads(v)) for rng, v in rows]
+    except Exception as e:
+        logger.warning(f"تعذّرت قراءة طابور المزامنة: {e}"); return []
+
+class SheetSyncQueue:
+    """طابور كتابات دائم (SQLite WAL) يدفعه خيط في الخلفية إلى Sheets على دفعات.
+    قبل الدفع تُقارن القيمة الحالية في الشيت بالقيمة التي بُنيت عليها الكتابة:
+    إن عدّلها أحد مباشرة في الشيت تُسجَّل كتعارض ويُحتفظ بقيمة الشيت،
+    ويُنبَّه صاحب الكتابة في جلسته (conflicts_for)."""
+    def __init__(self, store):
+        self._store = store
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def enqueue(self, sid, data, author=""):
+        cells = []
+        for d in data:
+            rows = d.get("values") or [[""]]
+            if parse_cell(d["range"]) is None or len(rows) != 1 or len(rows[0]) != 1:
+                raise ValueError(f"كتابة غير مدعومة في الطابور: {d['range']}")
+            cells.append((d["range"], rows[0][0]))
+        now = time_module.time()
+        def persist(bases):
+            with self._lock, _sync_db() as conn:
+                conn.executemany("INSERT INTO pending_writes (sid, rng, value, base, created_at, author) VALUES (?,?,?,?,?,?)",
+                                 [(sid, rng, json.dumps(v, ensure_ascii=False), json.dumps(bases.get(rng), ensure_ascii=False), now, author) for rng, v in cells])
+        self._store.apply_local_writes(sid, cells, persist)
+        self._ensure_worker()
+
+    def status(self):
+        """(كتابات في الانتظار، تعارضات مسجلة، كتابات متعثرة)"""
+        try:
+            with _sync_db() as conn:
+                pending = conn.execute("SELECT COUNT(*) FROM pending_writes WHERE dead=0").fetchone()[0]
+                conflicts = conn.execute("SELECT COUNT(*) FROM sync_conflicts").fetchone()[0]
+                dead = conn.execute("SELECT COUNT(*) FROM pending_writes WHERE dead=1").fetchone()[0]
+            return pending, conflicts, dead
+        except Exception: return 0, 0, 0
+
+    def dead_letters(self, limit=200):
+        """الكتابات التي استنفدت المحاولات — [(id, sid, range, القيمة، آخر خطأ، المحاولات)]"""
+        try:
+            with _sync_db() as conn:
+                rows = conn.execute("SELECT id, sid, rng, value, last_error, attempts FROM pending_writes WHERE dead=1 ORDER BY id LIMIT ?", (limit,)).fetchall()
+            return [(rid, sid, rng, json.loads(v), err, n) for rid, sid, rng, v, err, n in rows]
+        except Exception: return []
+
+    def requeue_dead(self, ids):
+        """إعادة كتابات متعثرة إلى الطابور من جديد"""
+        with self._lock, _sync_db() as conn:
+            sids = {r[0] for r in conn.execute(f"SELECT DISTINCT sid FROM pending_writes WHERE id IN ({','.join('?' * len(ids))})", list(ids))} if ids else set()
+            conn.executemany("UPDATE pending_writes SET dead=0, attempts=0, next_attempt_at=NULL WHERE id=?", [(i,) for i in ids])
+        # تعود ظاهرة في النسخة المحلية مع التحديث القادم
+        self._store.mark_dirty(*sids)
+        self._ensure_worker()
+
+    def discard_dead(self, ids):
+        with self._lock, _sync_db() as conn:
+            conn.executemany("DELETE FROM pending_writes WHERE id=? AND dead=1", [(i,) for i in ids])
+
+    def conflicts_for(self, author):
+        """تعارضات كتابات المستخدم التي لم يطّلع عليها — [(id, range, قيمته، قيمة الشيت)]"""
+        if not author: return []
+        try:
+            with _sync_db() as conn:
+                return conn.execute("SELECT id, rng, local_value, remote_value FROM sync_conflicts WHERE author=? AND seen=0 ORDER BY id", (author,)).fetchall()
+        except Exception: return []
+
+    def mark_conflicts_seen(self, ids):
+        with self._lock, _sync_db() as conn:
+            conn.executemany("UPDATE sync_conflicts SET seen=1 WHERE id=?", [(i,) for i in ids])
+
+    def _ensure_worker(self):
+        if self._thread is not None and self._thread.is_alive(): return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive(): return
+            self._thread = threading.Thread(target=self._sync_loop, name="sheets-sync", daemon=True)
+            self._thread.start()
+
+    def _sync_loop(self):
+        sheets = get_google_client("sheets")
+        while True:
+            try:
+                if not self.push_once(sheets): time_module.sleep(SYNC_INTERVAL)
+            except Exception as e:
+                logger.error(f"خطأ المزامنة: {e}"); time_module.sleep(SYNC_INTERVAL)
+
+    def push_once(self, sheets):
+        """دفع دفعة واحدة — يعيد True إن بقي عمل"""
+        # المتعثرة والمؤجَّلة (backoff) لا تحجز رأس الطابور عن غيرها
+        with _sync_db() as conn:
+            rows = conn.execute("SELECT id, sid, rng, value, base, author FROM pending_writes WHERE dead=0 AND COALESCE(next_attempt_at, 0)<=? ORDER BY id LIMIT ?",
+                                (time_module.time(), SYNC_BATCH)).fetchall()
+            if not rows: return False
+            synced = {(sid, rng): (pushed, readback) for sid, rng, pushed, readback in
+                      conn.execute("SELECT DISTINCT s.sid, s.rng, s.pushed, s.readback FROM synced_cells s JOIN pending_writes p ON p.sid=s.sid AND p.rng=s.rng WHERE p.id BETWEEN ? AND ?",
+                                   (rows[0][0], rows[-1][0]))}
+        by_sid = {}
+        for rid, sid, rng, value, base, author in rows:
+            cells = by_sid.setdefault(sid, {})
+            if rng in cells:
+                cells[rng]["ids"].append(rid); cells[rng]["value"] = json.loads(value)
+                cells[rng]["author"] = author or cells[rng]["author"]
+            else:
+                # الأساس = قيمة الشيت قبل أول كتابة محلية لم تُزامن
+                base = json.loads(base)
+                # إن كان الأساس قيمتنا الخام المدفوعة سابقاً (اللقطة لم تُحدَّث بعد) نقارن بما قرأه الشيت منها:
+                # الشيت يعيد القيمة منسّقة ("2026-06-01" ← "01/06/2026") فلا يُعدّ ذلك تعديلاً خارجياً
+                pushed = synced.get((sid, rng))
+                if pushed and base is not None and str(base) == pushed[0]: base = pushed[1]
+                cells[rng] = {"ids": [rid], "value": json.loads(value), "base": base, "author": author}
+        for sid, cells in by_sid.items():
+            ranges = list(cells)
+            try:
+                remote = api_execute(sheets.spreadsheets().values().batchGet(spreadsheetId=sid, ranges=ranges), urgent=False).get('valueRanges', [])
+                push, conflicts = [], []
+                for i, rng in enumerate(ranges):
+                    vals = remote[i].get('values', []) if i < len(remote) else []
+                    current = str(vals[0][0]) if vals and vals[0] else ""
+                    c = cells[rng]; local = "" if c["value"] is None else str(c["value"])
+                    base = "" if c["base"] is None else str(c["base"])
+                    # أساس مجهول (الشيت لم يكن محمّلاً) → لا يمكن كشف التعارض، نكتب مباشرة
+                    if c["base"] is not None and current != base and current != local: conflicts.append((sid, rng, local, current, base, time_module.time(), c["author"]))
+                    else: push.append({"range": rng, "values": [[c["value"]]]})
+                readback = []
+                if push:
+                    res = api_execute(sheets.spreadsheets().values().batchUpdate(spreadsheetId=sid, body={"valueInputOption":"USER_ENTERED","data":push,"includeValuesInResponse":True}), urgent=False)
+                    for p, r in zip(push, res.get("responses", [])):
+                        vals = r.get("updatedData", {}).get("values", [])
+                        raw = p["values"][0][0]
+                        readback.append((sid, p["range"], "" if raw is None else str(raw), str(vals[0][0]) if vals and vals[0] else ""))
+                done = [rid for c in cells.values() for rid in c["ids"]]
+                with self._lock, _sync_db() as conn:
+                    conn.executemany("DELETE FROM pending_writes WHERE id=?", [(rid,) for rid in done])
+                    if readback: conn.executemany("INSERT OR REPLACE INTO synced_cells (sid, rng, pushed, readback) VALUES (?,?,?,?)", readback)
+                    if conflicts: conn.executemany("INSERT INTO sync_conflicts (sid, rng, local_value, remote_value, base_value, detected_at, author) VALUES (?,?,?,?,?,?,?)", conflicts)
+                if conflicts:
+                    logger.warning(f"⚠️ {len(conflicts)} تعارض مزامنة في {sid} — احتُفظ بقيمة الشيت")
+                    self._store.mark_dirty(sid)
+            except Exception as e:
+                ids = [rid for c in cells.values() for rid in c["ids"]]
+                now = time_module.time()
+                with self._lock, _sync_db() as conn:
+                    conn.executemany("UPDATE pending_writes SET attempts=attempts+1, last_error=?, next_attempt_at=? + ? * (1 << MIN(attempts, 6)) WHERE id=?",
+                                     [(str(e)[:300], now, SYNC_INTERVAL, rid) for rid in ids])
+                    dead = conn.executemany("UPDATE pending_writes SET dead=1 WHERE id=? AND dead=0 AND attempts>=?", [(rid, SYNC_MAX_ATTEMPTS) for rid in ids]).rowcount
+                if dead:
+                    # لن تصل إلى الشيت: تُزال من النسخة المحلية وتنتظر قرار الإدارة
+                    logger.error(f"❌ {dead} كتابة لـ {sid} نُقلت إلى المتعثرة بعد {SYNC_MAX_ATTEMPTS} محاولات: {e}")
+                    self._store.mark_dirty(sid)
+                else:
+                    logger.error(f"تعذّرت مزامنة {sid}، إعادة لاحقاً: {e}")
+        return len(rows) == SYNC_BATCH
+
+@st.cache_resource
+def get_sync_queue():
+    queue = SheetSyncQueue(get_snapshot_store())
+    # كتابات بقيت من تشغيل سابق تُستأنف فوراً
+    queue._ensure_worker()
+    return queue
+
+def write_cells(spreadsheet_id, data, author=None):
+    """كتابة خلايا: فورية في النسخة المحلية، ومزامنة مع Sheets في الخلفية.
+    author: صاحب الكتابة لتنبيهه عند التعارض (افتراضياً مستخدم الجلسة الحالية)"""
+    if not data: return
+    get_sync_queue().enqueue(spreadsheet_id, data, current_editor() if author is None else author)
+    touched = {ds for d in data for ds in datasets_for_range(spreadsheet_id, d["range"])}
+    invalidate_datasets(*touched, refetch=False)
+
+def render_sync_conflicts():
+    """تنبيه المستخدم بتعديلاته التي لم تُحفظ لأن الخلية عُدّلت مباشرة في الشيت"""
+    queue = get_sync_queue()
+    conflicts = queue.conflicts_for(current_editor())
+    if not conflicts: return
+    lines = "\n".join(f"- `{rng}`: قيمتك «{local}» — القيمة المحفوظة «{remote}»" for _, rng, local, remote in conflicts[:10])
+    st.warning(f"⚠️ {len(conflicts)} من تعديلاتك لم تُحفظ لأن القيمة عُدّلت في الشيت قبل مزامنتها. يُرجى مراجعتها وإعادة إدخالها إن لزم:\n{lines}")
+    if st.button("تم الاطلاع", key="sync_conflicts_seen"):
+        queue.mark_conflicts_seen([c[0] for c in conflicts]); st.rerun()
+
+def render_data_freshness_banner():
+    """تنبيه "البيانات بتاريخ" حين نعمل على لقطة محلية أو أثناء تعطل Google"""
+    get_sync_queue()
+    render_sync_conflicts()
+    since = get_snapshot_store().stale_since()
+    if since is None: return
+    as_of = datetime.fromtimestamp(since).strftime('%Y-%m-%d %H:%M')
+    st.caption(f"🕒 البيانات المعروضة بتاريخ {as_of} — جاري التحديث من Google Sheets")
+
 @st.cache_data(ttl=60)
 def load_students():
     try:
-        result = sheets_service.spreadsheets().values().get(spreadsheetId=STUDENTS_SHEET_ID, range=STUDENTS_RANGE).execute()
-        values = result.get('values',[])
+        values = get_sheet_values(STUDENTS_SHEET_ID, STUDENTS_RANGE)
         if not values: return pd.DataFrame()
         df = pd.DataFrame(values[1:], columns=values[0]); df.columns = df.columns.str.strip(); return df
     except Exception as e: logger.error(f"خطأ الطلاب: {e}"); return pd.DataFrame()
@@ -376,50 +1004,257 @@ def load_students():
 @st.cache_data(ttl=60)
 def load_memos():
     try:
-        result = sheets_service.spreadsheets().values().get(spreadsheetId=MEMOS_SHEET_ID, range="Feuille 1!A1:AV1000").execute()
-        values = result.get('values',[])
+        values = get_sheet_values(MEMOS_SHEET_ID, MEMOS_RANGE)
         if not values: return pd.DataFrame()
         headers = values[0]; rows = values[1:]
         padded = [r+['']*(len(headers)-len(r)) for r in rows]
         return pd.DataFrame(padded, columns=headers)
     except Exception as e: logger.error(f"خطأ المذكرات: {e}"); return pd.DataFrame()
 
-@st.cache_data(ttl=60)
-def upload_to_drive(file_bytes, filename, folder_id, mimetype='application/pdf'):
-    """رفع ملف على Google Drive"""
+# ── فهرس الرفع حسب المحتوى: نفس الملف في نفس المجلد لا يُرفع مرتين ──
+UPLOAD_INDEX_DB = os.path.join(LOCAL_DATA_DIR, "uploads.sqlite3")
+
+def _upload_index_db():
+    os.makedirs(LOCAL_DATA_DIR, exist_ok=True)
+    conn = sqlite3.connect(UPLOAD_INDEX_DB, timeout=10)
+    conn.execute("CREATE TABLE IF NOT EXISTS uploads (sha256 TEXT, folder_id TEXT, file_id TEXT, link TEXT, filename TEXT, size INTEGER, uploaded_at REAL, PRIMARY KEY (sha256, folder_id))")
+    return conn
+
+def find_uploaded_file(digest, folder_id, drive=None):
+    """رابط ملف مرفوع سابقاً بنفس المحتوى — None إن لم يوجد أو حُذف من Drive"""
     try:
-        from googleapiclient.discovery import build as _gbuild
-        from googleapiclient.http import MediaIoBaseUpload as _MIU
-        import io as _io_d
-        drive_service = _gbuild('drive', 'v3', credentials=drive_credentials)
-        file_meta = {'name': filename, 'parents': [folder_id]}
-        media = _MIU(_io_d.BytesIO(file_bytes), mimetype=mimetype, resumable=True)
-        f = drive_service.files().create(body=file_meta, media_body=media, fields='id,webViewLink').execute()
-        drive_service.permissions().create(fileId=f['id'], body={'type':'anyone','role':'reader'}).execute()
-        return True, f['webViewLink']
+        with _upload_index_db() as conn:
+            row = conn.execute("SELECT file_id, link FROM uploads WHERE sha256=? AND folder_id=?", (digest, folder_id)).fetchone()
     except Exception as e:
-        return False, str(e)
+        logger.warning(f"تعذّرت قراءة فهرس الرفع: {e}"); return None
+    if not row: return None
+    file_id, link = row
+    try:
+        # فحص بيانات وصفية صغير بدل إعادة رفع عدة ميغابايت
+        meta = api_execute((drive or get_google_client("drive")).files().get(fileId=file_id, fields='id,trashed', supportsAllDrives=True), api="drive")
+        if not meta.get('trashed'): return link
+    except HttpError as e:
+        if e.resp.status != 404: return link
+    except Exception:
+        return link
+    forget_uploaded_file(digest, folder_id)
+    return None
 
-def upload_mahdar_pdf(file_bytes, filename, folder_id=MAHDAR_FOLDER_ID):
-    """رفع PDF محضر المناقشة على Google Drive"""
+def record_uploaded_file(digest, folder_id, file_id, link, filename, size):
+    try:
+        with _upload_index_db() as conn:
+            conn.execute("INSERT OR REPLACE INTO uploads VALUES (?,?,?,?,?,?,?)", (digest, folder_id, file_id, link, filename, size, time_module.time()))
+    except Exception as e:
+        logger.warning(f"تعذّر تحديث فهرس الرفع: {e}")
+
+def forget_uploaded_file(digest, folder_id):
+    try:
+        with _upload_index_db() as conn:
+            conn.execute("DELETE FROM uploads WHERE sha256=? AND folder_id=?", (digest, folder_id))
+    except Exception as e:
+        logger.warning(f"تعذّر تحديث فهرس الرفع: {e}")
+
+# ── رفع على أجزاء مع استئناف الجلسة: الانقطاع لا يعيد الملف من أوله ──
+UPLOAD_SPOOL_DIR  = os.path.join(LOCAL_DATA_DIR, "spool")
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024   # يجب أن يكون مضاعفاً لـ 256KB
+
+def _upload_sessions_db():
+    conn = _upload_index_db()
+    conn.execute("CREATE TABLE IF NOT EXISTS upload_sessions (resume_key TEXT PRIMARY KEY, uri TEXT, started_at REAL)")
+    return conn
+
+def _upload_session(resume_key, uri=None, forget=False):
+    """قراءة / حفظ / حذف رابط جلسة الرفع المستأنف (صالح أسبوعاً لدى Drive)"""
+    try:
+        with _upload_sessions_db() as conn:
+            if forget: conn.execute("DELETE FROM upload_sessions WHERE resume_key=?", (resume_key,))
+            elif uri: conn.execute("INSERT OR REPLACE INTO upload_sessions VALUES (?,?,?)", (resume_key, uri, time_module.time()))
+            else:
+                row = conn.execute("SELECT uri FROM upload_sessions WHERE resume_key=? AND started_at>?", (resume_key, time_module.time() - 6*86400)).fetchone()
+                return row[0] if row else None
+    except Exception as e:
+        logger.warning(f"تعذّر الوصول لجلسات الرفع: {e}")
+    return None
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024*1024), b""): h.update(block)
+    return h.hexdigest()
+
+@contextlib.contextmanager
+def spooled_file(source, suffix=".pdf"):
+    """مسار ملف على القرص للرفع: المسار كما هو، أو البايتات في ملف مؤقت يُحذف بعد الرفع"""
+    if isinstance(source, str):
+        yield source; return
+    os.makedirs(UPLOAD_SPOOL_DIR, exist_ok=True)
+    path = os.path.join(UPLOAD_SPOOL_DIR, f"tmp_{uuid.uuid4().hex}{suffix}")
+    with open(path, "wb") as f: f.write(source)
+    try: yield path
+    finally:
+        try: os.remove(path)
+        except OSError: pass
+
+def upload_file_chunked(drive, body, path, mimetype, fields='id,webViewLink', resume_key=None, urgent=True):
+    """إنشاء ملف على Drive برفع مستأنف على أجزاء من القرص.
+    رابط الجلسة يُحفظ محلياً: إعادة المحاولة (أو عامل بعد إعادة التشغيل) تكمل من آخر جزء مؤكد."""
+    resume_key = resume_key or f"{file_sha256(path)}|{body.get('name','')}|{','.join(body.get('parents', []))}"
+    budget = get_api_budgets()["drive"]
+    for fresh in (False, True):
+        media = MediaFileUpload(path, mimetype=mimetype, chunksize=UPLOAD_CHUNK_SIZE, resumable=True)
+        request = drive.files().create(body=body, media_body=media, fields=fields)
+        uri = None if fresh else _upload_session(resume_key)
+        # الاستئناف يعتمد على خاصية داخلية في googleapiclient (HttpRequest._in_error_state) — انظر requirements.txt
+        if uri and not hasattr(request, "_in_error_state"):
+            logger.warning(f"نسخة google-api-python-client لا تدعم استئناف الرفع — رفع {body.get('name','')} من البداية")
+            uri = None
+        if uri:
+            # حالة "خطأ" تجعل next_chunk يسأل Drive عن آخر بايت مستلم قبل المتابعة
+            request.resumable_uri = uri; request._in_error_state = True
+            logger.info(f"استئناف رفع {body.get('name','')}")
+        response, attempt = None, 0
+        try:
+            while response is None:
+                budget.acquire(urgent)
+                try:
+                    status, response = request.next_chunk()
+                    attempt = 0
+                except Exception as e:
+                    if attempt >= API_MAX_RETRIES or not _is_retryable(e): raise
+                    delay = min(32, 2 ** attempt) + random.uniform(0, 1); attempt += 1
+                    logger.warning(f"انقطاع أثناء رفع {body.get('name','')} ({e}) — متابعة بعد {delay:.1f}ث")
+                    time_module.sleep(delay)
+                if request.resumable_uri and request.resumable_uri != uri:
+                    uri = request.resumable_uri; _upload_session(resume_key, uri)
+        except HttpError as e:
+            # جلسة منتهية أو مجهولة → نبدأ رفعاً جديداً مرة واحدة
+            if uri and not fresh and e.resp.status in (404, 410):
+                _upload_session(resume_key, forget=True); continue
+            raise
+        _upload_session(resume_key, forget=True)
+        return response
+
+# ── مشاركة الملفات (anyone/reader) مجمّعة في BatchHttpRequest ──
+PERMISSION_BATCH_WINDOW = 0.5   # ثوانٍ لانتظار رفوع متزامنة أخرى قبل الإرسال
+PERMISSION_BATCH_MAX    = 100   # حد Drive لعدد الطلبات في الدفعة الواحدة
+
+class DrivePermissionBatcher:
+    """يجمع طلبات جعل الملفات قابلة للعرض من كل الجلسات وعمّال الرفع في دفعة واحدة.
+    كل مستدعٍ ينتظر نتيجة ملفاته فقط؛ الأخطاء تُعاد لكل ملف على حدة."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pending = []   # [(file_id, {"done": Event, "error": str|None})]
+        self._thread = None
+
+    def share(self, file_ids, timeout=120):
+        """→ {file_id: None عند النجاح أو رسالة الخطأ}"""
+        slots = [(fid, {"done": threading.Event(), "error": None}) for fid in file_ids]
+        with self._lock:
+            self._pending += slots
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._flush_loop, name="drive-permissions", daemon=True)
+                self._thread.start()
+        self._wake.set()
+        return {fid: (slot["error"] if slot["done"].wait(timeout) else "انتهت مهلة مشاركة الملف") for fid, slot in slots}
+
+    def _flush_loop(self):
+        while True:
+            self._wake.wait()
+            time_module.sleep(PERMISSION_BATCH_WINDOW)
+            with self._lock:
+                batch, self._pending = self._pending[:PERMISSION_BATCH_MAX], self._pending[PERMISSION_BATCH_MAX:]
+                if not self._pending: self._wake.clear()
+            if not batch: continue
+            try: self._send(batch)
+            except Exception as e:
+                logger.error(f"فشل دفعة مشاركة Drive: {e}")
+                for _, slot in batch:
+                    if not slot["done"].is_set(): slot["error"] = str(e); slot["done"].set()
+
+    def _send(self, batch):
+        drive = get_google_client("drive")
+        budget = get_api_budgets()["drive"]
+        todo = batch
+        for attempt in range(API_MAX_RETRIES + 1):
+            retry = []
+            def on_result(request_id, response, exception):
+                fid, slot = todo[int(request_id)]
+                if exception is None: slot["done"].set()
+                elif attempt < API_MAX_RETRIES and _is_retryable(exception): retry.append((fid, slot))
+                else: slot["error"] = str(exception); slot["done"].set()
+            request = drive.new_batch_http_request(callback=on_result)
+            for i, (fid, _) in enumerate(todo):
+                request.add(drive.permissions().create(fileId=fid, body={'type':'anyone','role':'reader'}, fields='id'), request_id=str(i))
+            # الحصة تُحسب لكل طلب داخل الدفعة
+            for _ in todo: budget.acquire()
+            try:
+                request.execute()
+            except Exception as e:
+                if attempt >= API_MAX_RETRIES or not _is_retryable(e): raise
+                retry = [item for item in todo if not item[1]["done"].is_set()]
+            if not retry: return
+            todo = retry
+            delay = min(32, 2 ** attempt) + random.uniform(0, 1)
+            logger.warning(f"مشاركة {len(todo)} ملف فشلت مؤقتاً — إعادة بعد {delay:.1f}ث")
+            time_module.sleep(delay)
+
+@st.cache_resource
+def get_permission_batcher():
+    return DrivePermissionBatcher()
+
+def share_files_public(file_ids):
+    """جعل الملفات قابلة للعرض برابط — يرفع خطأ يذكر الملفات التي فشلت"""
+    errors = {fid: err for fid, err in get_permission_batcher().share(file_ids).items() if err}
+    if errors:
+        raise RuntimeError("تعذّرت مشاركة: " + "; ".join(f"{fid}: {err}" for fid, err in errors.items()))
+
+def upload_files_to_drive(files, folder_id):
+    """رفع عدة ملفات [(bytes، الاسم، النوع)] على Google Drive ثم مشاركتها كلها في دفعة واحدة.
+    الملف المطابق بالمحتوى يُعاد رابطه دون رفع. → [(ok، الرابط أو الخطأ)] بنفس الترتيب"""
+    results, fresh = [], []
     try:
-        from googleapiclient.discovery import build as _gbuild
-        from googleapiclient.http import MediaIoBaseUpload as _MIU
-        import io as _io_d
-        drive_service = _gbuild('drive', 'v3', credentials=drive_credentials)
-        file_meta = {'name': filename, 'parents': [folder_id]}
-        media = _MIU(_io_d.BytesIO(file_bytes), mimetype='application/pdf', resumable=True)
-        f = drive_service.files().create(body=file_meta, media_body=media, fields='id,webViewLink').execute()
-        # جعل الملف قابلاً للعرض للجميع
-        drive_service.permissions().create(fileId=f['id'], body={'type':'anyone','role':'reader'}).execute()
-        return True, f['webViewLink']
+        drive_service = get_google_client("drive")
     except Exception as e:
-        return False, str(e)
+        return [(False, str(e)) for _ in files]
+    for file_bytes, filename, mimetype in files:
+        try:
+            digest = hashlib.sha256(file_bytes).hexdigest()
+            link = find_uploaded_file(digest, folder_id, drive_service)
+            if link:
+                logger.info(f"رفع مكرر ({filename}) — استعمال الملف الموجود")
+                results.append((True, link)); continue
+            file_meta = {'name': filename, 'parents': [folder_id]}
+            with spooled_file(file_bytes, os.path.splitext(filename)[1]) as path:
+                f = upload_file_chunked(drive_service, file_meta, path, mimetype, resume_key=f"{digest}|{filename}|{folder_id}")
+            fresh.append((len(results), digest, f, filename, len(file_bytes)))
+            results.append((True, f['webViewLink']))
+        except Exception as e:
+            results.append((False, str(e)))
+    if fresh:
+        # جعل الملفات قابلة للعرض للجميع — طلب واحد لكل الملفات المرفوعة
+        errors = get_permission_batcher().share([f['id'] for _, _, f, _, _ in fresh])
+        for i, digest, f, filename, size in fresh:
+            if errors.get(f['id']):
+                results[i] = (False, f"تعذّرت مشاركة {filename}: {errors[f['id']]}")
+                # ملف غير مشارَك وغير مفهرس → يُحذف كي لا يبقى يتيماً في المجلد (الإعادة ترفعه من جديد)
+                try: api_execute(drive_service.files().delete(fileId=f['id'], supportsAllDrives=True), api="drive")
+                except Exception as e: logger.error(f"تعذّر حذف الملف غير المشارَك {filename} ({f['id']}): {e}")
+            else:
+                record_uploaded_file(digest, folder_id, f['id'], f['webViewLink'], filename, size)
+    return results
+
+def upload_to_drive(file_bytes, filename, folder_id, mimetype='application/pdf'):
+    """رفع ملف على Google Drive — الملف المطابق بالمحتوى يُعاد رابطه دون رفع"""
+    return upload_files_to_drive([(file_bytes, filename, mimetype)], folder_id)[0]
+
+def upload_mahdar_pdf(file_bytes, filename, folder_id=MAHDAR_FOLDER_ID):
+    """رفع PDF محضر المناقشة على Google Drive"""
+    return upload_files_to_drive([(file_bytes, filename, 'application/pdf')], folder_id)[0]
 
 def load_prof_memos():
     try:
-        result = sheets_service.spreadsheets().values().get(spreadsheetId=PROF_MEMOS_SHEET_ID, range=PROF_MEMOS_RANGE).execute()
-        values = result.get('values',[])
+        values = get_sheet_values(PROF_MEMOS_SHEET_ID, PROF_MEMOS_RANGE)
         if not values: return pd.DataFrame()
         return pd.DataFrame(values[1:], columns=values[0])
     except Exception as e: logger.error(f"خطأ الأساتذة: {e}"); return pd.DataFrame()
@@ -427,14 +1262,396 @@ def load_prof_memos():
 @st.cache_data(ttl=60)
 def load_requests():
     try:
-        result = sheets_service.spreadsheets().values().get(spreadsheetId=REQUESTS_SHEET_ID, range=REQUESTS_RANGE).execute()
-        values = result.get('values',[])
+        values = get_sheet_values(REQUESTS_SHEET_ID, REQUESTS_RANGE)
         if not values: return pd.DataFrame()
         return pd.DataFrame(values[1:], columns=values[0])
     except: return pd.DataFrame()
 
-def clear_cache_and_reload(): st.cache_data.clear()
+# ================================================================
+# 🗂️ مستودع المذكرات — فهارس O(1) للبحث عن الصفوف
+# ================================================================
+class MemoRepository:
+    """فهارس مبنية مرة واحدة لكل نسخة بيانات: رقم المذكرة/اسم المستخدم/الأستاذ → رقم الصف في الشيت"""
+    def __init__(self):
+        self._memos = None; self._students = None; self._profs = None
+
+    @staticmethod
+    def _build_index(df, col):
+        index = {}
+        if df.empty or col not in df.columns: return index
+        for pos, key in enumerate(df[col].astype(str).map(normalize_text)):
+            if key: index.setdefault(key, pos+2)
+        return index
+
+    @staticmethod
+    def _build_multi_index(df, col):
+        index = {}
+        if df.empty or col not in df.columns: return index
+        for pos, key in enumerate(df[col].astype(str).str.strip()):
+            if key: index.setdefault(key, []).append(pos+2)
+        return index
+
+    def _memo_state(self):
+        if self._memos is None:
+            df = load_memos()
+            self._memos = (df, self._build_index(df, "رقم المذكرة"), self._build_multi_index(df, "الأستاذ"))
+        return self._memos
+
+    def _student_state(self):
+        if self._students is None:
+            df = load_students()
+            self._students = (df, self._build_index(df, "اسم المستخدم"), self._build_index(df, "رقم التسجيل"))
+        return self._students
+
+    def _prof_state(self):
+        if self._profs is None:
+            df = load_prof_memos()
+            self._profs = (df, self._build_multi_index(df, "الأستاذ"))
+        return self._profs
+
+    def invalidate(self, *names):
+        if "memos" in names: self._memos = None
+        if "students" in names: self._students = None
+        if "prof_memos" in names: self._profs = None
+
+    @property
+    def memos(self): return self._memo_state()[0]
+    @property
+    def students(self): return self._student_state()[0]
+    @property
+    def prof_memos(self): return self._prof_state()[0]
+
+    def memo_row(self, memo_number):
+        """رقم صف المذكرة في الشيت (أو None)"""
+        return self._memo_state()[1].get(normalize_text(memo_number))
+
+    def memo(self, memo_number):
+        df, index, _ = self._memo_state()
+        row_idx = index.get(normalize_text(memo_number))
+        return None if row_idx is None else df.iloc[row_idx-2]
+
+    def memo_rows_of_prof(self, prof_name):
+        return self._memo_state()[2].get(str(prof_name).strip(), [])
+
+    def student_row(self, username):
+        return self._student_state()[1].get(normalize_text(username))
+
+    def student(self, username):
+        df, index, _ = self._student_state()
+        row_idx = index.get(normalize_text(username))
+        return None if row_idx is None else df.iloc[row_idx-2]
+
+    def student_row_by_reg(self, reg):
+        return self._student_state()[2].get(normalize_text(reg))
+
+    def prof_rows(self, prof_name):
+        return self._prof_state()[1].get(str(prof_name).strip(), [])
+
+@st.cache_resource(ttl=60)
+def get_repository():
+    return MemoRepository()
+
+# ── إبطال الكاش حسب مجموعة البيانات ──
+# كل مجموعة = (الشيت، اسم الورقة) — الكتابة في ورقة لا تُبطل إلا محمّلها
+DATASET_SOURCES = {
+    "students":   (STUDENTS_SHEET_ID,   "Feuille 1"),
+    "memos":      (MEMOS_SHEET_ID,      "Feuille 1"),
+    "prof_memos": (PROF_MEMOS_SHEET_ID, "Feuille 1"),
+    "requests":   (REQUESTS_SHEET_ID,   "Feuille 1"),
+    "memo_exc":   (MEMOS_SHEET_ID,      "استثناءات_مذكرات"),
+    "prof_exc":   (MEMOS_SHEET_ID,      "استثناءات_أساتذة"),
+    "days":       (MEMOS_SHEET_ID,      "الأيام"),
+    "slots":      (MEMOS_SHEET_ID,      "التوقيت"),
+    "rooms":      (MEMOS_SHEET_ID,      "القاعات"),
+}
 
+def _dataset_loaders():
+    # load_prof_memos غير مخزّن → لا شيء لإبطاله
+    return {"students": load_students, "memos": load_memos, "requests": load_requests,
+            "memo_exc": load_memo_exceptions, "prof_exc": load_prof_exceptions,
+            "days": load_schedule_days, "slots": load_schedule_slots, "rooms": load_schedule_rooms}
+
+def datasets_for_range(spreadsheet_id, rng):
+    """المجموعة المتأثرة بالكتابة في نطاق معيّن"""
+    tab = rng.split("!")[0].strip("'")
+    return [name for name, (sid, t) in DATASET_SOURCES.items() if sid == spreadsheet_id and t == tab]
+
+def invalidate_datasets(*names, refetch=True):
+    """إبطال كاش مجموعات محددة فقط — بقية البيانات (الأيام، القاعات...) تبقى.
+    refetch=False: اللقطة المحلية محدّثة أصلاً (كتابة محلية) → يكفي إعادة التحليل"""
+    if not names: return
+    loaders = _dataset_loaders()
+    # modifiedTime في Drive قد يتأخر ثوانٍ بعد الكتابة → نفرض إعادة الجلب عند القراءة التالية
+    if refetch: get_snapshot_store().mark_dirty(*{DATASET_SOURCES[n][0] for n in names if n in DATASET_SOURCES})
+    for name in names:
+        if name in loaders: loaders[name].clear()
+    get_repository().invalidate(*names)
+
+def apply_snapshot_updates():
+    """لقطات حدّثها خيط الخلفية → إعادة تحليل مجموعاتها الآن بدل انتظار ttl الكاش"""
+    changed = get_snapshot_store().take_changed()
+    if changed: invalidate_datasets(*[name for name, (sid, _) in DATASET_SOURCES.items() if sid in changed], refetch=False)
+
+def clear_cache_and_reload():
+    st.cache_data.clear(); get_repository.clear()
+    get_snapshot_store().mark_dirty(*SHEET_BATCH_RANGES)
+
+# ================================================================
+# ✍️ مخزن الكتابة — تجميع التحديثات في batchUpdate واحد لكل شيت
+# ================================================================
+class SheetWriteBuffer:
+    """يجمع تحديثات الخلايا لكل شيت ثم يسلّمها دفعة واحدة لكل شيت (write_cells → طابور المزامنة).
+    الاستعمال: with SheetWriteBuffer() as buf: buf.add(...) — الإرسال مضمون عند الخروج،
+    ونتيجة كل شيت في buf.report (أو ما تعيده flush)."""
+    SHEET_LABELS = {STUDENTS_SHEET_ID: "شيت الطلبة", MEMOS_SHEET_ID: "شيت المذكرات",
+                    PROF_MEMOS_SHEET_ID: "شيت الأساتذة", REQUESTS_SHEET_ID: "شيت الطلبات"}
+
+    def __init__(self):
+        self._pending = {}   # spreadsheet_id -> [{"range":..., "values":...}]
+        self.report = []     # [(spreadsheet_id, ok, عدد النطاقات, رسالة)]
+
+    def add(self, spreadsheet_id, rng, value):
+        self._pending.setdefault(spreadsheet_id, []).append({"range": rng, "values": [[value]]})
+
+    def extend(self, spreadsheet_id, data):
+        if data: self._pending.setdefault(spreadsheet_id, []).extend(data)
+
+    def __len__(self): return sum(len(v) for v in self._pending.values())
+
+    def flush(self):
+        """إرسال كل التحديثات المعلقة — يعيد (ok, report)"""
+        pending, self._pending = self._pending, {}
+        report = []
+        for sid, data in pending.items():
+            try:
+                write_cells(sid, data)
+                report.append((sid, True, len(data), "✅"))
+            except Exception as e:
+                logger.error(f"خطأ الكتابة المجمعة ({sid}): {e}")
+                report.append((sid, False, len(data), f"❌ {str(e)}"))
+        self.report.extend(report)
+        return all(r[1] for r in report), report
+
+    @staticmethod
+    def summary(report):
+        """نتيجة كل شيت في سطر واحد: «شيت المذكرات: ✅ (12 خلية) | شيت الطلبة: ❌ ...»"""
+        return " | ".join(f"{SheetWriteBuffer.SHEET_LABELS.get(sid, sid)}: {msg} ({n} خلية)" for sid, ok, n, msg in report)
+
+    @staticmethod
+    def raise_on_failure(report):
+        """خطأ بنتيجة كل شيت إن فشل أحدها — ما نجح منها محفوظ ولا يُعاد"""
+        if not all(r[1] for r in report):
+            raise RuntimeError(SheetWriteBuffer.summary(report))
+
+    def __enter__(self): return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # نرسل ما جُمع حتى عند حدوث خطأ لاحق — كما كانت الكتابة الفورية تفعل
+        if self._pending: self.flush()
+        return False
+
+# ================================================================
+# ✉️ ناقل البريد — اتصالات SMTP موثّقة يُعاد استعمالها
+# ================================================================
+SMTP_POOL_SIZE       = 2     # اتصالات متزامنة كحد أقصى
+SMTP_MAX_PER_SESSION = 80    # Gmail يقطع الجلسة بعد عدد من الرسائل → نفتح جلسة جديدة قبل ذلك
+SMTP_IDLE_TIMEOUT    = 60    # ثوانٍ — الاتصال الخامل أكثر من ذلك يُغلق بدل المخاطرة بانقطاعه
+SMTP_TIMEOUT         = 30
+
+class SmtpPool:
+    """اتصالات SMTP مفتوحة (STARTTLS + login مرة واحدة لكل جلسة) تشترك فيها كل دوال الإرسال.
+    عند انقطاع الاتصال يُفتح اتصال جديد وتُعاد الرسالة مرة واحدة."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = []   # [(server, عدد الرسائل المرسلة عليه, آخر استعمال)]
+        self._slots = threading.BoundedSemaphore(SMTP_POOL_SIZE)
+
+    def _connect(self):
+        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=SMTP_TIMEOUT)
+        server.starttls(context=ssl.create_default_context())
+        server.login(EMAIL_SENDER, EMAIL_PASSWORD)
+        return server
+
+    @staticmethod
+    def _close(server):
+        try: server.quit()
+        except Exception: pass
+
+    def _checkout(self):
+        stale = []; found = None
+        with self._lock:
+            while self._idle and found is None:
+                server, count, last = self._idle.pop()
+                if time_module.time() - last < SMTP_IDLE_TIMEOUT and count < SMTP_MAX_PER_SESSION: found = (server, count)
+                else: stale.append(server)
+        for server in stale: self._close(server)
+        return found or (self._connect(), 0)
+
+    def send(self, to_addrs, raw):
+        """إرسال رسالة جاهزة (بايتات) إلى قائمة مستلمين"""
+        with self._slots:
+            for attempt in (0, 1):
+                server, count = self._checkout()
+                try:
+                    server.sendmail(EMAIL_SENDER, to_addrs, raw)
+                except (smtplib.SMTPServerDisconnected, ConnectionError, socket.timeout, ssl.SSLError):
+                    self._close(server)
+                    if attempt: raise
+                    continue
+                except Exception:
+                    self._close(server)   # حالة الجلسة بعد الخطأ مجهولة
+                    raise
+                with self._lock: self._idle.append((server, count + 1, time_module.time()))
+                return
+
+# ── صندوق الصادر: الرسائل تُحفظ في SQLite ويرسلها خيط في الخلفية ──
+OUTBOX_DB          = os.path.join(LOCAL_DATA_DIR, "outbox.sqlite3")
+EMAIL_PER_MINUTE   = 30    # حد الإرسال لتفادي حظر Gmail المؤقت
+EMAIL_MAX_ATTEMPTS = 5
+EMAIL_RETRY_BASE   = 30    # ثوانٍ — تتضاعف مع كل محاولة
+EMAIL_DEDUP_WINDOW = 24 * 3600   # نفس الرسالة لنفس المستلم خلال هذه المدة تُتخطى (إعادة تشغيل / نقر مزدوج)
+
+def _outbox_db():
+    os.makedirs(LOCAL_DATA_DIR, exist_ok=True)
+    conn = sqlite3.connect(OUTBOX_DB, timeout=10)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, to_addrs TEXT, subject TEXT, raw BLOB, status TEXT, attempts INTEGER DEFAULT 0, next_attempt_at REAL, last_error TEXT, created_at REAL, sent_at REAL)")
+    conn.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)")
+    conn.execute("CREATE TABLE IF NOT EXISTS email_ledger (dedup_key TEXT, outbox_id INTEGER, created_at REAL)")
+    conn.execute("CREATE INDEX IF NOT EXISTS email_ledger_key ON email_ledger (dedup_key, created_at)")
+    return conn
+
+def _email_content_hash(msg):
+    """بصمة المحتوى: الموضوع + النصوص + أسماء المرفقات (بايتات PDF تتغير مع تاريخ الإنشاء)"""
+    h = hashlib.sha256(str(msg.get('Subject', '')).encode('utf-8'))
+    for part in msg.walk():
+        if part.is_multipart(): continue
+        if part.get_filename(): h.update(part.get_filename().encode('utf-8'))
+        elif part.get_content_maintype() == 'text': h.update(part.get_payload(decode=True) or b'')
+    return h.hexdigest()
+
+def _flatten_email(msg, to_addrs=None):
+    """(المستلمون، بايتات الرسالة) كما يفعل send_message: Bcc يُضاف للمستلمين ويُحذف من الرأس"""
+    if to_addrs is None:
+        fields = msg.get_all('To', []) + msg.get_all('Cc', []) + msg.get_all('Bcc', [])
+        to_addrs = [addr for _, addr in getaddresses(fields) if addr]
+    msg_copy = copy.copy(msg)
+    del msg_copy['Bcc']; del msg_copy['Resent-Bcc']
+    with io.BytesIO() as buf:
+        BytesGenerator(buf).flatten(msg_copy, linesep='\r\n')
+        return to_addrs, buf.getvalue()
+
+class EmailOutbox:
+    """طابور بريد دائم: دوال الإرسال تضيف الرسالة وتعود فوراً، والإرسال الفعلي في الخلفية
+    بحد أقصى للمعدل، مع إعادة المحاولة للأخطاء المؤقتة وتتبع الحالة (pending / sent / failed)."""
+    def __init__(self, pool):
+        self._pool = pool
+        self._budget = RequestBudget(EMAIL_PER_MINUTE)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def enqueue(self, msg, to_addrs=None, template="", memo=""):
+        """إضافة رسالة — المستلمون الذين وصلتهم نفس الرسالة (قالب، مذكرة، محتوى) مؤخراً يُحذفون.
+        يعيد رقم الرسالة، أو None إن كانت مكررة لكل المستلمين"""
+        to_addrs, raw = _flatten_email(msg, to_addrs)
+        if not to_addrs: raise ValueError("لا يوجد مستلم")
+        content = _email_content_hash(msg)
+        keys = {addr: hashlib.sha256(f"{template}|{memo}|{addr.lower()}|{content}".encode('utf-8')).hexdigest() for addr in to_addrs}
+        now = time_module.time(); subject = str(msg.get('Subject', ''))
+        with self._lock, _outbox_db() as conn:
+            # رسالة سابقة فشلت نهائياً لا تمنع إعادة الإرسال
+            dup = {addr for addr, key in keys.items() if conn.execute(
+                "SELECT 1 FROM email_ledger l JOIN outbox o ON o.id = l.outbox_id WHERE l.dedup_key=? AND l.created_at>? AND o.status IN ('pending','sent') LIMIT 1",
+                (key, now - EMAIL_DEDUP_WINDOW)).fetchone()}
+            fresh = [addr for addr in to_addrs if addr not in dup]
+            if dup:
+                # تُسجَّل كـ skipped ليظهر عددها في لوحة الإدارة
+                conn.execute("INSERT INTO outbox (to_addrs, subject, status, last_error, created_at) VALUES (?,?,'skipped','مكررة',?)", (json.dumps(sorted(dup)), subject, now))
+                logger.info(f"⏭️ تخطي رسالة مكررة ({template or subject}) إلى: {', '.join(sorted(dup))}")
+            if not fresh: return None
+            cur = conn.execute("INSERT INTO outbox (to_addrs, subject, raw, status, next_attempt_at, created_at) VALUES (?,?,?,'pending',?,?)",
+                               (json.dumps(fresh), subject, raw, now, now))
+            conn.executemany("INSERT INTO email_ledger VALUES (?,?,?)", [(keys[addr], cur.lastrowid, now) for addr in fresh])
+        self._ensure_dispatcher(); self._wake.set()
+        return cur.lastrowid
+
+    def status(self):
+        """عدد الرسائل حسب الحالة — {"pending": n, "sent": n, "failed": n, "skipped": n}"""
+        try:
+            with _outbox_db() as conn:
+                return dict(conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+        except Exception: return {}
+
+    def failures(self, limit=20):
+        """آخر الرسائل الفاشلة: [(id, المستلمون, الموضوع, الخطأ)]"""
+        with _outbox_db() as conn:
+            rows = conn.execute("SELECT id, to_addrs, subject, last_error FROM outbox WHERE status='failed' ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        return [(rid, ", ".join(json.loads(to)), subj, err) for rid, to, subj, err in rows]
+
+    def retry_failed(self):
+        now = time_module.time()
+        with self._lock, _outbox_db() as conn:
+            n = conn.execute("UPDATE outbox SET status='pending', attempts=0, next_attempt_at=? WHERE status='failed'", (now,)).rowcount
+        self._ensure_dispatcher(); self._wake.set()
+        return n
+
+    def _ensure_dispatcher(self):
+        if self._thread is not None and self._thread.is_alive(): return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive(): return
+            self._thread = threading.Thread(target=self._dispatch_loop, name="email-outbox", daemon=True)
+            self._thread.start()
+
+    def _dispatch_loop(self):
+        last_digest = 0
+        while True:
+            try:
+                if time_module.time() - last_digest >= 60:
+                    last_digest = time_module.time()
+                    if flush_assignment_digests(): continue
+                with _outbox_db() as conn:
+                    row = conn.execute("SELECT id, to_addrs, raw, attempts FROM outbox WHERE status='pending' AND next_attempt_at<=? ORDER BY id LIMIT 1", (time_module.time(),)).fetchone()
+                if row is None:
+                    self._wake.wait(EMAIL_RETRY_BASE); self._wake.clear(); continue
+                self._budget.acquire()
+                self._deliver(*row)
+            except Exception as e:
+                logger.error(f"خطأ صندوق الصادر: {e}"); time_module.sleep(EMAIL_RETRY_BASE)
+
+    def _deliver(self, rid, to_addrs, raw, attempts):
+        try:
+            self._pool.send(json.loads(to_addrs), raw)
+        except Exception as e:
+            attempts += 1
+            # رفض نهائي من الخادم (5xx) أو استنفاد المحاولات → failed
+            permanent = isinstance(e, smtplib.SMTPResponseException) and 500 <= e.smtp_code < 600
+            permanent = permanent or isinstance(e, smtplib.SMTPRecipientsRefused)
+            status = "failed" if permanent or attempts >= EMAIL_MAX_ATTEMPTS else "pending"
+            with self._lock, _outbox_db() as conn:
+                conn.execute("UPDATE outbox SET status=?, attempts=?, next_attempt_at=?, last_error=? WHERE id=?",
+                             (status, attempts, time_module.time() + EMAIL_RETRY_BASE * (2 ** attempts), str(e)[:300], rid))
+            logger.warning(f"فشل إرسال البريد {rid} (محاولة {attempts}): {e}")
+            return
+        with self._lock, _outbox_db() as conn:
+            # نص الرسالة لم يعد لازماً بعد الإرسال
+            conn.execute("UPDATE outbox SET status='sent', sent_at=?, raw=NULL, last_error=NULL WHERE id=?", (time_module.time(), rid))
+
+@st.cache_resource
+def get_smtp_pool():
+    return SmtpPool()
+
+@st.cache_resource
+def get_outbox():
+    outbox = EmailOutbox(get_smtp_pool())
+    # رسائل بقيت من تشغيل سابق تُرسل فوراً
+    outbox._ensure_dispatcher()
+    return outbox
+
+def send_email(msg, to_addrs=None, template="", memo=""):
+    """إضافة رسالة MIME إلى صندوق الصادر — الإرسال يتم في الخلفية.
+    يعيد None إن كانت الرسالة قد أُرسلت لنفس المستلمين خلال EMAIL_DEDUP_WINDOW"""
+    return get_outbox().enqueue(msg, to_addrs, template=template, memo=memo)
 
 def _email_style():
     return """<style>body{font-family:Arial,sans-serif;background:#f4f4f4;padding:20px;direction:rtl;text-align:right;}.container{background:#fff;padding:28px;border-radius:12px;box-shadow:0 2px 10px rgba(0,0,0,.1);max-width:600px;margin:auto;}.header{background:linear-gradient(135deg,#0F2942,#2F6F7E);color:#fff;padding:20px;border-radius:8px;text-align:center;margin-bottom:18px;}.header h2{margin:0;font-size:1.3rem;}.info-box{background:#f0f9ff;padding:14px;border-right:4px solid #2F6F7E;margin:12px 0;border-radius:6px;}.action-box{background:#fff8e1;padding:14px;border-right:4px solid #F59E0B;margin:12px 0;border-radius:6px;}.success-box{background:#f0fdf4;padding:14px;border-right:4px solid #10B981;margin:12px 0;border-radius:6px;}.warning-box{background:#fff1f2;padding:14px;border-right:4px solid #EF4444;margin:12px 0;border-radius:6px;}.reject-box{background:#fff1f2;padding:14px;border-right:4px solid #EF4444;margin:12px 0;border-radius:6px;}.platform-btn{display:inline-block;background:#2F6F7E;color:#fff!important;padding:12px 28px;border-radius:8px;text-decoration:none;font-weight:bold;margin-top:10px;}.footer{text-align:center;color:#888;font-size:12px;margin-top:24px;border-top:1px solid #eee;padding-top:12px;}p{color:#333;line-height:1.8;}</style>"""
@@ -552,8 +1769,7 @@ def send_deposit_email_to_professor(prof_name, memo_number, memo_title, student1
             msg['From']=EMAIL_SENDER; msg['To']=recipient
             msg['Subject']=f"📥 إيداع مذكرة للمراجعة — رقم {memo_number}"
             msg.attach(MIMEText(body,'html','utf-8'))
-            with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-                server.starttls(); server.login(EMAIL_SENDER, EMAIL_PASSWORD); server.send_message(msg)
+            send_email(msg, template="deposit", memo=memo_number)
         return True, "✅ تم إرسال الإشعار"
     except Exception as e: return False, f"❌ {str(e)}"
 
@@ -575,8 +1791,7 @@ def send_approval_email_to_students(memo_number, memo_title, prof_name, student1
         msg['Bcc']=ADMIN_EMAIL
         msg['Subject']=f"🟢 مذكرتك معتمدة — رقم {memo_number}"
         msg.attach(MIMEText(body,'html','utf-8'))
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls(); server.login(EMAIL_SENDER, EMAIL_PASSWORD); server.send_message(msg)
+        send_email(msg, template="approval", memo=memo_number)
         return True, "✅ تم إرسال إشعار الموافقة"
     except Exception as e: return False, f"❌ {str(e)}"
 
@@ -597,8 +1812,7 @@ def send_rejection_email_to_students(memo_number, memo_title, prof_name, reason,
         msg['Bcc']=ADMIN_EMAIL
         msg['Subject']=f"🔴 ملاحظات على مذكرتك — رقم {memo_number}"
         msg.attach(MIMEText(body,'html','utf-8'))
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls(); server.login(EMAIL_SENDER, EMAIL_PASSWORD); server.send_message(msg)
+        send_email(msg, template="rejection", memo=memo_number)
         return True, "✅ تم إرسال إشعار الإعادة"
     except Exception as e: return False, f"❌ {str(e)}"
 
@@ -618,8 +1832,7 @@ def send_notes_email_to_students(memo_number, memo_title, prof_name, notes, s1_d
         if len(recipients)>1: msg['Cc']=", ".join(recipients[1:])
         msg['Subject']=f"📝 ملاحظات المشرف — رقم {memo_number}"
         msg.attach(MIMEText(body,'html','utf-8'))
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls(); server.login(EMAIL_SENDER, EMAIL_PASSWORD); server.send_message(msg)
+        send_email(msg, template="supervisor_notes", memo=memo_number)
         return True, "✅ تم إرسال الملاحظات"
     except Exception as e: return False, f"❌ {str(e)}"
 
@@ -640,8 +1853,7 @@ def send_defense_schedule_email(memo_number, memo_title, prof_name, defense_date
         msg['Bcc']=ADMIN_EMAIL
         msg['Subject']=f"📅 موعد مناقشتك — رقم {memo_number}"
         msg.attach(MIMEText(body,'html','utf-8'))
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls(); server.login(EMAIL_SENDER, EMAIL_PASSWORD); server.send_message(msg)
+        send_email(msg, template="defense_schedule", memo=memo_number)
         return True, "✅ تم إرسال موعد المناقشة"
     except Exception as e: return False, f"❌ {str(e)}"
 
@@ -667,8 +1879,7 @@ def _send_email_to_professor_row(row):
         msg['From']=EMAIL_SENDER; msg['To']=email
         msg['Subject']="تفعيل حساب فضاء الأساتذة - منصة المذكرات"
         msg.attach(MIMEText(body,'html','utf-8'))
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls(); server.login(EMAIL_SENDER, EMAIL_PASSWORD); server.send_message(msg)
+        send_email(msg, template="welcome_prof")
         return True, f"✅ تم الإرسال إلى {email}"
     except Exception as e: return False, f"❌ {str(e)}"
 
@@ -680,7 +1891,7 @@ def send_welcome_emails_to_all_profs():
             ok,msg = _send_email_to_professor_row(row)
             if ok: sent+=1
             else: failed+=1
-            logs.append(msg); pb.progress((i+1)/total); time_module.sleep(0.5)
+            logs.append(msg); pb.progress((i+1)/total)
     return sent, failed, logs
 
 def send_welcome_email_to_one(prof_name):
@@ -706,8 +1917,7 @@ def send_email_to_professor(prof_name, memo_info, student1, student2=None):
         msg['From']=EMAIL_SENDER; msg['To']=prof_email
         msg['Subject']=f"✅ تسجيل مذكرة رقم {memo_info['رقم المذكرة']}"
         msg.attach(MIMEText(body,'html','utf-8'))
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls(); server.login(EMAIL_SENDER, EMAIL_PASSWORD); server.send_message(msg)
+        send_email(msg, template="registration", memo=memo_info['رقم المذكرة'])
         return True, "تم الإرسال"
     except Exception as e: return False, f"❌ {str(e)}"
 
@@ -726,119 +1936,402 @@ def send_session_emails(students_data, session_info, prof_name):
         if emails: msg['Bcc']=", ".join(emails)
         msg['Subject']=f"🔔 ملاحظة من المشرف — {prof_name}"
         msg.attach(MIMEText(body,'html','utf-8'))
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls(); server.login(EMAIL_SENDER, EMAIL_PASSWORD); server.send_message(msg)
+        send_email(msg, template="session_note")
         return True, "تم"
     except Exception as e: return False, str(e)
 
 
-def upload_memo_to_drive(pdf_bytes, memo_number, memo_title):
-    if drive_service is None: return False, "", "❌ Drive غير متاح"
+# ── فهرس ملفات المذكرات في Drive: رقم المذكرة → النسخة الحالية + النسخ السابقة ──
+# يُبنى مرة بقراءة المجلد، ثم يُحدَّث تدريجياً من سجل التغييرات (changes feed)
+DRIVE_INDEX_TTL = 30   # ثوانٍ بين طلبين لسجل التغييرات
+
+def _drive_index_db():
+    conn = _upload_index_db()
+    conn.execute("CREATE TABLE IF NOT EXISTS memo_files (file_id TEXT PRIMARY KEY, memo_number TEXT, name TEXT, is_current INTEGER)")
+    conn.execute("CREATE INDEX IF NOT EXISTS memo_files_by_memo ON memo_files (memo_number)")
+    conn.execute("CREATE TABLE IF NOT EXISTS drive_index_state (key TEXT PRIMARY KEY, value TEXT)")
+    return conn
+
+def _memo_file_row(file_id, name):
+    """(file_id, رقم المذكرة, الاسم, حالية؟) — الاسم "رقم.العنوان.pdf"، والنسخ السابقة تحمل "_v" """
+    return (file_id, name.split('.', 1)[0], name, int('_v' not in name and name.endswith('.pdf')))
+
+def record_memo_file(file_id, name):
+    try:
+        with _drive_index_db() as conn:
+            conn.execute("INSERT OR REPLACE INTO memo_files VALUES (?,?,?,?)", _memo_file_row(file_id, name))
+    except Exception as e:
+        logger.warning(f"تعذّر تحديث فهرس Drive: {e}")
+
+def refresh_memo_file_index(drive, force=False):
+    """مزامنة الفهرس: قراءة كاملة أول مرة، ثم التغييرات منذ آخر رمز فقط"""
+    with _drive_index_db() as conn:
+        state = dict(conn.execute("SELECT key, value FROM drive_index_state").fetchall())
+    if not force and time_module.time() - float(state.get("checked_at", 0)) < DRIVE_INDEX_TTL: return
+    token = state.get("page_token")
+    if token is None:
+        # الرمز يُؤخذ قبل القراءة الكاملة حتى لا يضيع تغيير يحدث أثناءها
+        token = api_execute(drive.changes().getStartPageToken(), api="drive")["startPageToken"]
+        rows, page = [], None
+        while True:
+            res = api_execute(drive.files().list(q=f"'{DRIVE_UPLOAD_FOLDER_ID}' in parents and trashed=false",
+                                                 fields="nextPageToken,files(id,name)", pageSize=1000, pageToken=page), api="drive")
+            rows += [_memo_file_row(f['id'], f.get('name', '')) for f in res.get('files', [])]
+            page = res.get('nextPageToken')
+            if not page: break
+        with _drive_index_db() as conn:
+            conn.execute("DELETE FROM memo_files")
+            conn.executemany("INSERT OR REPLACE INTO memo_files VALUES (?,?,?,?)", rows)
+    else:
+        upserts, removed = [], []
+        while True:
+            res = api_execute(drive.changes().list(pageToken=token, pageSize=1000,
+                                                   fields="nextPageToken,newStartPageToken,changes(fileId,removed,file(name,parents,trashed))"), api="drive")
+            for ch in res.get('changes', []):
+                f = ch.get('file') or {}
+                if ch.get('removed') or f.get('trashed') or DRIVE_UPLOAD_FOLDER_ID not in f.get('parents', []):
+                    removed.append((ch['fileId'],))
+                else:
+                    upserts.append(_memo_file_row(ch['fileId'], f.get('name', '')))
+            if res.get('newStartPageToken'): token = res['newStartPageToken']; break
+            token = res['nextPageToken']
+        with _drive_index_db() as conn:
+            conn.executemany("DELETE FROM memo_files WHERE file_id=?", removed)
+            conn.executemany("INSERT OR REPLACE INTO memo_files VALUES (?,?,?,?)", upserts)
+    with _drive_index_db() as conn:
+        conn.executemany("INSERT OR REPLACE INTO drive_index_state VALUES (?,?)", [("page_token", token), ("checked_at", str(time_module.time()))])
+
+def memo_file_versions(memo_number, drive):
+    """{"current": [(id, الاسم)], "previous": [(id, الاسم)]} لمذكرة — من الفهرس بعد مزامنته"""
+    try:
+        refresh_memo_file_index(drive)
+    except Exception as e:
+        # سجل التغييرات غير متاح → الفهرس المحلي قد يكون متأخراً؛ نعيد بناءه في المرة القادمة
+        logger.warning(f"تعذّر تحديث فهرس Drive: {e}")
+        with _drive_index_db() as conn: conn.execute("DELETE FROM drive_index_state WHERE key='page_token'")
+        refresh_memo_file_index(drive, force=True)
+    with _drive_index_db() as conn:
+        rows = conn.execute("SELECT file_id, name, is_current FROM memo_files WHERE memo_number=?", (str(memo_number),)).fetchall()
+    return {"current": [(fid, name) for fid, name, cur in rows if cur],
+            "previous": [(fid, name) for fid, name, cur in rows if not cur]}
+
+def upload_memo_to_drive(pdf_source, memo_number, memo_title):
+    """رفع مذكرة (بايتات أو مسار ملف في مجلد الانتظار) مع أرشفة النسخ السابقة"""
     try:
+        # يُستدعى من عمّال الرفع أيضاً → عميل الخيط الحالي
+        drive_service = get_google_client("drive")
         safe_title = re.sub(r'[\\/:*?"<>|]','',str(memo_title).strip())
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
 
-        # البحث عن النسخ القديمة لإعادة تسميتها كنسخ احتياطية
-        existing = drive_service.files().list(
-            q=f"'{DRIVE_UPLOAD_FOLDER_ID}' in parents and name contains '{memo_number}.' and not name contains '_v' and trashed=false",
-            fields="files(id,name)"
-        ).execute()
-        for f in existing.get('files',[]):
-            old_name = f.get('name','')
-            # إعادة تسمية الملف القديم كنسخة احتياطية فقط إذا كان نفس المذكرة
-            if old_name.startswith(f"{memo_number}."):
-                backup_name = old_name.replace('.pdf', f'_v{timestamp}.pdf')
-                drive_service.files().update(
-                    fileId=f['id'],
-                    body={'name': backup_name}
-                ).execute()
+        # النسخ الحالية من الفهرس المحلي (بدل البحث في المجلد) → إعادة تسميتها كنسخ احتياطية
+        for file_id, old_name in memo_file_versions(memo_number, drive_service)["current"]:
+            backup_name = old_name.replace('.pdf', f'_v{timestamp}.pdf')
+            api_execute(drive_service.files().update(
+                fileId=file_id,
+                body={'name': backup_name}
+            ), api="drive")
+            record_memo_file(file_id, backup_name)
 
         # رفع الملف الجديد
         file_name = f"{memo_number}.{safe_title}.pdf"
-        media = MediaIoBaseUpload(io.BytesIO(pdf_bytes), mimetype='application/pdf', resumable=True)
-        uploaded = drive_service.files().create(
-            body={'name': file_name, 'parents': [DRIVE_UPLOAD_FOLDER_ID]},
-            media_body=media, fields='id,webViewLink'
-        ).execute()
+        with spooled_file(pdf_source) as path:
+            uploaded = upload_file_chunked(drive_service, {'name': file_name, 'parents': [DRIVE_UPLOAD_FOLDER_ID]}, path, 'application/pdf')
         file_id = uploaded.get('id')
-        drive_service.permissions().create(fileId=file_id, body={'type':'anyone','role':'reader'}).execute()
+        record_memo_file(file_id, file_name)
+        share_files_public([file_id])
         link = uploaded.get('webViewLink', f"https://drive.google.com/file/d/{file_id}/view")
         return True, link, "✅ تم رفع الملف"
     except Exception as e: return False, "", f"❌ {str(e)}"
 
+def deposit_cells(row_idx, file_link):
+    """خلايا الإيداع (الحالة، الرابط، التاريخ) لسطر مذكرة"""
+    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M')
+    return [{"range":f"Feuille 1!T{row_idx}","values":[["مودعة"]]},{"range":f"Feuille 1!U{row_idx}","values":[[file_link]]},{"range":f"Feuille 1!V{row_idx}","values":[[timestamp]]}]
+
 def save_memo_deposit(memo_number, file_link):
     try:
-        df_memos = load_memos()
-        row = df_memos[df_memos["رقم المذكرة"].astype(str).apply(normalize_text)==normalize_text(memo_number)]
-        if row.empty: return False, "❌ غير موجودة"
-        row_idx = row.index[0]+2
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M')
-        sheets_service.spreadsheets().values().batchUpdate(spreadsheetId=MEMOS_SHEET_ID, body={"valueInputOption":"USER_ENTERED","data":[{"range":f"Feuille 1!T{row_idx}","values":[["مودعة"]]},{"range":f"Feuille 1!U{row_idx}","values":[[file_link]]},{"range":f"Feuille 1!V{row_idx}","values":[[timestamp]]}]}).execute()
-        clear_cache_and_reload(); return True, "✅ تم حفظ الإيداع"
+        row_idx = get_repository().memo_row(memo_number)
+        if row_idx is None: return False, "❌ غير موجودة"
+        write_cells(MEMOS_SHEET_ID, deposit_cells(row_idx, file_link))
+        return True, "✅ تم حفظ الإيداع"
     except Exception as e: return False, f"❌ {str(e)}"
 
+# ================================================================
+# 🗜️ فحص PDF قبل الرفع وضغطه (PyMuPDF)
+# ================================================================
+PDF_COMPRESS_MIN_BYTES = 1024 * 1024   # الملفات الأصغر تُرفع كما هي
+PDF_IMAGE_TARGET_DPI   = 150           # دقة كافية للقراءة على الشاشة والطباعة العادية
+PDF_IMAGE_QUALITY      = 75
+
+def inspect_pdf(pdf_bytes):
+    """التأكد أن الملف PDF يُفتح فعلاً → (ok, عدد الصفحات أو رسالة خطأ)"""
+    try:
+        import fitz
+    except ImportError:
+        return True, None   # PyMuPDF غير مثبت → نكتفي بفحص %PDF
+    try:
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+            if doc.needs_pass: return False, "❌ الملف محمي بكلمة سر — أزل الحماية ثم أعد الرفع"
+            if doc.page_count == 0: return False, "❌ الملف لا يحتوي أي صفحة"
+            return True, doc.page_count
+    except Exception as e:
+        logger.warning(f"PDF لا يُفتح: {e}")
+        return False, "❌ تعذّر فتح الملف — يبدو أن ملف PDF تالف"
+
+def compress_pdf_file(path):
+    """تصغير الصور المضمّنة وحذف الكائنات غير المستعملة، واستبدال الملف إن صار أصغر → (الحجم الأصلي، الحجم النهائي)"""
+    original = os.path.getsize(path)
+    if original < PDF_COMPRESS_MIN_BYTES: return original, original
+    try:
+        import fitz
+        with fitz.open(path) as doc:
+            # rewrite_images متاح في PyMuPDF 1.24.11+ — النسخ الأقدم تكتفي بالضغط وتنظيف الكائنات
+            if hasattr(doc, "rewrite_images"):
+                doc.rewrite_images(dpi_threshold=PDF_IMAGE_TARGET_DPI + 50, dpi_target=PDF_IMAGE_TARGET_DPI, quality=PDF_IMAGE_QUALITY)
+            doc.save(path + ".min", garbage=3, deflate=True, deflate_images=True, deflate_fonts=True, clean=True)
+        final = os.path.getsize(path + ".min")
+        if final < original: os.replace(path + ".min", path); return original, final
+        os.remove(path + ".min")
+    except Exception as e:
+        logger.warning(f"تعذّر ضغط {path}، يُرفع كما هو: {e}")
+        try: os.remove(path + ".min")
+        except OSError: pass
+    return original, original
+
+# ================================================================
+# 📤 طابور رفع الإيداعات — حفظ الملف على القرص ثم الرفع في الخلفية
+# ================================================================
+UPLOAD_JOBS_DB      = os.path.join(LOCAL_DATA_DIR, "upload_jobs.sqlite3")
+UPLOAD_WORKERS      = 3
+UPLOAD_MAX_ATTEMPTS = 6
+UPLOAD_RETRY_BASE   = 5   # ثوانٍ — تتضاعف مع كل محاولة فاشلة
+UPLOAD_JOBS_ADDED_COLUMNS = (("pages", "INTEGER"), ("original_size", "INTEGER"), ("final_size", "INTEGER"), ("notify", "TEXT"))
+
+def _upload_jobs_db():
+    os.makedirs(LOCAL_DATA_DIR, exist_ok=True)
+    conn = sqlite3.connect(UPLOAD_JOBS_DB, timeout=10)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS upload_jobs (id TEXT PRIMARY KEY, memo_number TEXT, memo_title TEXT, row_idx INTEGER, extra_cells TEXT, spool_path TEXT, status TEXT, attempts INTEGER DEFAULT 0, next_attempt_at REAL, link TEXT, last_error TEXT, created_at REAL, updated_at REAL, pages INTEGER, original_size INTEGER, final_size INTEGER)")
+    add_missing_columns(conn, "upload_jobs", UPLOAD_JOBS_ADDED_COLUMNS)
+    return conn
+
+class DepositUploadQueue:
+    """إيداعات الطلبة: الملف يُحفظ على القرص ويُؤكَّد الاستلام فوراً،
+    ثم يرفعه عمّال في الخلفية إلى Drive ويحدّثون الشيت مع إعادة المحاولة.
+    الحالات: pending → uploading → committed، أو failed بعد استنفاد المحاولات،
+    أو replaced إذا رفع الطالب ملفاً جديداً بدل مهمة فاشلة.
+    إشعار الإيداع (notify) يُرسل بعد اكتمال الرفع وتحديث الشيت فقط."""
+    JOB_FIELDS = ("id", "status", "attempts", "link", "last_error", "created_at", "updated_at")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._threads = []
+        # مهام انقطعت أثناء الرفع (إعادة تشغيل الخادم) تعود إلى الانتظار
+        with _upload_jobs_db() as conn:
+            conn.execute("UPDATE upload_jobs SET status='pending' WHERE status='uploading'")
+
+    def submit(self, pdf_bytes, memo_number, memo_title, row_idx, extra_cells=None, pages=None, notify=None):
+        """حفظ الملف في مجلد الانتظار وتسجيل المهمة — يعيد رقم المهمة.
+        notify: {"kind": ..., "args": [...]} إشعار يُرسل بعد اكتمال الإيداع"""
+        job_id = f"{memo_number}_{int(time_module.time()*1000)}_{random.randint(0, 9999):04d}"
+        os.makedirs(UPLOAD_SPOOL_DIR, exist_ok=True)
+        path = os.path.join(UPLOAD_SPOOL_DIR, f"{job_id}.pdf")
+        with open(path + ".part", "wb") as f:
+            f.write(pdf_bytes); f.flush(); os.fsync(f.fileno())
+        os.replace(path + ".part", path)
+        now = time_module.time()
+        with self._lock, _upload_jobs_db() as conn:
+            # الملف الجديد يحلّ محل المهام الفاشلة للمذكرة نفسها
+            replaced = conn.execute("SELECT spool_path FROM upload_jobs WHERE memo_number=? AND status='failed'", (str(memo_number),)).fetchall()
+            conn.execute("UPDATE upload_jobs SET status='replaced', updated_at=? WHERE memo_number=? AND status='failed'", (now, str(memo_number)))
+            conn.execute("INSERT INTO upload_jobs (id, memo_number, memo_title, row_idx, extra_cells, spool_path, status, next_attempt_at, created_at, updated_at, pages, notify) VALUES (?,?,?,?,?,?,'pending',?,?,?,?,?)",
+                         (job_id, str(memo_number), str(memo_title), row_idx, json.dumps(extra_cells or [], ensure_ascii=False), path, now, now, now, pages,
+                          json.dumps(notify, ensure_ascii=False, default=str) if notify else None))
+        for (old_path,) in replaced:
+            try: os.remove(old_path)
+            except OSError: pass
+        self._ensure_workers(); self._wake.set()
+        return job_id
+
+    def latest_job(self, memo_number):
+        """آخر مهمة رفع للمذكرة — dict أو None"""
+        try:
+            with _upload_jobs_db() as conn:
+                row = conn.execute(f"SELECT {', '.join(self.JOB_FIELDS)} FROM upload_jobs WHERE memo_number=? ORDER BY created_at DESC LIMIT 1", (str(memo_number),)).fetchone()
+        except Exception as e:
+            logger.warning(f"تعذّرت قراءة طابور الرفع: {e}"); return None
+        return dict(zip(self.JOB_FIELDS, row)) if row else None
+
+    def retry(self, job_id):
+        """إعادة مهمة فاشلة إلى الانتظار (الملف ما زال في مجلد الانتظار)"""
+        now = time_module.time()
+        with self._lock, _upload_jobs_db() as conn:
+            conn.execute("UPDATE upload_jobs SET status='pending', attempts=0, next_attempt_at=?, updated_at=? WHERE id=? AND status='failed'", (now, now, job_id))
+        self._ensure_workers(); self._wake.set()
+
+    def status(self):
+        """عدد المهام حسب الحالة — {"pending": n, "uploading": n, "failed": n, ...}"""
+        try:
+            with _upload_jobs_db() as conn:
+                return dict(conn.execute("SELECT status, COUNT(*) FROM upload_jobs GROUP BY status").fetchall())
+        except Exception: return {}
+
+    def bytes_saved(self):
+        """مجموع ما وفّره ضغط PDF على الإيداعات المرفوعة (بايت)"""
+        try:
+            with _upload_jobs_db() as conn:
+                return conn.execute("SELECT COALESCE(SUM(original_size - final_size), 0) FROM upload_jobs WHERE final_size IS NOT NULL").fetchone()[0]
+        except Exception: return 0
+
+    def _ensure_workers(self):
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < UPLOAD_WORKERS:
+                t = threading.Thread(target=self._worker_loop, name=f"deposit-upload-{len(self._threads)}", daemon=True)
+                t.start(); self._threads.append(t)
+
+    def _claim(self):
+        now = time_module.time()
+        with self._lock, _upload_jobs_db() as conn:
+            row = conn.execute("SELECT id, memo_number, memo_title, row_idx, extra_cells, spool_path, attempts, final_size, notify FROM upload_jobs WHERE status='pending' AND next_attempt_at<=? ORDER BY created_at LIMIT 1", (now,)).fetchone()
+            if row: conn.execute("UPDATE upload_jobs SET status='uploading', updated_at=? WHERE id=?", (now, row[0]))
+        return row
+
+    def _worker_loop(self):
+        while True:
+            try:
+                job = self._claim()
+                if job is None:
+                    self._wake.wait(UPLOAD_RETRY_BASE); self._wake.clear(); continue
+                self._process(job)
+            except Exception as e:
+                logger.error(f"خطأ عامل الرفع: {e}"); time_module.sleep(UPLOAD_RETRY_BASE)
+
+    def _process(self, job):
+        job_id, memo_number, memo_title, row_idx, extra_cells, path, attempts, final_size, notify = job
+        try:
+            if final_size is None:   # الضغط مرة واحدة فقط، لا عند كل إعادة محاولة
+                original, final_size = compress_pdf_file(path)
+                with self._lock, _upload_jobs_db() as conn:
+                    conn.execute("UPDATE upload_jobs SET original_size=?, final_size=? WHERE id=?", (original, final_size, job_id))
+                if final_size < original:
+                    logger.info(f"🗜️ المذكرة {memo_number}: {original/1048576:.1f} → {final_size/1048576:.1f} MB (-{100*(original-final_size)/original:.0f}%)")
+            # الرفع يقرأ الملف على أجزاء من مجلد الانتظار مباشرة
+            ok, link, msg = upload_memo_to_drive(path, memo_number, memo_title)
+            if not ok: raise RuntimeError(msg)
+            write_cells(MEMOS_SHEET_ID, deposit_cells(row_idx, link) + json.loads(extra_cells), author="")
+        except Exception as e:
+            attempts += 1
+            status = "failed" if attempts >= UPLOAD_MAX_ATTEMPTS else "pending"
+            now = time_module.time()
+            with self._lock, _upload_jobs_db() as conn:
+                conn.execute("UPDATE upload_jobs SET status=?, attempts=?, next_attempt_at=?, last_error=?, updated_at=? WHERE id=?",
+                             (status, attempts, now + UPLOAD_RETRY_BASE * (2 ** attempts), str(e)[:300], now, job_id))
+            logger.error(f"فشل رفع إيداع المذكرة {memo_number} (محاولة {attempts}): {e}")
+            return
+        with self._lock, _upload_jobs_db() as conn:
+            conn.execute("UPDATE upload_jobs SET status='committed', link=?, last_error=NULL, updated_at=? WHERE id=?", (link, time_module.time(), job_id))
+        try: os.remove(path)
+        except OSError: pass
+        logger.info(f"✅ تم رفع إيداع المذكرة {memo_number}")
+        if notify:
+            self._notify(memo_number, json.loads(notify))
+
+    def _notify(self, memo_number, notify):
+        """إشعار الإيداع بعد اكتماله — فشله لا يُعيد الرفع"""
+        senders = {"deposit": send_deposit_email_to_professor, "recovery": send_recovery_email_to_admin}
+        try:
+            ok, msg = senders[notify["kind"]](*notify["args"])
+        except Exception as e:
+            ok, msg = False, str(e)
+        if not ok:
+            logger.error(f"فشل إشعار إيداع المذكرة {memo_number}: {msg}")
+
+@st.cache_resource
+def get_upload_queue():
+    queue = DepositUploadQueue()
+    # مهام بقيت من تشغيل سابق تُستأنف فوراً
+    queue._ensure_workers()
+    return queue
+
+def submit_memo_deposit(pdf_bytes, memo_number, memo_title, extra_columns=None, notify=None):
+    """تسجيل الإيداع في طابور الرفع — الرد فوري والرفع يتم في الخلفية.
+    extra_columns: {عمود: قيمة} تُكتب في سطر المذكرة مع الإيداع بعد اكتمال الرفع
+    notify: إشعار البريد الذي يُرسل بعد اكتمال الرفع (انظر DepositUploadQueue)"""
+    try:
+        row_idx = get_repository().memo_row(memo_number)
+        if row_idx is None: return False, "❌ غير موجودة"
+        ok, pages = inspect_pdf(pdf_bytes)
+        if not ok: return False, pages
+        extra_cells = [{"range": f"Feuille 1!{col}{row_idx}", "values": [[val]]} for col, val in (extra_columns or {}).items()]
+        get_upload_queue().submit(pdf_bytes, memo_number, memo_title, row_idx, extra_cells, pages=pages, notify=notify)
+        return True, "✅ تم استلام الملف"
+    except Exception as e: return False, f"❌ {str(e)}"
+
+def render_deposit_job_status(job):
+    """بطاقة حالة رفع الإيداع (في الانتظار / جاري الرفع / فشل)"""
+    since = datetime.fromtimestamp(job["created_at"]).strftime('%Y-%m-%d %H:%M')
+    if job["status"] == "failed":
+        st.error(f"❌ تعذّر رفع ملف مذكرتك بعد عدة محاولات ({since}). الملف محفوظ لدينا — أعد المحاولة أو ارفع ملفاً جديداً.")
+        if st.button("🔁 إعادة محاولة الرفع", type="primary", use_container_width=True, key=f"retry_upload_{job['id']}"):
+            get_upload_queue().retry(job["id"]); st.rerun()
+    else:
+        state = "جاري رفعه الآن" if job["status"] == "uploading" else "في انتظار الرفع"
+        retry_note = f" — إعادة المحاولة ({job['attempts']})" if job["attempts"] else ""
+        st.info(f"⏳ تم استلام ملف مذكرتك ({since}) وهو {state}{retry_note}. ستتحدث حالة الإيداع تلقائياً فور اكتمال الرفع.")
+        if st.button("🔄 تحديث الحالة", use_container_width=True, key=f"refresh_upload_{job['id']}"): st.rerun()
+
 def save_approval_declaration(memo_number, prof_name, signature, declaration_text):
     try:
-        df_memos = load_memos()
-        row = df_memos[df_memos["رقم المذكرة"].astype(str).apply(normalize_text)==normalize_text(memo_number)]
-        if row.empty: return False, "❌ غير موجودة"
-        row_idx = row.index[0]+2
-        sheets_service.spreadsheets().values().update(spreadsheetId=MEMOS_SHEET_ID, range=f"Feuille 1!Z{row_idx}", valueInputOption="USER_ENTERED", body={"values":[[declaration_text]]}).execute()
+        row_idx = get_repository().memo_row(memo_number)
+        if row_idx is None: return False, "❌ غير موجودة"
+        write_cells(MEMOS_SHEET_ID, [{"range":f"Feuille 1!Z{row_idx}","values":[[declaration_text]]}])
         return True, "✅ تم حفظ التصريح"
     except Exception as e: return False, f"❌ {str(e)}"
 
 def approve_memo_for_defense(memo_number):
     try:
-        df_memos = load_memos()
-        row = df_memos[df_memos["رقم المذكرة"].astype(str).apply(normalize_text)==normalize_text(memo_number)]
-        if row.empty: return False, "❌ غير موجودة"
-        row_idx = row.index[0]+2
-        sheets_service.spreadsheets().values().update(spreadsheetId=MEMOS_SHEET_ID, range=f"Feuille 1!T{row_idx}", valueInputOption="USER_ENTERED", body={"values":[["قابلة للمناقشة"]]}).execute()
-        clear_cache_and_reload(); return True, "✅ تمت الموافقة"
+        row_idx = get_repository().memo_row(memo_number)
+        if row_idx is None: return False, "❌ غير موجودة"
+        write_cells(MEMOS_SHEET_ID, [{"range":f"Feuille 1!T{row_idx}","values":[["قابلة للمناقشة"]]}])
+        return True, "✅ تمت الموافقة"
     except Exception as e: return False, f"❌ {str(e)}"
 
 def reject_memo_and_reopen(memo_number, prof_name, rejection_reason):
     try:
-        df_memos = load_memos()
-        row = df_memos[df_memos["رقم المذكرة"].astype(str).apply(normalize_text)==normalize_text(memo_number)]
-        if row.empty: return False, "❌ غير موجودة"
-        row_idx = row.index[0]+2
+        row_idx = get_repository().memo_row(memo_number)
+        if row_idx is None: return False, "❌ غير موجودة"
         timestamp = datetime.now().strftime('%Y-%m-%d %H:%M')
         rejection_full = f"مرفوضة بتاريخ {timestamp} | المشرف: {prof_name} | السبب: {rejection_reason}"
-        sheets_service.spreadsheets().values().batchUpdate(spreadsheetId=MEMOS_SHEET_ID, body={"valueInputOption":"USER_ENTERED","data":[{"range":f"Feuille 1!T{row_idx}","values":[["مرفوضة"]]},{"range":f"Feuille 1!U{row_idx}","values":[[""]]},{"range":f"Feuille 1!V{row_idx}","values":[[""]]},{"range":f"Feuille 1!Z{row_idx}","values":[[rejection_full]]}]}).execute()
-        clear_cache_and_reload(); return True, "✅ تم تسجيل الإعادة وفتح الإيداع"
+        write_cells(MEMOS_SHEET_ID, [{"range":f"Feuille 1!T{row_idx}","values":[["مرفوضة"]]},{"range":f"Feuille 1!U{row_idx}","values":[[""]]},{"range":f"Feuille 1!V{row_idx}","values":[[""]]},{"range":f"Feuille 1!Z{row_idx}","values":[[rejection_full]]}])
+        return True, "✅ تم تسجيل الإعادة وفتح الإيداع"
     except Exception as e: return False, f"❌ {str(e)}"
 
 def save_prof_notes(memo_number, prof_name, notes_text):
     try:
-        df_memos = load_memos()
-        row = df_memos[df_memos["رقم المذكرة"].astype(str).apply(normalize_text)==normalize_text(memo_number)]
-        if row.empty: return False, "❌ غير موجودة"
-        row_idx = row.index[0]+2
+        row_idx = get_repository().memo_row(memo_number)
+        if row_idx is None: return False, "❌ غير موجودة"
         timestamp = datetime.now().strftime('%Y-%m-%d %H:%M')
         note_full = f"ملاحظات المشرف {prof_name} [{timestamp}]: {notes_text}"
-        sheets_service.spreadsheets().values().update(spreadsheetId=MEMOS_SHEET_ID, range=f"Feuille 1!Z{row_idx}", valueInputOption="USER_ENTERED", body={"values":[[note_full]]}).execute()
-        clear_cache_and_reload(); return True, "✅ تم حفظ الملاحظات"
+        write_cells(MEMOS_SHEET_ID, [{"range":f"Feuille 1!Z{row_idx}","values":[[note_full]]}])
+        return True, "✅ تم حفظ الملاحظات"
     except Exception as e: return False, f"❌ {str(e)}"
 
 def save_defense_schedule(memo_number, defense_date, defense_time, defense_room):
     try:
-        df_memos = load_memos()
-        row = df_memos[df_memos["رقم المذكرة"].astype(str).apply(normalize_text)==normalize_text(memo_number)]
-        if row.empty: return False, "❌ غير موجودة"
-        row_idx = row.index[0]+2
-        sheets_service.spreadsheets().values().batchUpdate(spreadsheetId=MEMOS_SHEET_ID, body={"valueInputOption":"USER_ENTERED","data":[{"range":f"Feuille 1!W{row_idx}","values":[[str(defense_date)]]},{"range":f"Feuille 1!X{row_idx}","values":[[str(defense_time)]]},{"range":f"Feuille 1!Y{row_idx}","values":[[defense_room]]}]}).execute()
-        clear_cache_and_reload(); return True, "✅ تم حفظ الموعد"
+        row_idx = get_repository().memo_row(memo_number)
+        if row_idx is None: return False, "❌ غير موجودة"
+        write_cells(MEMOS_SHEET_ID, [{"range":f"Feuille 1!W{row_idx}","values":[[str(defense_date)]]},{"range":f"Feuille 1!X{row_idx}","values":[[str(defense_time)]]},{"range":f"Feuille 1!Y{row_idx}","values":[[defense_room]]}])
+        return True, "✅ تم حفظ الموعد"
     except Exception as e: return False, f"❌ {str(e)}"
 
 def save_jury(memo_number, president, exam1, exam2):
     try:
-        df_memos = load_memos()
-        row = df_memos[df_memos["رقم المذكرة"].astype(str).apply(normalize_text)==normalize_text(memo_number)]
-        if row.empty: return False, "❌ غير موجودة"
-        row_idx = row.index[0]+2
-        sheets_service.spreadsheets().values().batchUpdate(spreadsheetId=MEMOS_SHEET_ID, body={"valueInputOption":"USER_ENTERED","data":[{"range":f"Feuille 1!AA{row_idx}","values":[[president]]},{"range":f"Feuille 1!AB{row_idx}","values":[[exam1]]},{"range":f"Feuille 1!AC{row_idx}","values":[[exam2]]}]}).execute()
-        clear_cache_and_reload(); return True, "✅ تم حفظ اللجنة"
+        row_idx = get_repository().memo_row(memo_number)
+        if row_idx is None: return False, "❌ غير موجودة"
+        write_cells(MEMOS_SHEET_ID, [{"range":f"Feuille 1!AA{row_idx}","values":[[president]]},{"range":f"Feuille 1!AB{row_idx}","values":[[exam1]]},{"range":f"Feuille 1!AC{row_idx}","values":[[exam2]]}])
+        return True, "✅ تم حفظ اللجنة"
     except Exception as e: return False, f"❌ {str(e)}"
 
 def save_notes_by_member(memo_number, member_role, notes_text):
@@ -846,55 +2339,48 @@ def save_notes_by_member(memo_number, member_role, notes_text):
     col = col_map.get(member_role)
     if not col: return False, "دور غير معروف"
     try:
-        df_memos = load_memos()
-        row = df_memos[df_memos["رقم المذكرة"].astype(str).apply(normalize_text)==normalize_text(memo_number)]
-        if row.empty: return False, "❌ غير موجودة"
-        row_idx = row.index[0]+2
-        sheets_service.spreadsheets().values().update(spreadsheetId=MEMOS_SHEET_ID, range=f"Feuille 1!{col}{row_idx}", valueInputOption="USER_ENTERED", body={"values":[[notes_text]]}).execute()
-        clear_cache_and_reload(); return True, "✅ تم حفظ الملاحظات"
+        row_idx = get_repository().memo_row(memo_number)
+        if row_idx is None: return False, "❌ غير موجودة"
+        write_cells(MEMOS_SHEET_ID, [{"range":f"Feuille 1!{col}{row_idx}","values":[[notes_text]]}])
+        return True, "✅ تم حفظ الملاحظات"
     except Exception as e: return False, f"❌ {str(e)}"
 
 def publish_memos(memo_numbers=None):
     try:
-        df_memos = load_memos()
+        repo = get_repository(); df_memos = repo.memos
         if memo_numbers:
-            targets = df_memos[df_memos["رقم المذكرة"].astype(str).apply(normalize_text).isin([normalize_text(m) for m in memo_numbers])]
+            target_rows = sorted({r for r in (repo.memo_row(m) for m in memo_numbers) if r is not None})
         else:
             col = "حالة الإيداع"
-            targets = df_memos[df_memos[col].astype(str).str.strip()=="قابلة للمناقشة"] if col in df_memos.columns else pd.DataFrame()
-        if targets.empty: return False, "لا توجد مذكرات"
-        updates = [{"range":f"Feuille 1!AD{idx+2}","values":[["نعم"]]} for idx in targets.index]
-        sheets_service.spreadsheets().values().batchUpdate(spreadsheetId=MEMOS_SHEET_ID, body={"valueInputOption":"USER_ENTERED","data":updates}).execute()
-        clear_cache_and_reload(); return True, f"✅ تم نشر {len(updates)} مذكرة"
+            target_rows = [idx+2 for idx in df_memos[df_memos[col].astype(str).str.strip()=="قابلة للمناقشة"].index] if col in df_memos.columns else []
+        if not target_rows: return False, "لا توجد مذكرات"
+        updates = [{"range":f"Feuille 1!AD{r}","values":[["نعم"]]} for r in target_rows]
+        write_cells(MEMOS_SHEET_ID, updates)
+        return True, f"✅ تم نشر {len(updates)} مذكرة"
     except Exception as e: return False, f"❌ {str(e)}"
 
 def update_progress(memo_number, progress_value):
     try:
-        df_memos = load_memos()
-        row = df_memos[df_memos["رقم المذكرة"].astype(str).apply(normalize_text)==normalize_text(memo_number)]
-        if row.empty: return False, "❌ غير موجودة"
-        row_idx = row.index[0]+2
-        sheets_service.spreadsheets().values().update(spreadsheetId=MEMOS_SHEET_ID, range=f"Feuille 1!Q{row_idx}", valueInputOption="USER_ENTERED", body={"values":[[str(progress_value)]]}).execute()
-        clear_cache_and_reload(); return True, "✅ تم تحديث نسبة التقدم"
+        row_idx = get_repository().memo_row(memo_number)
+        if row_idx is None: return False, "❌ غير موجودة"
+        write_cells(MEMOS_SHEET_ID, [{"range":f"Feuille 1!Q{row_idx}","values":[[str(progress_value)]]}])
+        return True, "✅ تم تحديث نسبة التقدم"
     except Exception as e: return False, f"❌ {str(e)}"
 
 def save_and_send_request(req_type, prof_name, memo_id, memo_title, details_text, status="قيد المراجعة"):
     try:
         timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         new_row = ["", timestamp, req_type, status, prof_name, memo_id, "", "", details_text, "", ""]
-        sheets_service.spreadsheets().values().append(spreadsheetId=REQUESTS_SHEET_ID, range="Feuille 1!A2", valueInputOption="USER_ENTERED", body={"values":[new_row]}, insertDataOption="INSERT_ROWS").execute()
+        api_execute(sheets_service.spreadsheets().values().append(spreadsheetId=REQUESTS_SHEET_ID, range="Feuille 1!A2", valueInputOption="USER_ENTERED", body={"values":[new_row]}, insertDataOption="INSERT_ROWS"), idempotent=False)
         return True, "✅ تم تسجيل الطلب"
     except Exception as e: return False, f"❌ {str(e)}"
 
 def update_student_profile(username, phone, nin):
     try:
-        df_students = load_students()
-        df_students['username_norm'] = df_students["اسم المستخدم"].astype(str).apply(normalize_text)
-        student_row = df_students[df_students["username_norm"]==normalize_text(username)]
-        if student_row.empty: return False, "❌ لم يتم العثور على الطالب"
-        row_idx = student_row.index[0]+2
-        sheets_service.spreadsheets().values().batchUpdate(spreadsheetId=STUDENTS_SHEET_ID, body={"valueInputOption":"USER_ENTERED","data":[{"range":f"Feuille 1!M{row_idx}","values":[[phone]]},{"range":f"Feuille 1!U{row_idx}","values":[[nin]]}]}).execute()
-        clear_cache_and_reload(); return True, "✅ تم التحديث"
+        row_idx = get_repository().student_row(username)
+        if row_idx is None: return False, "❌ لم يتم العثور على الطالب"
+        write_cells(STUDENTS_SHEET_ID, [{"range":f"Feuille 1!M{row_idx}","values":[[phone]]},{"range":f"Feuille 1!U{row_idx}","values":[[nin]]}])
+        return True, "✅ تم التحديث"
     except Exception as e: return False, f"❌ {str(e)}"
 
 def update_session_date_in_sheets(prof_name, date_str):
@@ -908,7 +2394,7 @@ def update_session_date_in_sheets(prof_name, date_str):
         col_idx = col_names.index(target_col)+1 if target_col in col_names else len(col_names)
         col_l = col_letter(col_idx)
         updates = [{"range":f"Feuille 1!{col_l}{idx+2}","values":[[date_str]]} for idx in target_indices]
-        sheets_service.spreadsheets().values().batchUpdate(spreadsheetId=MEMOS_SHEET_ID, body={"valueInputOption":"USER_ENTERED","data":updates}).execute()
+        write_cells(MEMOS_SHEET_ID, updates)
         return True, "تم التحديث"
     except Exception as e: return False, str(e)
 
@@ -934,22 +2420,19 @@ def sync_student_registration_numbers():
             if reg_s1: updates.append({"range":f"Feuille 1!S{row_idx}","values":[[reg_s1]]})
             if reg_s2: updates.append({"range":f"Feuille 1!T{row_idx}","values":[[reg_s2]]})
         if updates:
-            sheets_service.spreadsheets().values().batchUpdate(spreadsheetId=MEMOS_SHEET_ID, body={"valueInputOption":"USER_ENTERED","data":updates}).execute()
+            write_cells(MEMOS_SHEET_ID, updates)
             return True, f"✅ تم تحديث {len(updates)} خلية"
         return False, "ℹ️ لا توجد تغييرات"
     except Exception as e: return False, f"❌ {str(e)}"
 
 def update_diploma_status(username, status_dict):
     try:
-        df_students = load_students()
-        df_students['username_norm'] = df_students["اسم المستخدم"].astype(str).apply(normalize_text)
-        row = df_students[df_students["username_norm"]==normalize_text(username)]
-        if row.empty: return False, "❌ لم يتم العثور على الطالب"
-        row_idx = row.index[0]+2
+        row_idx = get_repository().student_row(username)
+        if row_idx is None: return False, "❌ لم يتم العثور على الطالب"
         updates = [{"range":f"Feuille 1!{k}{row_idx}","values":[[v]]} for k,v in status_dict.items()]
         if updates:
-            sheets_service.spreadsheets().values().batchUpdate(spreadsheetId=STUDENTS_SHEET_ID, body={"valueInputOption":"USER_ENTERED","data":updates}).execute()
-            clear_cache_and_reload(); return True, "✅ تم التحديث"
+            write_cells(STUDENTS_SHEET_ID, updates)
+            return True, "✅ تم التحديث"
         return False, "لا شيء"
     except Exception as e: return False, f"❌ {str(e)}"
 
@@ -1008,12 +2491,14 @@ def verify_professor_password(note_number, prof_password, df_memos, df_prof_memo
 
 def update_registration(note_number, student1, student2=None, s2_new_phone=None, s2_new_nin=None):
     try:
-        df_memos = load_memos(); df_prof_memos = load_prof_memos(); df_students = load_students()
-        memo_data = df_memos[df_memos["رقم المذكرة"].astype(str).apply(normalize_text)==str(note_number).strip()]
-        if memo_data.empty: return False, "❌ رقم المذكرة غير موجود"
-        prof_name = memo_data["الأستاذ"].iloc[0].strip()
+        repo = get_repository(); buf = SheetWriteBuffer()
+        df_memos = repo.memos; df_prof_memos = repo.prof_memos; df_students = repo.students
+        memo_d = repo.memo(note_number)
+        if memo_d is None: return False, "❌ رقم المذكرة غير موجود"
+        prof_name = str(memo_d["الأستاذ"]).strip()
         used_pw = st.session_state.prof_password.strip()
-        potential = df_prof_memos[(df_prof_memos["الأستاذ"].astype(str).str.strip()==prof_name) & (df_prof_memos["كلمة سر التسجيل"].astype(str).str.strip()==used_pw)]
+        prof_candidates = df_prof_memos.iloc[[r-2 for r in repo.prof_rows(prof_name)]]
+        potential = prof_candidates[prof_candidates["كلمة سر التسجيل"].astype(str).str.strip()==used_pw]
         if potential.empty: return False, "❌ بيانات الأستاذ غير متطابقة"
         target = potential[potential["رقم المذكرة"].astype(str).apply(normalize_text)==str(note_number).strip()]
         if target.empty:
@@ -1031,8 +2516,8 @@ def update_registration(note_number, student1, student2=None, s2_new_phone=None,
         if student2:
             s2_ln, s2_fn = get_student_name_display(student2)
             updates_prof.append({"range":f"Feuille 1!{col_letter(col_names.index('الطالب الثاني')+1)}{prof_row_idx}","values":[[f"{s2_ln} {s2_fn}"]]})
-        sheets_service.spreadsheets().values().batchUpdate(spreadsheetId=PROF_MEMOS_SHEET_ID, body={"valueInputOption":"USER_ENTERED","data":updates_prof}).execute()
-        memo_row_idx = df_memos[df_memos["رقم المذكرة"].astype(str).apply(normalize_text)==str(note_number).strip()].index[0]+2
+        buf.extend(PROF_MEMOS_SHEET_ID, updates_prof)
+        memo_row_idx = repo.memo_row(note_number)
         memo_cols = df_memos.columns.tolist()
         reg1 = normalize_text(student1.get('رقم التسجيل',''))
         updates_memo = [
@@ -1047,26 +2532,25 @@ def update_registration(note_number, student1, student2=None, s2_new_phone=None,
             s2_ln2, s2_fn2 = get_student_name_display(student2); reg2 = normalize_text(student2.get('رقم التسجيل',''))
             updates_memo.append({"range":f"Feuille 1!{col_letter(memo_cols.index('الطالب الثاني')+1)}{memo_row_idx}","values":[[f"{s2_ln2} {s2_fn2}"]]})
             updates_memo.append({"range":f"Feuille 1!T{memo_row_idx}","values":[[reg2]]})
-        sheets_service.spreadsheets().values().batchUpdate(spreadsheetId=MEMOS_SHEET_ID, body={"valueInputOption":"USER_ENTERED","data":updates_memo}).execute()
+        buf.extend(MEMOS_SHEET_ID, updates_memo)
         students_cols = df_students.columns.tolist()
         s1_user = normalize_text(student1.get('اسم المستخدم',''))
-        s1_row_idx = df_students[df_students["اسم المستخدم"].astype(str).apply(normalize_text)==s1_user].index[0]+2
-        sheets_service.spreadsheets().values().update(spreadsheetId=STUDENTS_SHEET_ID, range=f"Feuille 1!{col_letter(students_cols.index('رقم المذكرة')+1)}{s1_row_idx}", valueInputOption="USER_ENTERED", body={"values":[[note_number]]}).execute()
+        s1_row_idx = repo.student_row(s1_user)
+        buf.add(STUDENTS_SHEET_ID, f"Feuille 1!{col_letter(students_cols.index('رقم المذكرة')+1)}{s1_row_idx}", note_number)
         if student2:
             s2_user = normalize_text(student2.get('اسم المستخدم',''))
-            s2_row_idx = df_students[df_students["اسم المستخدم"].astype(str).apply(normalize_text)==s2_user].index[0]+2
-            sheets_service.spreadsheets().values().update(spreadsheetId=STUDENTS_SHEET_ID, range=f"Feuille 1!{col_letter(students_cols.index('رقم المذكرة')+1)}{s2_row_idx}", valueInputOption="USER_ENTERED", body={"values":[[note_number]]}).execute()
-            s2_upd = []
-            if s2_new_phone: s2_upd.append({"range":f"Feuille 1!M{s2_row_idx}","values":[[s2_new_phone]]})
-            if s2_new_nin: s2_upd.append({"range":f"Feuille 1!U{s2_row_idx}","values":[[s2_new_nin]]})
-            if s2_upd: sheets_service.spreadsheets().values().batchUpdate(spreadsheetId=STUDENTS_SHEET_ID, body={"valueInputOption":"USER_ENTERED","data":s2_upd}).execute()
-        time_module.sleep(2); clear_cache_and_reload(); time_module.sleep(1)
-        df_students_updated = load_students()
-        st.session_state.student1 = df_students_updated[df_students_updated["اسم المستخدم"].astype(str).apply(normalize_text)==s1_user].iloc[0].to_dict()
+            s2_row_idx = repo.student_row(s2_user)
+            buf.add(STUDENTS_SHEET_ID, f"Feuille 1!{col_letter(students_cols.index('رقم المذكرة')+1)}{s2_row_idx}", note_number)
+            if s2_new_phone: buf.add(STUDENTS_SHEET_ID, f"Feuille 1!M{s2_row_idx}", s2_new_phone)
+            if s2_new_nin: buf.add(STUDENTS_SHEET_ID, f"Feuille 1!U{s2_row_idx}", s2_new_nin)
+        # كل التحديثات جاهزة → طلب واحد لكل شيت (3 بدل 6) ولا كتابة جزئية عند خطأ في التحضير
+        _, report = buf.flush()
+        SheetWriteBuffer.raise_on_failure(report)
+        repo_updated = get_repository()
+        st.session_state.student1 = repo_updated.student(s1_user).to_dict()
         if student2:
             s2_user2 = normalize_text(student2.get('اسم المستخدم',''))
-            st.session_state.student2 = df_students_updated[df_students_updated["اسم المستخدم"].astype(str).apply(normalize_text)==s2_user2].iloc[0].to_dict()
-        memo_d = df_memos[df_memos["رقم المذكرة"].astype(str).apply(normalize_text)==str(note_number).strip()].iloc[0]
+            st.session_state.student2 = repo_updated.student(s2_user2).to_dict()
         send_email_to_professor(prof_name, memo_d, st.session_state.student1, st.session_state.get('student2'))
         return True, "✅ تم تسجيل المذكرة بنجاح!"
     except Exception as e:
@@ -1181,10 +2665,6 @@ def professor_first_schedule(df_memos, days, slots_per_day, rooms, max_per_day=3
     day_time_limits = day_time_limits or {}
     profs_accept_18 = profs_accept_18 or set()
     profs_cluster_days = profs_cluster_days or set()
-    profs_cluster_days = profs_cluster_days or set()
-    LATE_SLOT = "18:00"
-    profs_accept_18 = profs_accept_18 or set()
-    slot_to_idx = {s: i for i, s in enumerate(slots_per_day)}
     """
     الخوارزمية الرئيسية — تبدأ بالأستاذ وليس بالمذكرة
     
@@ -1200,94 +2680,20 @@ def professor_first_schedule(df_memos, days, slots_per_day, rooms, max_per_day=3
     prof_memos_map, memo_members = build_prof_memo_map(df_memos)
     memo_ids = df_memos["رقم المذكرة"].astype(str).tolist()
     
-    # الجدول النهائي: memo_id -> (day, slot, room)
-    schedule = {}
-    
-    # خريطة الخانات المشغولة: (day, slot, room) -> memo_id
-    occupied = {}
-    
-    # خريطة الأستاذ في التوقيت: (day, slot, prof) -> memo_id
-    prof_busy = {}
-    # عدد مناقشات الأستاذ في اليوم: (prof, day) -> count
-    prof_day_count = {}
-    # تتبع أسباب رفض المذكرات
-    rejection_log = {}
     # تتبع أسباب رفض المذكرات: memo_id -> [reasons]
     rejection_log = {}
-    
-    def can_place(memo_id, day, slot, room, log=False):
-        """هل يمكن وضع المذكرة في هذه الخانة؟"""
-        def _reject(reason):
-            if log: rejection_log.setdefault(memo_id, set()).add(reason)
-            return False
 
-        if (day, slot, room) in occupied:
-            return _reject(f"القاعة {room} مشغولة {day} {slot}")
-
-        # لا بعد 16:00 للجميع — إلا من يقبل 18:00
-        if slot > "16:00":
-            _members_late = memo_members.get(memo_id, set())
-            _non_acc = _members_late - profs_accept_18
-            if _non_acc: return _reject(f"توقيت {slot} بعد 16:00 — غير مقبول من: {', '.join(_non_acc)}")
-        if slot == LATE_SLOT:
-            members_check = memo_members.get(memo_id, set())
-            non_acc = members_check - profs_accept_18
-            if non_acc: return _reject(f"18:00 غير مقبول من: {', '.join(non_acc)}")
-
-        if day in day_time_limits:
-            from_t, to_t = day_time_limits[day]
-            if from_t and slot_to_idx.get(slot,0) < slot_to_idx.get(from_t,0):
-                return _reject(f"{day}: {slot} قبل الحد {from_t}")
-            if to_t and slot_to_idx.get(slot,99) > slot_to_idx.get(to_t,99):
-                return _reject(f"{day}: {slot} بعد الحد {to_t}")
-
-        if memo_id in memo_date_limits:
-            earliest, latest = memo_date_limits[memo_id]
-            if earliest and day < earliest: return _reject(f"لا قبل {earliest}")
-            if latest and day > latest: return _reject(f"لا بعد {latest}")
-
-        if memo_id in memo_alt_days and memo_alt_days[memo_id]:
-            if day not in memo_alt_days[memo_id]:
-                return _reject(f"{day} ليس من الأيام البديلة")
-
-        members = memo_members.get(memo_id, set())
-        for prof in members:
-            if (day, slot, prof) in prof_busy:
-                return _reject(f"{prof} مشغول {day} {slot}")
-            if prof_day_count.get((prof, day), 0) >= 3:
-                return _reject(f"{prof} بلغ الحد الأقصى 3 في {day}")
-            if day in prof_banned_days.get(prof, set()):
-                return _reject(f"{day} ممنوع على {prof}")
-            if prof in prof_allowed_days and prof_allowed_days[prof]:
-                if day not in prof_allowed_days[prof]:
-                    return _reject(f"{day} غير مسموح لـ{prof} (مسموح: {','.join(sorted(prof_allowed_days[prof]))})")
-            if slot == "18:00" and prof not in profs_accept_18:
-                return _reject(f"{prof} لا يقبل 18:00")
-            if prof in prof_not_before:
-                if slot_to_idx.get(slot,0) < slot_to_idx.get(prof_not_before[prof],0):
-                    return _reject(f"{prof} لا يحضر قبل {prof_not_before[prof]}")
-            if prof in prof_not_after:
-                if slot_to_idx.get(slot,99) > slot_to_idx.get(prof_not_after[prof],99):
-                    return _reject(f"{prof} لا يحضر بعد {prof_not_after[prof]}")
-            if prof in prof_phase_split:
-                n_first, start_second = prof_phase_split[prof]
-                cur = prof_first_phase_count.get(prof, 0)
-                if cur < n_first:
-                    if day >= start_second: return _reject(f"{prof} في الفترة الأولى — {day} في الثانية")
-                else:
-                    if day < start_second: return _reject(f"{prof} في الفترة الثانية — {day} في الأولى")
-        return True
-    
-    def place_memo(memo_id, day, slot, room):
-        """وضع المذكرة في الخانة"""
-        schedule[memo_id] = (day, slot, room)
-        occupied[(day, slot, room)] = memo_id
-        members = memo_members.get(memo_id, set())
-        for prof in members:
-            prof_busy[(day, slot, prof)] = memo_id
-            prof_day_count[(prof, day)] = prof_day_count.get((prof, day), 0) + 1
-            if prof in prof_phase_split:
-                prof_first_phase_count[prof] = prof_first_phase_count.get(prof, 0) + 1
+    model = ConstraintModel(
+        memo_members, days, slots_per_day, rooms,
+        memo_date_limits=memo_date_limits, prof_banned_days=prof_banned_days,
+        prof_not_before=prof_not_before, prof_not_after=prof_not_after,
+        prof_allowed_days=prof_allowed_days, profs_accept_18=profs_accept_18,
+        memo_alt_days=memo_alt_days, prof_phase_split=prof_phase_split,
+        day_time_limits=day_time_limits)
+    state = model.new_state()
+    # الجدول النهائي: memo_id -> (day, slot, room)
+    schedule = state.schedule
+    can_place, place_memo = state.can_place, state.place
     
     # رتّب الأساتذة من الأكثر مذكرات إلى الأقل
     sorted_profs = sorted(prof_memos_map.items(), key=lambda x: len(x[1]), reverse=True)
@@ -1295,9 +2701,6 @@ def professor_first_schedule(df_memos, days, slots_per_day, rooms, max_per_day=3
     # تتبع المذكرات المجدولة
     scheduled_memos = set()
 
-    # بناء خريطة التقسيم الزمني للأساتذة
-    prof_first_phase_count = {prof: 0 for prof in prof_phase_split}
-
     # المرحلة 0: تطبيق المواعيد المثبتة أولاً (قيود صارمة)
     for _fmid, (_fday, _fslot, _froom) in fixed_slots.items():
         if _fday in days and _fslot in slots_per_day:
@@ -1417,56 +2820,98 @@ def calc_schedule_quality(schedule, memo_members, days, slots_per_day):
     
     return min(100, quality), placed, unplaced, total_idle, total_days, max_gap
 
+class ProfessorProgram:
+    """برنامج كل أستاذ (يوم → توقيتات ومذكرات) مع مجموع الفراغات وعدد الأيام محدَّثَين تزايدياً"""
+    DAY_WEIGHT = 10
+
+    def __init__(self, memo_members, slots_per_day):
+        self.memo_members = memo_members
+        self.slot_id = {s: i for i, s in enumerate(slots_per_day)}
+        self.slots = {}   # prof -> day -> [slot_idx]
+        self.memos = {}   # prof -> day -> [memo_id]
+        self.lonely = set()  # (prof, day) فيها مذكرة واحدة
+        self.idle = 0
+        self.n_days = 0
+
+    @staticmethod
+    def _idle(slots):
+        """مجموع الفراغات بين توقيتات يوم واحد"""
+        return max(slots) - min(slots) - len(slots) + 1 if slots else 0
+
+    def _mark(self, prof, day):
+        if len(self.memos[prof].get(day, ())) == 1: self.lonely.add((prof, day))
+        else: self.lonely.discard((prof, day))
+
+    def add(self, mid, sv):
+        day, si = sv[0], self.slot_id.get(sv[1], 0)
+        for prof in self.memo_members.get(mid, set()):
+            lst = self.slots.setdefault(prof, {}).setdefault(day, [])
+            before = self._idle(lst)
+            if not lst: self.n_days += 1
+            lst.append(si)
+            self.idle += self._idle(lst) - before
+            self.memos.setdefault(prof, {}).setdefault(day, []).append(mid)
+            self._mark(prof, day)
+
+    def drop(self, mid, sv):
+        day, si = sv[0], self.slot_id.get(sv[1], 0)
+        for prof in self.memo_members.get(mid, set()):
+            lst = self.slots[prof][day]
+            before = self._idle(lst)
+            lst.remove(si)
+            self.idle += self._idle(lst) - before
+            self.memos[prof][day].remove(mid)
+            if not lst:
+                self.n_days -= 1
+                del self.slots[prof][day], self.memos[prof][day]
+            self._mark(prof, day)
+
+    def load(self, schedule):
+        for mid, sv in schedule.items():
+            if sv: self.add(mid, sv)
+        return self
+
+    def score(self):
+        """نفس مقياس calc_schedule_quality: الفراغات + 10 × أيام الحضور"""
+        return self.idle + self.n_days * self.DAY_WEIGHT
+
+    def move_delta(self, mid, old_sv, new_sv):
+        """تغيّر النقاط لو نُقلت المذكرة — بحجم لجنتها فقط ودون تعديل الحالة"""
+        si_old, si_new = self.slot_id.get(old_sv[1], 0), self.slot_id.get(new_sv[1], 0)
+        delta = 0
+        for prof in self.memo_members.get(mid, set()):
+            pdays = self.slots.get(prof, {})
+            old_list = pdays.get(old_sv[0], [])
+            rest = list(old_list)
+            rest.remove(si_old)
+            if old_sv[0] == new_sv[0]:
+                delta += self._idle(rest + [si_new]) - self._idle(old_list)
+                continue
+            target = pdays.get(new_sv[0], [])
+            delta += (self._idle(rest) - self._idle(old_list)
+                      + self._idle(target + [si_new]) - self._idle(target))
+            delta += self.DAY_WEIGHT * ((not target) - (not rest))
+        return delta
+
+    def move(self, mid, old_sv, new_sv):
+        self.drop(mid, old_sv)
+        self.add(mid, new_sv)
+
+
 def improve_schedule(schedule, memo_members, days, slots_per_day, rooms, iterations=2000, prof_banned_days=None, prof_allowed_days=None, profs_accept_18=None, fixed_slots=None):
     """
     تحسين الجدول:
     - ابحث عن أستاذ لديه مذكرة معزولة في يوم وحدها
     - حاول نقلها ليوم فيه مذكرات أخرى له
+    كل نقلة تُقيَّم تزايدياً بحجم لجنة المذكرة بدل إعادة بناء الجدول
     """
     import random
-    
-    slot_to_idx = {s: i for i, s in enumerate(slots_per_day)}
-    
-    def get_prof_program(sched):
-        prog = {}
-        for mid, slot in sched.items():
-            if not slot: continue
-            day, time_slot, room = slot
-            for prof in memo_members.get(mid, set()):
-                prog.setdefault(prof, {}).setdefault(day, []).append(mid)
-        return prog
-    
-    def can_place(sched, memo_id, day, slot, room):
-        members_new = memo_members.get(memo_id, set())
-        # ✅ تحقق من الأيام الممنوعة أولاً
-        for p in members_new:
-            _banned = prof_banned_days.get(p, set())
-            if day in _banned:
-                return False
-            if prof_allowed_days.get(p) and day not in prof_allowed_days[p]:
-                return False
-            if slot > "16:00" and p not in profs_accept_18:
-                return False
-        day_counts = {}
-        for other_mid, other_slot in sched.items():
-            if other_mid == memo_id or not other_slot: continue
-            if other_slot == (day, slot, room): return False
-            if other_slot[0] == day and other_slot[1] == slot:
-                if members_new & memo_members.get(other_mid, set()):
-                    return False
-            if other_slot[0] == day:
-                for p in memo_members.get(other_mid, set()):
-                    day_counts[p] = day_counts.get(p, 0) + 1
-        for p in members_new:
-            if day_counts.get(p, 0) >= 3:
-                return False
-        return True
-    
+    from datetime import datetime as _dt2
+
     prof_banned_days = prof_banned_days or {}
     prof_allowed_days = prof_allowed_days or {}
     profs_accept_18 = profs_accept_18 or set()
     fixed_slots = fixed_slots or {}
-    _fixed_mids = set(str(k) for k in fixed_slots.keys())
 
     # مذكرات محمية — لا تُلمس أبداً:
     # 1. مواعيد مثبتة
@@ -1479,20 +2924,21 @@ def improve_schedule(schedule, memo_members, days, slots_per_day, rooms, iterati
                 _protected_mids.add(str(mid))
                 break
 
-    current = dict(schedule)
-    _, _, _, cur_idle, cur_days, _ = calc_schedule_quality(current, memo_members, days, slots_per_day)
-    cur_score = cur_idle + cur_days * 10
-    
+    state = ConstraintModel(
+        memo_members, days, slots_per_day, rooms,
+        prof_banned_days=prof_banned_days, prof_allowed_days=prof_allowed_days,
+        profs_accept_18=profs_accept_18).new_state().load(schedule)
+    current = state.schedule
+    program = ProfessorProgram(memo_members, slots_per_day).load(current)
+    prog = program.memos
+
+    # (أستاذ، مذكرة) جُرّبت دون تحسن منذ آخر نقلة — إعادة تجربتها لن تغير شيئاً
+    tried = set()
+
     for _ in range(iterations):
-        prog = get_prof_program(current)
-        
         # ابحث عن أستاذ له يوم فيه مذكرة واحدة فقط
-        lonely_memos = []
-        for prof, days_dict in prog.items():
-            if len(days_dict) <= 1: continue
-            for day, memos in days_dict.items():
-                if len(memos) == 1:
-                    lonely_memos.append((prof, day, memos[0]))
+        lonely_memos = [(prof, day, prog[prof][day][0])
+                        for prof, day in sorted(program.lonely) if len(prog[prof]) > 1]
         
         if not lonely_memos:
             # تحقق من أيام منعزلة متعددة — فقط إذا المجموع >= 3
@@ -1507,7 +2953,6 @@ def improve_schedule(schedule, memo_members, days, slots_per_day, rooms, iterati
 
             # تحقق من أيام متتالية > 3
             if not multi_lonely:
-                from datetime import datetime as _dt2, timedelta as _td2
                 for prof, days_dict in prog.items():
                     sorted_d = sorted(days_dict.keys())
                     consec = 1
@@ -1531,41 +2976,34 @@ def improve_schedule(schedule, memo_members, days, slots_per_day, rooms, iterati
             lonely_memos = multi_lonely
         
         random.shuffle(lonely_memos)
-        # تخطى المذكرات المحمية
-        _movable = [(p, d, m) for p, d, m in lonely_memos if str(m) not in _protected_mids]
+        # تخطى المذكرات المحمية وما جُرّب بلا فائدة
+        _movable = [(p, d, m) for p, d, m in lonely_memos
+                    if str(m) not in _protected_mids and (p, m) not in tried]
         if not _movable: break
         prof, lonely_day, lonely_memo = _movable[0]
+        tried.add((prof, lonely_memo))
         old_slot = current.get(lonely_memo)
         if not old_slot: continue
         
-        # حاول نقلها ليوم فيه مذكرات أخرى لنفس الأستاذ
-        best_day = None
+        # حاول نقلها ليوم فيه مذكرات أخرى لنفس الأستاذ — أول نقلة تُحسّن النقاط
+        state.remove(lonely_memo)
         best_slot_val = None
-        
         for target_day, target_memos in prog.get(prof, {}).items():
             if target_day == lonely_day: continue
             if len(target_memos) >= 3: continue  # اليوم ممتلئ
             
             # جرب وضعها في توقيت متتالي مع مذكرات الأستاذ في هذا اليوم
             for slot in slots_per_day:
-                for room in rooms:
-                    if can_place(current, lonely_memo, target_day, slot, room):
-                        current[lonely_memo] = (target_day, slot, room)
-                        _, _, _, new_idle, new_days, _ = calc_schedule_quality(current, memo_members, days, slots_per_day)
-                        new_score = new_idle + new_days * 10
-                        if new_score < cur_score:
-                            cur_score = new_score
-                            best_day = target_day
-                            best_slot_val = (target_day, slot, room)
-                        current[lonely_memo] = old_slot
-                        break
-                if best_slot_val: break
-            if best_day: break
+                cell = state.first_fit(lonely_memo, (target_day,), (slot,), rooms)
+                if cell and program.move_delta(lonely_memo, old_slot, cell) < 0:
+                    best_slot_val = cell
+                    break
+            if best_slot_val: break
         
+        state.place(lonely_memo, *(best_slot_val or old_slot))
         if best_slot_val:
-            current[lonely_memo] = best_slot_val
-            _, _, _, cur_idle, cur_days, _ = calc_schedule_quality(current, memo_members, days, slots_per_day)
-            cur_score = cur_idle + cur_days * 10
+            program.move(lonely_memo, old_slot, best_slot_val)
+            tried.clear()
     
     return current
 
@@ -1575,118 +3013,401 @@ def improve_schedule(schedule, memo_members, days, slots_per_day, rooms, iterati
 # ================================================================
 
 # ================================================================
-# 🔒 دالة مشتركة للتحقق من القيود — تُستخدم في كل الخوارزميات
+# 🔒 نموذج القيود المُرمَّز — يُستخدم في كل الخوارزميات
 # ================================================================
-def make_can_place(occupied, prof_busy, prof_day_count, memo_members,
-                   fixed_slots, memo_date_limits, prof_banned_days,
-                   prof_not_before, prof_not_after, prof_allowed_days,
-                   profs_accept_18, memo_alt_days, prof_phase_split,
-                   prof_first_phase_count, slots_per_day, rejection_log=None):
-    """
-    تُنشئ دالة can_place مخصصة بكل القيود
-    تُرجع (can_place_fn, constraint_report)
-    """
-    slot_to_idx = {s: i for i, s in enumerate(slots_per_day)}
-    LATE_SLOT = "18:00"
-    constraint_report = []  # سجل تطبيق القيود
+SCHED_MAX_PER_DAY = 3
+SCHED_LATE_AFTER = "16:00"
 
 
-    def _reject(memo_id, reason):
-        if rejection_log is not None:
-            rejection_log.setdefault(str(memo_id), set()).add(reason)
-        return False
-
-    def can_place(memo_id, day, slot, room, log=True):
+def _slot_minutes(slot):
+    """تحويل التوقيت HH:MM إلى دقائق للمقارنة العددية بدل المقارنة النصية"""
+    try:
+        h, m = str(slot).strip().split(":")[:2]
+        return int(h) * 60 + int(m)
+    except (ValueError, TypeError):
+        return 0
+
+
+class ConstraintModel:
+    """ترميز الأيام والتوقيتات والقاعات والأساتذة بمعرّفات صحيحة وحساب مجال كل مذكرة مرة واحدة"""
+
+    def __init__(self, memo_members, days, slots_per_day, rooms,
+                 memo_date_limits=None, prof_banned_days=None,
+                 prof_not_before=None, prof_not_after=None, prof_allowed_days=None,
+                 profs_accept_18=None, memo_alt_days=None, prof_phase_split=None,
+                 day_time_limits=None, max_per_day=SCHED_MAX_PER_DAY):
+        import numpy as np
+
+        self.memo_members = memo_members
+        self.days = list(days)
+        self.slots = list(slots_per_day)
+        self.rooms = list(rooms)
+        self.day_id = {d: i for i, d in enumerate(self.days)}
+        self.slot_id = {s: i for i, s in enumerate(self.slots)}
+        self.room_id = {r: i for i, r in enumerate(self.rooms)}
+        self.profs = sorted({p for ms in memo_members.values() for p in ms})
+        self.prof_id = {p: i for i, p in enumerate(self.profs)}
+        self.n_slots = len(self.slots)
+        self.max_per_day = max_per_day
+
+        self.memo_date_limits = memo_date_limits or {}
+        self.prof_banned_days = prof_banned_days or {}
+        self.prof_not_before = prof_not_before or {}
+        self.prof_not_after = prof_not_after or {}
+        self.prof_allowed_days = prof_allowed_days or {}
+        self.profs_accept_18 = profs_accept_18 or set()
+        self.memo_alt_days = memo_alt_days or {}
+        self.prof_phase_split = prof_phase_split or {}
+        self.day_time_limits = day_time_limits or {}
+
+        n_days, n_slots = len(self.days), self.n_slots
+        self._day_arr = np.array(self.days, dtype=str)
+        late_cut = _slot_minutes(SCHED_LATE_AFTER)
+        self.late = np.array([_slot_minutes(s) > late_cut for s in self.slots], dtype=bool)
+
+        # الأيام والتوقيتات المسموحة لكل أستاذ: (P, D) و (P, S)
+        self.prof_day = np.ones((len(self.profs), n_days), dtype=bool)
+        self.prof_slot = np.ones((len(self.profs), n_slots), dtype=bool)
+        for prof, p in self.prof_id.items():
+            banned = self.prof_banned_days.get(prof)
+            if banned:
+                self.prof_day[p] &= ~np.isin(self._day_arr, list(banned))
+            if self.prof_allowed_days.get(prof):
+                self.prof_day[p] &= np.isin(self._day_arr, list(self.prof_allowed_days[prof]))
+            if prof not in self.profs_accept_18:
+                self.prof_slot[p] &= ~self.late
+            if prof in self.prof_not_before:
+                self.prof_slot[p, :self.slot_id.get(self.prof_not_before[prof], 0)] = False
+            if prof in self.prof_not_after:
+                self.prof_slot[p, self.slot_id.get(self.prof_not_after[prof], 99) + 1:] = False
+
+        # قيود التوقيت اليومي (من/إلى): (D, S)
+        self.day_slot = np.ones((n_days, n_slots), dtype=bool)
+        for day, (from_t, to_t) in self.day_time_limits.items():
+            d = self.day_id.get(day)
+            if d is None: continue
+            if from_t: self.day_slot[d, :self.slot_id.get(from_t, 0)] = False
+            if to_t: self.day_slot[d, self.slot_id.get(to_t, 99) + 1:] = False
+
+        # تقسيم الفترتين: قناع أيام الفترة الثانية لكل أستاذ معني
+        self.phase = {}
+        for p, (n_first, start_second) in self.prof_phase_split.items():
+            if p in self.prof_id:
+                second = sum(1 << i for i, d in enumerate(self.days) if d >= start_second)
+                self.phase[self.prof_id[p]] = (n_first, second)
+        self.phase_mask = sum(1 << p for p in self.phase)
+
+        self._static = {}
+        self.memo_ids = list(memo_members)
+        self.domain = self._compile_domain(self.memo_ids)
+
+    def _compile_domain(self, memo_ids):
+        """مجال المذكرات الثابت (M, D, S): كل القيود التي لا تتغير أثناء البحث دفعة واحدة.
+        القاعة لا تدخل في أي قيد ثابت لذا يُبث المجال على كل القاعات."""
+        import numpy as np
+
+        n_profs = len(self.profs)
+        memo_ids = [str(m) for m in memo_ids]
+        members = np.zeros((len(memo_ids), n_profs), dtype=np.int32)
+        for i, mid in enumerate(memo_ids):
+            for prof in self.memo_members.get(mid, ()):
+                if prof in self.prof_id: members[i, self.prof_id[prof]] = 1
+
+        # المذكرة مسموحة في يوم/توقيت إذا لم يرفضه أي عضو
+        memo_day = (members @ (~self.prof_day).astype(np.int32)) == 0
+        memo_slot = (members @ (~self.prof_slot).astype(np.int32)) == 0
+
+        for i, mid in enumerate(memo_ids):
+            if mid in self.memo_date_limits:
+                earliest, latest = self.memo_date_limits[mid]
+                if earliest: memo_day[i] &= self._day_arr >= earliest
+                if latest: memo_day[i] &= self._day_arr <= latest
+            if self.memo_alt_days.get(mid):
+                memo_day[i] &= np.isin(self._day_arr, list(self.memo_alt_days[mid]))
+
+        domain = memo_day[:, :, None] & memo_slot[:, None, :] & self.day_slot[None, :, :]
+
+        # صف لكل مذكرة: قناع بتات التوقيتات المسموحة في كل يوم
+        weights = np.left_shift(1, np.arange(self.n_slots, dtype=np.int64))
+        day_slots = (domain.astype(np.int64) * weights).sum(axis=2).tolist()
+        for i, mid in enumerate(memo_ids):
+            pids = tuple(int(p) for p in np.flatnonzero(members[i]))
+            self._static[mid] = (pids, sum(1 << p for p in pids), day_slots[i])
+        return domain
+
+    def room_index(self, room):
+        """معرّف القاعة — القاعات غير المعروفة (مثل مواعيد مثبتة) تُضاف عند أول ظهور"""
+        r = self.room_id.get(room)
+        if r is None:
+            r = self.room_id[room] = len(self.rooms)
+            self.rooms.append(room)
+        return r
+
+    def static(self, memo_id):
+        """(معرّفات الأعضاء، قناع الأعضاء، أقنعة التوقيتات المسموحة لكل يوم) للمذكرة"""
         mid = str(memo_id)
+        cached = self._static.get(mid)
+        if cached is None:
+            self._compile_domain([mid])
+            cached = self._static[mid]
+        return cached
+
+    def new_state(self, rejection_log=None):
+        return ScheduleState(self, rejection_log)
+
+
+class ScheduleState:
+    """جدول قيد البناء: إشغال القاعات وانشغال الأساتذة وبلوغ الحد اليومي كمجموعات بتات لكل (يوم، توقيت)"""
+
+    def __init__(self, model, rejection_log=None):
+        self.model = model
+        self.rejection_log = rejection_log
+        self.schedule = {}
+        n_days = len(model.days)
+        self.room_used = [0] * (n_days * model.n_slots)
+        self.prof_busy = [0] * (n_days * model.n_slots)
+        self.day_full = [0] * n_days
+        self.prof_day_load = [[0] * n_days for _ in model.profs]
+        self.phase_count = {}
+        self._cells = {}
+
+    def day_count(self, prof, day):
+        """عدد مناقشات الأستاذ في اليوم"""
+        p, d = self.model.prof_id.get(prof), self.model.day_id.get(day)
+        if p is None or d is None:
+            return 0
+        return self.prof_day_load[p][d]
+
+    def _phase_ok(self, pids, d, phase_drop=None):
+        for p in pids:
+            if p in self.model.phase:
+                n_first, second = self.model.phase[p]
+                in_second = (second >> d) & 1
+                count = self.phase_count.get(p, 0) - (phase_drop.get(p, 0) if phase_drop else 0)
+                if count < n_first:
+                    if in_second: return False
+                elif not in_second:
+                    return False
+        return True
 
-        # 1. القاعة مشغولة
-        if (day, slot, room) in occupied:
-            return _reject(mid, f"القاعة {room} مشغولة {day} {slot}") if log else False
+    def _lift(self, lift):
+        """أثر سحب مذكرات مؤقتاً دون تعديل الحالة:
+        ({خلية: (بتات القاعات، بتات الأساتذة)}، {يوم: بتات من ينزل تحت الحد}، {أستاذ: نقص عدّاد الفترة الأولى})"""
+        m = self.model
+        cells, drops, phase_drop = {}, collections.Counter(), collections.Counter()
+        for mid in lift:
+            cell = self._cells.get(str(mid))
+            if cell is None:
+                continue
+            d, s, r = cell
+            pids, pmask, _ = m.static(mid)
+            c = d * m.n_slots + s
+            rooms_bits, profs_bits = cells.get(c, (0, 0))
+            cells[c] = (rooms_bits | 1 << r, profs_bits | pmask)
+            for p in pids:
+                drops[(p, d)] += 1
+                if p in m.phase and not (m.phase[p][1] >> d) & 1:
+                    phase_drop[p] += 1
+        unfull = collections.Counter()
+        for (p, d), k in drops.items():
+            if self.prof_day_load[p][d] - k < m.max_per_day:
+                unfull[d] |= 1 << p
+        return cells, unfull, phase_drop
+
+    def prof_total(self, prof):
+        """مجموع مناقشات الأستاذ في الجدول"""
+        p = self.model.prof_id.get(prof)
+        return sum(self.prof_day_load[p]) if p is not None else 0
+
+    def used_slots(self, day):
+        """معرّفات التوقيتات المشغولة في اليوم (أي قاعة)"""
+        d = self.model.day_id.get(day)
+        if d is None:
+            return []
+        n = self.model.n_slots
+        return [s for s in range(n) if self.room_used[d * n + s]]
+
+    def fits(self, memo_id, day, slot, room):
+        """التعارضات المتغيرة فقط: القاعة، انشغال الأعضاء، الحد اليومي"""
+        m = self.model
+        d, s = m.day_id.get(day), m.slot_id.get(slot)
+        if d is None or s is None:
+            return False
+        r = m.room_id.get(room)
+        if r is None: r = m.room_index(room)
+        pmask = m.static(memo_id)[1]
+        c = d * m.n_slots + s
+        return not ((self.room_used[c] >> r) & 1
+                    or self.prof_busy[c] & pmask
+                    or self.day_full[d] & pmask)
+
+    def can_place(self, memo_id, day, slot, room, log=True, lift=()):
+        """هل يمكن وضع المذكرة في هذه الخانة؟ — بضع عمليات على البتات.
+        lift: مذكرات تُعامَل خاناتها كأنها فارغة (لتقييم نقلة دون تطبيقها)"""
+        m = self.model
+        d, s = m.day_id.get(day), m.slot_id.get(slot)
+        if d is None or s is None:
+            return False
+        r = m.room_id.get(room)
+        if r is None: r = m.room_index(room)
+        c = d * m.n_slots + s
+        cells, unfull, phase_drop = self._lift(lift) if lift else ({}, {}, None)
+        free_rooms, free_profs = cells.get(c, (0, 0))
+        if ((self.room_used[c] & ~free_rooms) >> r) & 1:
+            if log and self.rejection_log is not None:
+                self.rejection_log.setdefault(str(memo_id), set()).add(f"القاعة {room} مشغولة {day} {slot}")
+            return False
+        pids, pmask, day_slots = m.static(memo_id)
+        static_ok = (day_slots[d] >> s) & 1
+        if (static_ok
+                and not self.prof_busy[c] & ~free_profs & pmask
+                and not self.day_full[d] & ~unfull.get(d, 0) & pmask
+                and (not pmask & m.phase_mask or self._phase_ok(pids, d, phase_drop))):
+            return True
+        # الأيام الممنوعة/المسموحة تُسجَّل دائماً، الباقي فقط عند log
+        if self.rejection_log is not None and not lift and (log or not static_ok):
+            reason, always = self._explain(str(memo_id), day, slot, d, s, c)
+            if reason and (log or always):
+                self.rejection_log.setdefault(str(memo_id), set()).add(reason)
+        return False
 
-        # 2. لا بعد 16:00 للجميع إلا من يقبل 18:00
-        if slot > "16:00":
-            _members = memo_members.get(mid, set())
-            _non_acc = _members - profs_accept_18
+    def _explain(self, mid, day, slot, d, s, c):
+        """سبب الرفض بنفس ترتيب فحص القيود: (السبب، هل يُسجَّل دائماً)"""
+        m = self.model
+        members = m.memo_members.get(mid, set())
+        if m.late[s]:
+            _non_acc = members - m.profs_accept_18
             if _non_acc:
-                return _reject(mid, f"توقيت {slot} بعد 16:00 — لا يقبله: {', '.join(sorted(_non_acc)[:2])}") if log else False
-
-        # 3. قيود التوقيت اليومي (من/إلى في شيت الأيام) — يُمرر من خارج
-        # (يُعالج في day_time_limits خارج هذه الدالة)
-
-        # 4. حدود تاريخ المذكرة
-        if mid in memo_date_limits:
-            earliest, latest = memo_date_limits[mid]
-            if earliest and day < earliest:
-                return _reject(mid, f"لا تُبرمج قبل {earliest}") if log else False
-            if latest and day > latest:
-                return _reject(mid, f"لا تُبرمج بعد {latest}") if log else False
-
-        # 5. الأيام البديلة
-        if mid in memo_alt_days and memo_alt_days[mid]:
-            if day not in memo_alt_days[mid]:
-                return _reject(mid, f"يوم {day} ليس من الأيام البديلة") if log else False
-
-        members = memo_members.get(mid, set())
+                return f"توقيت {slot} بعد 16:00 — لا يقبله: {', '.join(sorted(_non_acc)[:2])}", False
+        if not m.day_slot[d, s]:
+            return f"{day}: {slot} خارج حدود التوقيت اليومي", False
+        if mid in m.memo_date_limits:
+            earliest, latest = m.memo_date_limits[mid]
+            if earliest and day < earliest: return f"لا تُبرمج قبل {earliest}", False
+            if latest and day > latest: return f"لا تُبرمج بعد {latest}", False
+        if m.memo_alt_days.get(mid) and day not in m.memo_alt_days[mid]:
+            return f"يوم {day} ليس من الأيام البديلة", False
         for prof in members:
-            # 6. تعارض في نفس التوقيت
-            if (day, slot, prof) in prof_busy:
-                return _reject(mid, f"{prof} مشغول {day} {slot}") if log else False
-
-            # 7. الحد الأقصى 3 مناقشات/يوم
-            if prof_day_count.get((prof, day), 0) >= 3:
-                return _reject(mid, f"{prof} بلغ الحد 3 في {day}") if log else False
-
-            # 8. أيام ممنوعة
-            if day in prof_banned_days.get(prof, set()):
-                if rejection_log is not None:
-                    rejection_log.setdefault(str(mid), set()).add(f"يوم {day} ممنوع على {prof}")
-                return False  # رفض مطلق بغض النظر عن log
-
-            # 9. أيام مسموحة فقط
-            if prof in prof_allowed_days and prof_allowed_days[prof]:
-                if day not in prof_allowed_days[prof]:
-                    if rejection_log is not None:
-                        rejection_log.setdefault(str(mid), set()).add(f"يوم {day} غير مسموح لـ{prof}")
-                    return False  # رفض مطلق
-
-            # 10. لا قبل توقيت
-            if prof in prof_not_before:
-                if slot_to_idx.get(slot, 0) < slot_to_idx.get(prof_not_before[prof], 0):
-                    return _reject(mid, f"{prof} لا يحضر قبل {prof_not_before[prof]}") if log else False
-
-            # 11. لا بعد توقيت
-            if prof in prof_not_after:
-                if slot_to_idx.get(slot, 99) > slot_to_idx.get(prof_not_after[prof], 99):
-                    return _reject(mid, f"{prof} لا يحضر بعد {prof_not_after[prof]}") if log else False
-
-            # 12. تقسيم الفترتين
-            if prof in prof_phase_split:
-                n_first, start_second = prof_phase_split[prof]
-                cur = prof_first_phase_count.get(prof, 0)
-                if cur < n_first:
-                    if day >= start_second:
-                        return _reject(mid, f"{prof} لا يزال في الفترة الأولى") if log else False
-                else:
-                    if day < start_second:
-                        return _reject(mid, f"{prof} انتقل للفترة الثانية") if log else False
-
-        return True
-
-    return can_place, constraint_report
+            p = m.prof_id[prof]
+            if (self.prof_busy[c] >> p) & 1:
+                return f"{prof} مشغول {day} {slot}", False
+            if (self.day_full[d] >> p) & 1:
+                return f"{prof} بلغ الحد {m.max_per_day} في {day}", False
+            if not m.prof_day[p, d]:
+                if day in m.prof_banned_days.get(prof, set()):
+                    return f"يوم {day} ممنوع على {prof}", True
+                return f"يوم {day} غير مسموح لـ{prof}", True
+            if not m.prof_slot[p, s]:
+                if prof in m.prof_not_before and s < m.slot_id.get(m.prof_not_before[prof], 0):
+                    return f"{prof} لا يحضر قبل {m.prof_not_before[prof]}", False
+                if prof in m.prof_not_after and s > m.slot_id.get(m.prof_not_after[prof], 99):
+                    return f"{prof} لا يحضر بعد {m.prof_not_after[prof]}", False
+            if p in m.phase and not self._phase_ok((p,), d):
+                if self.phase_count.get(p, 0) < m.phase[p][0]:
+                    return f"{prof} لا يزال في الفترة الأولى", False
+                return f"{prof} انتقل للفترة الثانية", False
+        return None, False
+
+    def first_fit(self, memo_id, days, slots, rooms, lift=()):
+        """أول خانة صالحة بالترتيب المعطى — الأيام والتوقيتات المرفوضة تُتخطى دفعة واحدة.
+        slots/rooms: قائمة، أو دالة slots(day) / rooms(day, slot) تُرجع ترتيباً جديداً لكل يوم/توقيت.
+        lift: كما في can_place"""
+        m = self.model
+        pids, pmask, day_slots = m.static(memo_id)
+        n = m.n_slots
+        slots_for = slots if callable(slots) else (lambda day: slots)
+        rooms_for = rooms if callable(rooms) else (lambda day, slot: rooms)
+        cells, unfull, phase_drop = self._lift(lift) if lift else ({}, {}, None)
+        for day in days:
+            d = m.day_id.get(day)
+            if d is None:
+                continue
+            allowed = day_slots[d]
+            if not allowed or self.day_full[d] & ~unfull.get(d, 0) & pmask:
+                continue
+            if pmask & m.phase_mask and not self._phase_ok(pids, d, phase_drop):
+                continue
+            for slot in slots_for(day):
+                s = m.slot_id.get(slot)
+                if s is None or not (allowed >> s) & 1:
+                    continue
+                c = d * n + s
+                free_rooms, free_profs = cells.get(c, (0, 0))
+                if self.prof_busy[c] & ~free_profs & pmask:
+                    continue
+                used = self.room_used[c] & ~free_rooms
+                for room in rooms_for(day, slot):
+                    r = m.room_id.get(room)
+                    if r is None: r = m.room_index(room)
+                    if not (used >> r) & 1:
+                        return day, slot, room
+        return None
+
+    def place(self, memo_id, day, slot, room):
+        """وضع المذكرة في الخانة وتحديث البتات والعدّادات"""
+        m = self.model
+        mid = str(memo_id)
+        self.schedule[mid] = (day, slot, room)
+        d, s = m.day_id.get(day), m.slot_id.get(slot)
+        if d is None or s is None:
+            return
+        r = m.room_id.get(room)
+        if r is None: r = m.room_index(room)
+        self._cells[mid] = (d, s, r)
+        c = d * m.n_slots + s
+        pids, pmask, _ = m.static(mid)
+        self.room_used[c] |= 1 << r
+        self.prof_busy[c] |= pmask
+        for p in pids:
+            load = self.prof_day_load[p]
+            load[d] += 1
+            if load[d] >= m.max_per_day:
+                self.day_full[d] |= 1 << p
+            # عدّاد الفترة الأولى = مناقشات الأستاذ في أيامها، لا ترتيب الوضع — فيصحّ تحميل جدول كامل
+            if p in m.phase and not (m.phase[p][1] >> d) & 1:
+                self.phase_count[p] = self.phase_count.get(p, 0) + 1
+
+    def remove(self, memo_id):
+        """سحب المذكرة من خانتها"""
+        m = self.model
+        mid = str(memo_id)
+        self.schedule[mid] = None
+        cell = self._cells.pop(mid, None)
+        if cell is None:
+            return
+        d, s, r = cell
+        c = d * m.n_slots + s
+        pids, pmask, _ = m.static(mid)
+        self.room_used[c] &= ~(1 << r)
+        self.prof_busy[c] &= ~pmask
+        for p in pids:
+            load = self.prof_day_load[p]
+            load[d] -= 1
+            if load[d] < m.max_per_day:
+                self.day_full[d] &= ~(1 << p)
+            if p in m.phase and not (m.phase[p][1] >> d) & 1:
+                self.phase_count[p] -= 1
+
+    def load(self, schedule):
+        """تحميل جدول موجود كما هو دون فحص"""
+        for mid, sv in schedule.items():
+            if sv: self.place(mid, *sv)
+            else: self.schedule[str(mid)] = None
+        return self
 
 
-def make_place_fn(schedule, occupied, prof_busy, prof_day_count, memo_members, prof_first_phase_count, prof_phase_split):
-    """دالة وضع المذكرة في الجدول"""
-    def place(memo_id, day, slot, room):
-        mid = str(memo_id)
-        schedule[mid] = (day, slot, room)
-        occupied[(day, slot, room)] = mid
-        for prof in memo_members.get(mid, set()):
-            prof_busy[(day, slot, prof)] = mid
-            prof_day_count[(prof, day)] = prof_day_count.get((prof, day), 0) + 1
-            if prof in prof_phase_split:
-                prof_first_phase_count[prof] = prof_first_phase_count.get(prof, 0) + 1
-    return place
+def compile_constraints(memo_members, days, slots_per_day, rooms, constraints, day_time_limits=None):
+    """بناء نموذج القيود من صف القيود الموحّد للخوارزميات"""
+    fixed_slots, memo_date_limits, prof_banned_days, prof_not_before, prof_not_after, \
+    prof_one_day, prof_allowed_days, prof_consecutive, frozen_profs, prof_phase_split, \
+    memo_alt_days, profs_accept_18, profs_cluster_days = constraints
+    return ConstraintModel(
+        memo_members, days, slots_per_day, rooms,
+        memo_date_limits=memo_date_limits, prof_banned_days=prof_banned_days,
+        prof_not_before=prof_not_before, prof_not_after=prof_not_after,
+        prof_allowed_days=prof_allowed_days, profs_accept_18=profs_accept_18,
+        memo_alt_days=memo_alt_days, prof_phase_split=prof_phase_split,
+        day_time_limits=day_time_limits)
 
 
 def apply_fixed_slots(fixed_slots, days, slots_per_day, rooms, can_place, place, scheduled, rejection_log=None):
@@ -1732,8 +3453,9 @@ def algo_blocks(df_memos, days, slots_per_day, rooms, constraints):
     memo_ids = df_memos["رقم المذكرة"].astype(str).tolist()
     slot_to_idx = {s: i for i, s in enumerate(slots_per_day)}
 
-    schedule, occupied, prof_busy, prof_day_count, prof_first_phase_count = {}, {}, {}, {}, {}
     rejection_log = {}
+    state = compile_constraints(memo_members, days, slots_per_day, rooms, constraints).new_state(rejection_log)
+    schedule = state.schedule
     scheduled = set()
 
     # الطاقة اليومية المستهدفة — توزيع عادل
@@ -1748,14 +3470,7 @@ def algo_blocks(df_memos, days, slots_per_day, rooms, constraints):
     # عداد المذكرات في كل يوم
     day_count = {d: 0 for d in days}
 
-    can_place, _ = make_can_place(
-        occupied, prof_busy, prof_day_count, memo_members,
-        fixed_slots, memo_date_limits, prof_banned_days,
-        prof_not_before, prof_not_after, prof_allowed_days,
-        profs_accept_18, memo_alt_days, prof_phase_split,
-        prof_first_phase_count, slots_per_day, rejection_log)
-    place = make_place_fn(schedule, occupied, prof_busy, prof_day_count,
-                          memo_members, prof_first_phase_count, prof_phase_split)
+    can_place, place = state.can_place, state.place
 
     # Phase 0: Fixed slots
     applied, failed = apply_fixed_slots(fixed_slots, days, slots_per_day, rooms, can_place, place, scheduled)
@@ -1893,16 +3608,11 @@ def algo_day_first(df_memos, days, slots_per_day, rooms, constraints):
     prof_memos_map, memo_members = build_prof_memo_map(df_memos)
     memo_ids = df_memos["رقم المذكرة"].astype(str).tolist()
 
-    schedule, occupied, prof_busy, prof_day_count, prof_first_phase_count = {}, {}, {}, {}, {}
     rejection_log = {}
+    state = compile_constraints(memo_members, days, slots_per_day, rooms, constraints).new_state(rejection_log)
+    schedule = state.schedule
     scheduled = set()
-
-    can_place, _ = make_can_place(occupied, prof_busy, prof_day_count, memo_members,
-        fixed_slots, memo_date_limits, prof_banned_days, prof_not_before, prof_not_after,
-        prof_allowed_days, profs_accept_18, memo_alt_days, prof_phase_split,
-        prof_first_phase_count, slots_per_day, rejection_log)
-    place = make_place_fn(schedule, occupied, prof_busy, prof_day_count, memo_members,
-        prof_first_phase_count, prof_phase_split)
+    can_place, place = state.can_place, state.place
 
     applied, failed = apply_fixed_slots(fixed_slots, days, slots_per_day, rooms, can_place, place, scheduled)
     if failed:
@@ -1915,7 +3625,7 @@ def algo_day_first(df_memos, days, slots_per_day, rooms, constraints):
         free = sum(1 for p in members
             if day not in prof_banned_days.get(p, set())
             and (not prof_allowed_days.get(p) or day in prof_allowed_days.get(p, set()))
-            and prof_day_count.get((p, day), 0) < 3)
+            and state.day_count(p, day) < 3)
         return free / len(members)
 
     remaining = [m for m in memo_ids if m not in scheduled]
@@ -1958,26 +3668,17 @@ def algo_greedy(df_memos, days, slots_per_day, rooms, constraints):
     prof_memos_map, memo_members = build_prof_memo_map(df_memos)
     memo_ids = df_memos["رقم المذكرة"].astype(str).tolist()
 
-    schedule, occupied, prof_busy, prof_day_count, prof_first_phase_count = {}, {}, {}, {}, {}
     prof_days_used = {}
     rejection_log = {}
+    state = compile_constraints(memo_members, days, slots_per_day, rooms, constraints).new_state(rejection_log)
+    schedule = state.schedule
     scheduled = set()
-
-    can_place, _ = make_can_place(occupied, prof_busy, prof_day_count, memo_members,
-        fixed_slots, memo_date_limits, prof_banned_days, prof_not_before, prof_not_after,
-        prof_allowed_days, profs_accept_18, memo_alt_days, prof_phase_split,
-        prof_first_phase_count, slots_per_day, rejection_log)
+    can_place = state.can_place
 
     def place(memo_id, day, slot, room):
-        mid = str(memo_id)
-        schedule[mid] = (day, slot, room)
-        occupied[(day, slot, room)] = mid
-        for prof in memo_members.get(mid, set()):
-            prof_busy[(day, slot, prof)] = mid
-            prof_day_count[(prof, day)] = prof_day_count.get((prof, day), 0) + 1
+        state.place(memo_id, day, slot, room)
+        for prof in memo_members.get(str(memo_id), set()):
             prof_days_used.setdefault(prof, set()).add(day)
-            if prof in prof_phase_split:
-                prof_first_phase_count[prof] = prof_first_phase_count.get(prof, 0) + 1
 
     applied, failed = apply_fixed_slots(fixed_slots, days, slots_per_day, rooms, can_place, place, scheduled)
     if failed:
@@ -2001,7 +3702,7 @@ def algo_greedy(df_memos, days, slots_per_day, rooms, constraints):
             for p in members:
                 if day in prof_banned_days.get(p, set()): continue
                 if prof_allowed_days.get(p) and day not in prof_allowed_days[p]: continue
-                if prof_day_count.get((p, day), 0) >= 3: continue
+                if state.day_count(p, day) >= 3: continue
                 available += 1
                 if day in prof_days_used.get(p, set()): already_here += 1
             score = available * 2 + already_here * 3
@@ -2147,16 +3848,11 @@ def algo_smart_fair(df_memos, days, slots_per_day, rooms, constraints):
         return total_score
 
     # ── المرحلة 1: توليد schedule صالح ──
-    schedule, occupied, prof_busy, prof_day_count, prof_first_phase_count = {}, {}, {}, {}, {}
     rejection_log = {}
+    state = compile_constraints(memo_members, days, slots_per_day, rooms, constraints).new_state(rejection_log)
+    schedule = state.schedule
     scheduled = set()
-
-    can_place, _ = make_can_place(occupied, prof_busy, prof_day_count, memo_members,
-        fixed_slots, memo_date_limits, prof_banned_days, prof_not_before, prof_not_after,
-        prof_allowed_days, profs_accept_18, memo_alt_days, prof_phase_split,
-        prof_first_phase_count, slots_per_day, rejection_log)
-    place = make_place_fn(schedule, occupied, prof_busy, prof_day_count, memo_members,
-        prof_first_phase_count, prof_phase_split)
+    can_place, place = state.can_place, state.place
 
     # Fixed slots
     applied, failed = apply_fixed_slots(fixed_slots, days, slots_per_day, rooms, can_place, place, scheduled)
@@ -2185,8 +3881,10 @@ def algo_smart_fair(df_memos, days, slots_per_day, rooms, constraints):
         best_slot_score = -float('inf')
 
         members = memo_members.get(memo, set())
+        profs_with_sessions = [p for p in members if state.prof_total(p) > 0]
 
         for day in days:
+            existing_slots = state.used_slots(day)
             for slot in slots_per_day:
                 for room in rooms:
                     if not can_place(memo, day, slot, room, log=False):
@@ -2196,27 +3894,22 @@ def algo_smart_fair(df_memos, days, slots_per_day, rooms, constraints):
 
                     # مكافأة إذا الأستاذ موجود بالفعل في هذا اليوم
                     for p in members:
-                        if prof_day_count.get((p, day), 0) > 0:
+                        if state.day_count(p, day) > 0:
                             slot_score += 30  # يفضل التجميع
                         # عقوبة إذا الأستاذ سيبلغ 3 في هذا اليوم
-                        if prof_day_count.get((p, day), 0) == 2:
+                        if state.day_count(p, day) == 2:
                             slot_score -= 5  # اليوم سيمتلئ
 
                     # مكافأة إذا التوقيتات متتالية
                     for p in members:
-                        existing_slots = [slot_to_idx.get(s, 0)
-                                          for (d, s, _), mid2 in [(sv, m) for m, sv in schedule.items() if sv]
-                                          if d == day]
                         if existing_slots:
                             min_gap = min(abs(slot_to_idx.get(slot, 0) - es) for es in existing_slots)
                             if min_gap == 1: slot_score += 20  # متتالية
                             elif min_gap > 2: slot_score -= 15  # فجوة
 
                     # عقوبة على أيام منعزلة
-                    for p in members:
-                        days_with_sessions = [d for (d, s, r), mid2 in [(sv, m) for m, sv in schedule.items() if sv]
-                                              for pp in [memo_members.get(mid2, set())] if p in pp]
-                        if days_with_sessions and day not in days_with_sessions:
+                    for p in profs_with_sessions:
+                        if state.day_count(p, day) == 0:
                             slot_score -= 10  # يوم جديد = قد يكون منعزلاً
 
                     if slot_score > best_slot_score:
@@ -2374,10 +4067,287 @@ def _compute_soft_score(sched, memo_members, slot_to_idx, days, slots_per_day, r
     return score
 
 
+# ================================================================
+# 🔍 Tabu Search بتقييم تزايدي
+# ================================================================
+TABU_ITERATIONS = 5000
+TABU_TIME_BUDGET = 20      # ثوانٍ
+TABU_TENURE = 30           # عدد النقلات التي يبقى فيها (مذكرة، خانة) محظوراً
+TABU_NEIGHBOURS = 24       # نقلات مُقيَّمة في كل تكرار (نصفها نقل ونصفها مبادلة)
+
+
+class ScheduleFitness:
+    """fitness جدول GA محدَّثة تزايدياً — تغيير خانة مذكرة يكلّف بحجم لجنتها فقط"""
+
+    def __init__(self, memo_members, n_memos, days, slots_per_day, rooms,
+                 cutoff=None, target_ratio=0.70, early_enabled=False):
+        self.program = ProfessorProgram(memo_members, slots_per_day)
+        self.memo_members = memo_members
+        self.total = n_memos
+        self.cap = len(days) * len(slots_per_day) * len(rooms)
+        self.cutoff = cutoff
+        self.target_ratio = target_ratio
+        self.early_enabled = early_enabled
+        self.schedule = {}
+        self.placed = 0
+        self.early = 0
+        self._day_ord = {}
+        self._parts = {}      # prof -> (نقاط، انتهاك حرج، عدد المناقشات)
+        self.part_sum = 0
+        self.critical = 0
+        self._n = self._sum = self._sq = 0
+
+    def _ord(self, day):
+        if day not in self._day_ord:
+            try: self._day_ord[day] = datetime.strptime(day, "%Y-%m-%d").toordinal()
+            except (ValueError, TypeError): self._day_ord[day] = None
+        return self._day_ord[day]
+
+    def _prof_part(self, prof):
+        """مساهمة الأستاذ: فراغات، أيام متتالية، أيام منعزلة، عدد الأيام — كما في fitness و_compute_soft_score"""
+        days_dict = self.program.slots.get(prof)
+        if not days_dict:
+            return None
+        total_p = sum(len(s) for s in days_dict.values())
+        score = -5 * sum(ProfessorProgram._idle(s) for s in days_dict.values())
+        sorted_d = sorted(days_dict)
+        consec = max_c = 1
+        for i in range(1, len(sorted_d)):
+            d1, d2 = self._ord(sorted_d[i-1]), self._ord(sorted_d[i])
+            if d1 is None or d2 is None: continue
+            if d2 - d1 <= 3:
+                consec += 1; max_c = max(max_c, consec)
+            else:
+                consec = 1
+            if consec > 3: score -= 50 * (consec - 3)
+        if max_c > 3: score -= (max_c - 3) * 15
+        lonely = sum(1 for s in days_dict.values() if len(s) == 1)
+        critical = 0
+        if total_p >= 3:
+            if lonely > 1: score -= (lonely - 1) * 10
+            if lonely > 2:
+                score -= 500 * (lonely - 2)
+                critical = 1
+            elif lonely == 2:
+                score -= 50
+        score += max(0, 20 - len(days_dict) * 2)
+        return score, critical, total_p
+
+    def _refresh(self, profs):
+        for prof in profs:
+            old = self._parts.pop(prof, None)
+            if old:
+                self.part_sum -= old[0]; self.critical -= old[1]
+                self._n -= 1; self._sum -= old[2]; self._sq -= old[2] * old[2]
+            new = self._prof_part(prof)
+            if new:
+                self._parts[prof] = new
+                self.part_sum += new[0]; self.critical += new[1]
+                self._n += 1; self._sum += new[2]; self._sq += new[2] * new[2]
+
+    def _is_early(self, sv):
+        return bool(self.cutoff) and sv[0] < self.cutoff
+
+    def set(self, mid, sv):
+        """نقل المذكرة إلى sv (أو None) — تُرجع الخانة السابقة"""
+        old = self.schedule.get(mid)
+        if old == sv:
+            return old
+        if old:
+            self.program.drop(mid, old)
+            self.placed -= 1; self.early -= self._is_early(old)
+        if sv:
+            self.program.add(mid, sv)
+            self.placed += 1; self.early += self._is_early(sv)
+        self.schedule[mid] = sv
+        self._refresh(self.memo_members.get(mid, ()))
+        return old
+
+    def load(self, schedule):
+        for mid, sv in schedule.items():
+            self.schedule[mid] = None
+            if sv: self.set(mid, sv)
+        return self
+
+    def value(self):
+        """نفس قيمة fitness في ga_tabu_scheduler لجدول خالٍ من التعارضات"""
+        if self.critical:
+            return -10000 * self.critical
+        score = self.part_sum
+        if self._n:
+            mean = self._sum / self._n
+            std = max(0.0, self._sq / self._n - mean * mean) ** 0.5 if self._n > 1 else 0
+            score += max(0, 100 - std * 8)
+        if self.cap:
+            score += (self.placed / self.cap) * 30
+        if self.early_enabled:
+            ratio = self.early / max(self.placed, 1)
+            tr = self.target_ratio
+            if ratio >= tr: score += 400
+            elif ratio >= tr - 0.05: score += 200
+            elif ratio >= tr - 0.15: score += 50
+            else: score -= 100
+        placement = (self.placed / self.total) * 1000 if self.total else 0
+        return placement + score
+
+
+def tabu_search(schedule, state, fitness, movable, days, slots_per_day, rooms,
+                iterations=TABU_ITERATIONS, time_budget=TABU_TIME_BUDGET,
+                tenure=TABU_TENURE, neighbours=TABU_NEIGHBOURS, progress=None):
+    """
+    Tabu Search: نقل مذكرة لخانة فارغة أو مبادلة مذكرتين، تقييم كل نقلة تزايدياً،
+    قائمة محظورات FIFO بطول tenure مع معيار الطموح (تُقبل المحظورة إن تجاوزت الأفضل)
+    state: ScheduleState محمَّل بالجدول، fitness: ScheduleFitness محمَّل بنفس الجدول
+    تُرجع (أفضل جدول، أفضل fitness، إحصائيات)
+    """
+    import random, time
+
+    movable = list(movable)
+    current_fit = fitness.value()
+    best_fit, best = current_fit, dict(schedule)
+    tabu_fifo = collections.deque()
+    tabu = collections.Counter()
+    stats = {"iterations": 0, "evaluated": 0, "accepted": 0, "aspirations": 0, "improvements": 0}
+    started = time.monotonic()
+
+    def try_move(changes):
+        """تطبيق مؤقت ثم تراجع: [(مذكرة، خانة جديدة)] → fitness الناتجة"""
+        olds = [(mid, fitness.set(mid, sv)) for mid, sv in changes]
+        value, critical = fitness.value(), fitness.critical
+        for mid, sv in reversed(olds):
+            fitness.set(mid, sv)
+        return value, critical
+
+    # النقلات تُفحص على الحالة مع رفع المذكرات المعنية (lift) — لا تعديل ولا تراجع
+    def relocation(mid):
+        old = state.schedule.get(mid)
+        d_order, s_order, r_order = days[:], slots_per_day[:], rooms[:]
+        random.shuffle(d_order); random.shuffle(s_order); random.shuffle(r_order)
+        cell = state.first_fit(mid, d_order, s_order, r_order, lift=(mid,))
+        return [(mid, cell)] if cell and cell != old else None
+
+    def swap(m1, m2):
+        sv1, sv2 = state.schedule.get(m1), state.schedule.get(m2)
+        if not sv1 or not sv2 or sv1[:2] == sv2[:2]:
+            return None
+        # الخانتان مختلفتان، وعند اشتراك أستاذ يبقى حِمله اليومي وعدّاد فترته كما هو بعد المبادلة
+        ok = (state.can_place(m1, *sv2, log=False, lift=(m1, m2))
+              and state.can_place(m2, *sv1, log=False, lift=(m1, m2)))
+        return [(m1, sv2), (m2, sv1)] if ok else None
+
+    for it in range(iterations):
+        if time.monotonic() - started > time_budget or not movable:
+            break
+        stats["iterations"] = it + 1
+        if progress and it % 100 == 0:
+            progress(it, iterations, fitness.placed, current_fit)
+
+        best_move, best_move_fit = None, -float("inf")
+        base_critical = fitness.critical
+        for n in range(neighbours):
+            if n % 2 == 0 or len(movable) < 2:
+                move = relocation(random.choice(movable))
+            else:
+                move = swap(*random.sample(movable, 2))
+            if not move: continue
+            value, critical = try_move(move)
+            stats["evaluated"] += 1
+            if critical > base_critical: continue
+            if any(tabu[(mid, sv)] for mid, sv in move):
+                if value <= best_fit: continue
+                stats["aspirations"] += 1
+            if value > best_move_fit:
+                best_move, best_move_fit = move, value
+
+        if best_move is None:
+            continue
+
+        # تطبيق أفضل نقلة غير محظورة حتى لو كانت أسوأ — هذا ما يُخرج البحث من القمم المحلية
+        for mid, sv in best_move:
+            old = state.schedule.get(mid)
+            if old: state.remove(mid)
+        for mid, sv in best_move:
+            old = fitness.set(mid, sv)
+            state.place(mid, *sv)
+            tabu_fifo.append((mid, old)); tabu[(mid, old)] += 1
+        while len(tabu_fifo) > tenure:
+            tabu[tabu_fifo.popleft()] -= 1
+        current_fit = best_move_fit
+        stats["accepted"] += 1
+        if current_fit > best_fit:
+            best_fit, best = current_fit, dict(state.schedule)
+            stats["improvements"] += 1
+
+    stats["seconds"] = round(time.monotonic() - started, 2)
+    return best, best_fit, stats
+
+
+# ================================================================
+# 🧠 ذاكرة fitness للخوارزمية الجينية
+# ================================================================
+GA_FITNESS_CACHE_SIZE = 512
+
+
+def schedule_fingerprint(schedule, memo_ids):
+    """بصمة قانونية للجدول: نفس الخانات لنفس المذكرات → نفس البصمة مهما كان ترتيب القاموس"""
+    key = repr([schedule.get(m) for m in memo_ids]).encode("utf-8")
+    return hashlib.blake2b(key, digest_size=16).digest()
+
+
+class Individual(dict):
+    """جدول في مجتمع GA يحمل قيمة fitness المحسوبة له — لا يُعدَّل بعد إنشائه"""
+    __slots__ = ("fitness",)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fitness = None
+
+
+class FitnessCache:
+    """ذاكرة LRU لقيم fitness مفهرسة ببصمة الجدول، مع عدّادات الإصابة"""
+
+    def __init__(self, fn, memo_ids, maxsize=GA_FITNESS_CACHE_SIZE):
+        self.fn = fn
+        self.memo_ids = list(memo_ids)
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self.carried = 0   # القيمة محمولة على الفرد نفسه
+        self.hits = 0      # وُجدت في الذاكرة بالبصمة
+        self.misses = 0    # حُسبت فعلاً
+
+    def __call__(self, schedule):
+        value = getattr(schedule, "fitness", None)
+        if value is not None:
+            self.carried += 1
+            return value
+        key = schedule_fingerprint(schedule, self.memo_ids)
+        if key in self._data:
+            self._data.move_to_end(key)
+            self.hits += 1
+            value = self._data[key]
+        else:
+            self.misses += 1
+            value = self._data[key] = self.fn(schedule)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        if isinstance(schedule, Individual):
+            schedule.fitness = value
+        return value
+
+    def hit_rate(self):
+        total = self.carried + self.hits + self.misses
+        return (self.carried + self.hits) / total if total else 0.0
+
+    def stats(self):
+        return {"carried": self.carried, "hits": self.hits, "misses": self.misses,
+                "hit_rate": round(self.hit_rate(), 3), "size": len(self._data)}
+
+
 # ================================================================
 # 🧬 GA + Tabu Search Optimizer
 # ================================================================
-def ga_tabu_scheduler(df_memos, days, slots_per_day, rooms, constraints, streamlit_progress=None):
+def ga_tabu_scheduler(df_memos, days, slots_per_day, rooms, constraints, streamlit_progress=None,
+                      tabu_iterations=TABU_ITERATIONS, tabu_time_budget=TABU_TIME_BUDGET):
     """
     Genetic Algorithm + Tabu Search
     المرحلة 1: GA — توليد وتطوير أجيال من الجداول
@@ -2393,23 +4363,21 @@ def ga_tabu_scheduler(df_memos, days, slots_per_day, rooms, constraints, streaml
     prof_memos_map, memo_members = build_prof_memo_map(df_memos)
     memo_ids = df_memos["رقم المذكرة"].astype(str).tolist()
     slot_to_idx = {s: i for i, s in enumerate(slots_per_day)}
+    model = compile_constraints(memo_members, days, slots_per_day, rooms, constraints)
 
     # ── دالة توليد جدول صالح (Individual) ──
+    def _shuffled_slots(day):
+        return random.sample(slots_per_day, len(slots_per_day))
+
+    def _shuffled_rooms(day, slot):
+        return random.sample(rooms, len(rooms))
+
     def generate_individual(seed=None):
         if seed is not None: random.seed(seed)
-        schedule, occupied, prof_busy, prof_day_count, prof_first_phase_count = {}, {}, {}, {}, {}
-        rej = {}
+        state = model.new_state({})
+        schedule = state.schedule
         scheduled = set()
-
-        can_place, _ = make_can_place(
-            occupied, prof_busy, prof_day_count, memo_members,
-            fixed_slots, memo_date_limits, prof_banned_days,
-            prof_not_before, prof_not_after, prof_allowed_days,
-            profs_accept_18, memo_alt_days, prof_phase_split,
-            prof_first_phase_count, slots_per_day, rej
-        )
-        place = make_place_fn(schedule, occupied, prof_busy, prof_day_count,
-                              memo_members, prof_first_phase_count, prof_phase_split)
+        can_place, place = state.can_place, state.place
 
         apply_fixed_slots(fixed_slots, days, slots_per_day, rooms, can_place, place, scheduled)
 
@@ -2435,21 +4403,12 @@ def ga_tabu_scheduler(df_memos, days, slots_per_day, rooms, constraints, streaml
             else:
                 d_order = days[:]
             random.shuffle(d_order[:len(_early)])  # خلط الأيام المبكرة فيما بينها
-            placed = False
-            for day in d_order:
-                if placed: break
-                s_order = slots_per_day[:]
-                random.shuffle(s_order)
-                for slot in s_order:
-                    if placed: break
-                    r_order = rooms[:]
-                    random.shuffle(r_order)
-                    for room in r_order:
-                        if can_place(memo, day, slot, room, log=False):
-                            place(memo, day, slot, room)
-                            scheduled.add(memo)
-                            placed = True; break
-            if not placed:
+            # ترتيب جديد للتوقيتات في كل يوم وللقاعات في كل توقيت — تنوّع الأفراد
+            cell = state.first_fit(memo, d_order, _shuffled_slots, _shuffled_rooms)
+            if cell:
+                place(memo, *cell)
+                scheduled.add(memo)
+            else:
                 schedule[memo] = None
 
         for memo in memo_ids:
@@ -2490,7 +4449,7 @@ def ga_tabu_scheduler(df_memos, days, slots_per_day, rooms, constraints, streaml
         soft = _compute_soft_score(schedule, memo_members, slot_to_idx, days, slots_per_day, rooms)
 
         # ── مكافأة الجدولة في الفترة المبكرة (قبل 7 جوان) ──
-        early_placed = sum(1 for sv in schedule.values() if sv and sv[0] < CUTOFF_DATE)
+        early_placed = sum(1 for sv in schedule.values() if sv and CUTOFF_DATE and sv[0] < CUTOFF_DATE)
         early_ratio = early_placed / max(placed, 1)
         # نكافئ بقوة إذا 80%+ في الفترة المبكرة
         _tr = _target_r if "_target_r" in dir() else 0.70
@@ -2541,10 +4500,8 @@ def ga_tabu_scheduler(df_memos, days, slots_per_day, rooms, constraints, streaml
 
     # ── Crossover: دمج جدولين ──
     def crossover(parent1, parent2):
-        child = {}
-        occupied_c = {}
-        prof_busy_c = {}
-        prof_day_c = {}
+        state = model.new_state()
+        schedule_c = state.schedule
 
         # لكل مذكرة — اختر من أي والد بناءً على الـ fitness المحلي
         memos_shuffled = memo_ids[:]
@@ -2553,57 +4510,17 @@ def ga_tabu_scheduler(df_memos, days, slots_per_day, rooms, constraints, streaml
 
         for i, mid in enumerate(memos_shuffled):
             sv = parent1.get(mid) if i < cutpoint else parent2.get(mid)
-            if not sv:
-                child[mid] = None; continue
-
-            day, slot, room = sv
-            # تحقق من عدم التعارض
-            conflict = False
-            if (day, slot, room) in occupied_c:
-                conflict = True
-            else:
-                for prof in memo_members.get(mid, set()):
-                    if (day, slot, prof) in prof_busy_c:
-                        conflict = True; break
-                    if prof_day_c.get((prof, day), 0) >= 3:
-                        conflict = True; break
-
-            if not conflict:
-                child[mid] = sv
-                occupied_c[(day, slot, room)] = mid
-                for prof in memo_members.get(mid, set()):
-                    prof_busy_c[(day, slot, prof)] = mid
-                    prof_day_c[(prof, day)] = prof_day_c.get((prof, day), 0) + 1
+            # تحقق من عدم التعارض — وإلا سيُعالج في repair
+            if sv and state.fits(mid, *sv):
+                state.place(mid, *sv)
             else:
-                child[mid] = None  # سيُعالج في repair
+                schedule_c[mid] = None
 
         # Repair: برمجة المذكرات غير المجدولة
-        schedule_c = dict(child)
-        occupied_r, prof_busy_r, prof_day_r, ppc_r = {}, {}, {}, {}
-        for mid, sv in schedule_c.items():
-            if not sv: continue
-            day, slot, room = sv
-            occupied_r[(day, slot, room)] = mid
-            for prof in memo_members.get(mid, set()):
-                prof_busy_r[(day, slot, prof)] = mid
-                prof_day_r[(prof, day)] = prof_day_r.get((prof, day), 0) + 1
-
-        can_r, _ = make_can_place(occupied_r, prof_busy_r, prof_day_r, memo_members,
-            fixed_slots, memo_date_limits, prof_banned_days, prof_not_before,
-            prof_not_after, prof_allowed_days, profs_accept_18, memo_alt_days,
-            prof_phase_split, ppc_r, slots_per_day, None)
-        place_r = make_place_fn(schedule_c, occupied_r, prof_busy_r, prof_day_r,
-                                memo_members, ppc_r, prof_phase_split)
-
         for mid in memo_ids:
             if schedule_c.get(mid): continue
-            for day in days:
-                for slot in slots_per_day:
-                    for room in rooms:
-                        if can_r(mid, day, slot, room, log=False):
-                            place_r(mid, day, slot, room); break
-                    else: continue; break
-                else: continue; break
+            cell = state.first_fit(mid, days, slots_per_day, rooms)
+            if cell: state.place(mid, *cell)
 
         for mid in memo_ids:
             if mid not in schedule_c: schedule_c[mid] = None
@@ -2612,50 +4529,17 @@ def ga_tabu_scheduler(df_memos, days, slots_per_day, rooms, constraints, streaml
 
     # ── Mutation: تغيير عشوائي ──
     def mutate(schedule, rate=0.05):
-        mutated = dict(schedule)
-        occupied_m = {sv: mid for mid, sv in mutated.items() if sv}
-        prof_busy_m = {}
-        prof_day_m = {}
-        for mid, sv in mutated.items():
-            if not sv: continue
-            day, slot, room = sv
-            for prof in memo_members.get(mid, set()):
-                prof_busy_m[(day, slot, prof)] = mid
-                prof_day_m[(prof, day)] = prof_day_m.get((prof, day), 0) + 1
+        state = model.new_state().load(schedule)
+        mutated = state.schedule
 
         for mid in memo_ids:
             if random.random() > rate: continue
             if mid in fixed_slots: continue  # لا نغير المثبتة
-            old_sv = mutated.get(mid)
-            if old_sv:
-                day, slot, room = old_sv
-                del occupied_m[old_sv]
-                for prof in memo_members.get(mid, set()):
-                    if (day, slot, prof) in prof_busy_m:
-                        del prof_busy_m[(day, slot, prof)]
-                    prof_day_m[(prof, day)] = max(0, prof_day_m.get((prof, day), 1) - 1)
-
-            can_m, _ = make_can_place(occupied_m, prof_busy_m, prof_day_m, memo_members,
-                fixed_slots, memo_date_limits, prof_banned_days, prof_not_before,
-                prof_not_after, prof_allowed_days, profs_accept_18, memo_alt_days,
-                prof_phase_split, {}, slots_per_day, None)
-
-            placed = False
+            state.remove(mid)
+
             d_order = days[:]; random.shuffle(d_order)
-            for day in d_order:
-                if placed: break
-                for slot in slots_per_day:
-                    if placed: break
-                    for room in rooms:
-                        if can_m(mid, day, slot, room, log=False):
-                            mutated[mid] = (day, slot, room)
-                            occupied_m[(day, slot, room)] = mid
-                            for prof in memo_members.get(mid, set()):
-                                prof_busy_m[(day, slot, prof)] = mid
-                                prof_day_m[(prof, day)] = prof_day_m.get((prof, day), 0) + 1
-                            placed = True; break
-            if not placed:
-                mutated[mid] = None
+            cell = state.first_fit(mid, d_order, slots_per_day, rooms)
+            if cell: state.place(mid, *cell)
 
         return mutated
 
@@ -2668,6 +4552,9 @@ def ga_tabu_scheduler(df_memos, days, slots_per_day, rooms, constraints, streaml
     if streamlit_progress:
         streamlit_progress.text("🧬 المرحلة 1: توليد الجيل الأول...")
 
+    # الأفراد الباقون (النخبة) والمكررون لا يُعاد تقييمهم
+    fitness_cached = FitnessCache(fitness, memo_ids)
+
     # توليد الجيل الأول
     population = []
     for i in range(POPULATION_SIZE):
@@ -2682,19 +4569,19 @@ def ga_tabu_scheduler(df_memos, days, slots_per_day, rooms, constraints, streaml
                 ind["__lv__"] = lonely_v
                 best_attempt = ind
         if "__lv__" in best_attempt: del best_attempt["__lv__"]
-        population.append(best_attempt)
+        population.append(Individual(best_attempt))
         if streamlit_progress:
             streamlit_progress.progress(int((i+1)/POPULATION_SIZE * 30))
 
-    best_overall = max(population, key=fitness)
-    best_fitness = fitness(best_overall)
+    best_overall = max(population, key=fitness_cached)
+    best_fitness = fitness_cached(best_overall)
 
     # تطوير الأجيال
     for gen in range(GENERATIONS):
         # تقييم الجيل
-        scored = sorted(population, key=fitness, reverse=True)
+        scored = sorted(population, key=fitness_cached, reverse=True)
         gen_best = scored[0]
-        gen_best_fit = fitness(gen_best)
+        gen_best_fit = fitness_cached(gen_best)
 
         if gen_best_fit > best_fitness:
             best_fitness = gen_best_fit
@@ -2702,7 +4589,7 @@ def ga_tabu_scheduler(df_memos, days, slots_per_day, rooms, constraints, streaml
 
         if streamlit_progress:
             placed_n = sum(1 for sv in best_overall.values() if sv)
-            streamlit_progress.text(f"🧬 الجيل {gen+1}/{GENERATIONS} | أفضل: {placed_n}/{len(memo_ids)} مجدول | fitness: {best_fitness:.0f}")
+            streamlit_progress.text(f"🧬 الجيل {gen+1}/{GENERATIONS} | أفضل: {placed_n}/{len(memo_ids)} مجدول | fitness: {best_fitness:.0f} | ذاكرة: {fitness_cached.hit_rate():.0%}")
             streamlit_progress.progress(30 + int((gen+1)/GENERATIONS * 40))
 
         # Elite selection
@@ -2713,68 +4600,33 @@ def ga_tabu_scheduler(df_memos, days, slots_per_day, rooms, constraints, streaml
             p1, p2 = random.choices(scored[:10], k=2)
             child = crossover(p1, p2)
             child = mutate(child, rate=MUTATION_RATE)
-            new_pop.append(child)
+            new_pop.append(Individual(child))
 
         population = new_pop
 
+    logger.info("GA fitness cache: %s", fitness_cached.stats())
+
     # ── المرحلة 2: Tabu Search على أفضل جدول ──
     if streamlit_progress:
         streamlit_progress.text("🔍 المرحلة 2: Tabu Search — تحسين أفضل جدول...")
 
-    current = dict(best_overall)
-    current_fit = best_fitness
-    tabu_list = set()  # تعقب المبادلات المزارة
-    TABU_SIZE = 50
-    TABU_ITERATIONS = 200
-
-    scheduled_list = [m for m, sv in current.items() if sv and m not in fixed_slots]
-
-    for it in range(TABU_ITERATIONS):
-        if streamlit_progress and it % 20 == 0:
-            placed_n = sum(1 for sv in current.values() if sv)
-            streamlit_progress.text(f"🔍 Tabu Iteration {it}/{TABU_ITERATIONS} | مجدول: {placed_n} | fitness: {current_fit:.0f}")
-            streamlit_progress.progress(70 + int(it/TABU_ITERATIONS * 25))
-
-        if len(scheduled_list) < 2: break
-
-        best_neighbor = None
-        best_neighbor_fit = -float("inf")
-        best_move = None
-
-        # استكشف جيرة المبادلة
-        candidates = random.sample(scheduled_list, min(20, len(scheduled_list)))
-        for i in range(len(candidates)):
-            for j in range(i+1, len(candidates)):
-                m1, m2 = candidates[i], candidates[j]
-                move = (m1, m2) if m1 < m2 else (m2, m1)
-                if move in tabu_list: continue
-
-                sv1, sv2 = current[m1], current[m2]
-                if not sv1 or not sv2: continue
-
-                # جرب المبادلة
-                current[m1] = sv2; current[m2] = sv1
-
-                # تحقق من Hard Constraints
-                v = _validate_hard_constraints(current, memo_members)
-                if not any(x.startswith("🔴") for x in v):
-                    nf = fitness(current)
-                    if nf > best_neighbor_fit:
-                        best_neighbor_fit = nf
-                        best_neighbor = (dict(current), nf)
-                        best_move = move
-
-                # أعد الحال
-                current[m1] = sv1; current[m2] = sv2
-
-        if best_neighbor:
-            current, current_fit = best_neighbor
-            tabu_list.add(best_move)
-            if len(tabu_list) > TABU_SIZE:
-                tabu_list.pop()
-            if current_fit > best_fitness:
-                best_fitness = current_fit
-                best_overall = dict(current)
+    def _tabu_progress(it, total, placed_n, fit):
+        if streamlit_progress:
+            streamlit_progress.text(f"🔍 Tabu Iteration {it}/{total} | مجدول: {placed_n} | fitness: {fit:.0f}")
+            streamlit_progress.progress(70 + int(it/total * 25))
+
+    _tabu_state = model.new_state().load(best_overall)
+    _tabu_fitness = ScheduleFitness(
+        memo_members, len(best_overall), days, slots_per_day, rooms,
+        cutoff=CUTOFF_DATE, target_ratio=_target_r,
+        early_enabled=bool(_use_intensive and early_days)).load(best_overall)
+    _tabu_best, _tabu_fit, _tabu_stats = tabu_search(
+        best_overall, _tabu_state, _tabu_fitness,
+        [m for m in memo_ids if m not in fixed_slots], days, slots_per_day, rooms,
+        iterations=tabu_iterations, time_budget=tabu_time_budget, progress=_tabu_progress)
+    if _tabu_stats["improvements"]:
+        best_overall, best_fitness = _tabu_best, _tabu_fit
+    logger.info("Tabu: %s", _tabu_stats)
 
     if streamlit_progress:
         placed_f = sum(1 for sv in best_overall.values() if sv)
@@ -2782,7 +4634,10 @@ def ga_tabu_scheduler(df_memos, days, slots_per_day, rooms, constraints, streaml
         streamlit_progress.progress(100)
 
     # rej_log
-    rej_log = {mid: {"لا توجد خانة متاحة مع القيود"} for mid, sv in best_overall.items() if not sv}
+    # المجال الثابت الفارغ يعني أن القيود وحدها تمنع البرمجة مهما كان ترتيب البحث
+    rej_log = {mid: {"لا توجد خانة متاحة مع القيود" if any(model.static(mid)[2])
+                     else "القيود الثابتة (أيام/توقيتات الأعضاء) لا تترك أي خانة"}
+               for mid, sv in best_overall.items() if not sv}
 
     return best_overall, memo_members, rej_log
 
@@ -2946,46 +4801,20 @@ def run_algorithm(algo_name, df_memos, days, slots_per_day, rooms, constraints,
         
         # أصلح كل انتهاك — انقل المذكرة ليوم صالح
         if _violations_found:
+            _state = compile_constraints(memo_members, days, slots_per_day, rooms, constraints).new_state()
+            _state.load(schedule)
             _fixed_count = 0
             for mid, viol_prof, bad_day in _violations_found:
                 old_sv = schedule.get(mid)
                 if not old_sv: continue
+                if old_sv[0] != bad_day: continue  # نُقلت سابقاً
                 # ابحث عن خانة بديلة
-                _occ = {sv: m for m, sv in schedule.items() if sv}
-                _pbusy = {}
-                _pdc = {}
-                for m2, sv2 in schedule.items():
-                    if not sv2: continue
-                    d2, s2, r2 = sv2
-                    for p2 in memo_members.get(m2, set()):
-                        _pbusy[(d2, s2, p2)] = m2
-                        _pdc[(p2, d2)] = _pdc.get((p2, d2), 0) + 1
-                
-                placed_alt = False
-                for day in days:
-                    if placed_alt: break
-                    # تحقق أن هذا اليوم مقبول لكل الأعضاء
-                    ok_for_all = True
-                    for p in memo_members.get(mid, set()):
-                        if day in _pbd.get(p, set()):
-                            ok_for_all = False; break
-                        if _pad.get(p) and day not in _pad[p]:
-                            ok_for_all = False; break
-                    if not ok_for_all: continue
-                    
-                    for slot in slots_per_day:
-                        if placed_alt: break
-                        for room in rooms:
-                            if (day, slot, room) in _occ: continue
-                            conflict = False
-                            for p in memo_members.get(mid, set()):
-                                if (day, slot, p) in _pbusy: conflict = True; break
-                                if _pdc.get((p, day), 0) >= 3: conflict = True; break
-                            if not conflict:
-                                schedule[mid] = (day, slot, room)
-                                placed_alt = True
-                                _fixed_count += 1
-                                break
+                _state.remove(mid)
+                _cell = _state.first_fit(mid, days, slots_per_day, rooms)
+                if _cell:
+                    schedule[mid] = _cell
+                    _fixed_count += 1
+                _state.place(mid, *(_cell or old_sv))
 
     quality, placed, unplaced, idle, total_days, _ = calc_schedule_quality(schedule, memo_members, days, slots_per_day)
     return schedule, quality, placed, unplaced, idle, total_days, memo_members, rej_log
@@ -3072,36 +4901,112 @@ def save_full_schedule_to_sheets(schedule, df_memos):
     """حفظ الجدول الكامل في Google Sheets"""
     try:
         # أولاً: اقرأ الشيت الكامل للحصول على الصفوف الحقيقية
-        all_memos = load_memos()
-        # بناء خريطة رقم المذكرة → رقم الصف الحقيقي في الشيت
-        row_map = {}
-        for i, (_, row) in enumerate(all_memos.iterrows()):
-            mid = str(row.get("رقم المذكرة","")).strip()
-            if mid and mid not in ["","nan"]:
-                row_map[mid] = i + 2  # +2 لأن الصف الأول هو الرأس
-
-        updates = []
+        repo = get_repository()
+        buf = SheetWriteBuffer()
         for mid, slot in schedule.items():
             if not slot: continue
-            row_idx = row_map.get(str(mid))
+            row_idx = repo.memo_row(mid)
             if not row_idx: continue
-            updates += [
-                {"range": f"Feuille 1!W{row_idx}", "values": [[slot[0]]]},
-                {"range": f"Feuille 1!X{row_idx}", "values": [[slot[1]]]},
-                {"range": f"Feuille 1!Y{row_idx}", "values": [[slot[2] if slot[2] else ""]]},
-            ]
-        if updates:
-            for i in range(0, len(updates), 100):
-                sheets_service.spreadsheets().values().batchUpdate(
-                    spreadsheetId=MEMOS_SHEET_ID,
-                    body={"valueInputOption": "USER_ENTERED", "data": updates[i:i+100]}
-                ).execute()
-            clear_cache_and_reload()
+            buf.add(MEMOS_SHEET_ID, f"Feuille 1!W{row_idx}", slot[0])
+            buf.add(MEMOS_SHEET_ID, f"Feuille 1!X{row_idx}", slot[1])
+            buf.add(MEMOS_SHEET_ID, f"Feuille 1!Y{row_idx}", slot[2] if slot[2] else "")
+        if len(buf):
+            _, report = buf.flush()
+            SheetWriteBuffer.raise_on_failure(report)
             return True, f"✅ تم حفظ {len([s for s in schedule.values() if s])} مذكرة — لم يتم النشر بعد، الإدارة تتحكم في النشر من الشيت"
         return False, "لا شيء للحفظ"
     except Exception as e:
         return False, f"❌ {str(e)}"
 
+def _render_prof_schedule(prof_name, items):
+    """(الموضوع، HTML) للبرنامج الكامل لمناقشات أستاذ"""
+    by_day = {}
+    for it in sorted(items, key=lambda x: (x["اليوم"], x["التوقيت"])):
+        by_day.setdefault(it["اليوم"], []).append(it)
+    rows_html = ""
+    for day, its in sorted(by_day.items()):
+        rows_html += f'<tr style="background:#e8f4f8;"><td colspan="4" style="padding:8px;font-weight:900;color:#1e3a5f;">📅 {day}</td></tr>'
+        for it in its:
+            lnk = f'<a href="{it["رابط الملف"]}" style="color:#2F6F7E;">📄</a>' if it.get("رابط الملف","") not in ["","nan"] else "—"
+            rows_html += f'<tr><td style="padding:8px;border-bottom:1px solid #eee;">{it["التوقيت"]}</td><td style="padding:8px;border-bottom:1px solid #eee;">{it["القاعة"]}</td><td style="padding:8px;border-bottom:1px solid #eee;">{it["رقم المذكرة"]}</td><td style="padding:8px;border-bottom:1px solid #eee;">{it["الصفة"]} {lnk}</td></tr>'
+    body = f'''<html dir="rtl"><head><meta charset="UTF-8"><style>body{{font-family:Arial;direction:rtl;background:#f4f4f4;padding:20px}}.c{{background:#fff;padding:28px;border-radius:12px;max-width:700px;margin:auto}}.h{{background:linear-gradient(135deg,#0F2942,#2F6F7E);color:#fff;padding:20px;border-radius:8px;text-align:center;margin-bottom:18px}}table{{width:100%;border-collapse:collapse}}th{{background:#2F6F7E;color:#fff;padding:10px;text-align:right}}</style></head><body><div class="c"><div class="h"><h2>📋 برنامج مناقشاتك</h2><p style="opacity:.9">جامعة محمد البشير الإبراهيمي</p></div><p>الأستاذ(ة) <strong>{prof_name}</strong>، فيما يلي برنامج مناقشاتك: <strong>{len(items)} مناقشة</strong> في <strong>{len(by_day)} يوم</strong>.</p><table><thead><tr><th>التوقيت</th><th>القاعة</th><th>المذكرة</th><th>صفتك</th></tr></thead><tbody>{rows_html}</tbody></table><p style="background:#fff8e1;padding:12px;border-right:4px solid #F59E0B;border-radius:6px;margin-top:16px;">⚠️ يُرجى الحضور قبل الموعد بـ 15 دقيقة.</p><div style="text-align:center;margin:16px 0"><a href="https://memoires2026.streamlit.app" style="background:#2F6F7E;color:#fff;padding:12px 28px;border-radius:8px;text-decoration:none;font-weight:bold">🔗 الدخول للمنصة</a></div></div></body></html>'''
+    return f"📋 برنامج مناقشاتك — {len(items)} مناقشة في {len(by_day)} يوم", body
+
+def _html_message(email, subject, body, pdf_name=None):
+    """رسالة HTML — مع نسخة PDF مرفقة منها إن طُلبت وتوفّر weasyprint"""
+    msg = MIMEMultipart("mixed" if pdf_name else "alternative")
+    msg["From"] = EMAIL_SENDER
+    msg["To"] = email
+    msg["Subject"] = subject
+    msg.attach(MIMEText(body, "html", "utf-8"))
+    if pdf_name:
+        try:
+            from weasyprint import HTML as _WH
+            pdf = MIMEApplication(_WH(string=body).write_pdf(), _subtype="pdf")
+            pdf.add_header("Content-Disposition", "attachment", filename=pdf_name)
+            msg.attach(pdf)
+        except Exception as e:
+            logger.warning(f"تعذّر إنشاء PDF للرسالة ({subject}): {e}")
+    return msg
+
+def _build_prof_schedule_message(email, prof_name, items):
+    subject, body = _render_prof_schedule(prof_name, items)
+    return _html_message(email, subject, body)
+
+def _takleef_item_html(it, lead):
+    """فقرة تكليف واحد بصيغة رسالة التكليف الرسمية"""
+    link = it.get("رابط الملف", "")
+    link_btn = f'<a href="{link}" style="color:#1a3a6b;font-weight:bold;">👁️ معاينة المذكرة</a>' if link and link not in ["","nan"] else ""
+    students = it.get("الطلبة", "")
+    students_label = "الطالبَين" if " — " in students else "الطالب(ة)"
+    return f"""<p>{lead} رقم <strong>{it["رقم المذكرة"]}</strong>، الموسومة بـ:</p>
+<div class="box"><strong>« {it.get("العنوان", "")} »</strong></div>
+<p>من إعداد {students_label}: <strong>{students}</strong><br>
+وتحت إشراف الأستاذ(ة): <strong>{it.get("المشرف", "")}</strong></p>
+<p>وذلك يوم <strong>{it["اليوم"]}</strong> على الساعة <strong>{it["التوقيت"]}</strong> بقاعة <strong>{it["القاعة"]}</strong>،
+بصفتكم <span class="role">{it["الصفة"]}</span></p>
+{f'<p style="margin-top:14px;">{link_btn}</p>' if link_btn else ""}"""
+
+def build_takleef_email(prof_name, items):
+    """رسالة التكليف الرسمية للأستاذ — تكليف واحد، أو عدة تكاليف جديدة بالصيغة نفسها في رسالة واحدة"""
+    if len(items) == 1:
+        title = "📋 برمجة مناقشة مذكرة الماستر"
+        content = _takleef_item_html(items[0], "نُحيطكم علمًا بأنه تمّت برمجة مناقشة مذكرة الماستر")
+    else:
+        title = f"📋 تكاليف جديدة: برمجة مناقشة {len(items)} مذكرات ماستر"
+        content = "<p>نُحيطكم علمًا بأنه تمّت برمجة المناقشات الجديدة التالية:</p>" + '<hr style="border:none;border-top:1px solid #e0e0e0;margin:16px 0">'.join(
+            _takleef_item_html(it, f"{i}. مناقشة مذكرة الماستر") for i, it in enumerate(sorted(items, key=lambda x: (x["اليوم"], x["التوقيت"])), 1))
+    return f"""<!DOCTYPE html><html dir="rtl" lang="ar">
+<head><meta charset="UTF-8"><meta name="viewport" content="width=device-width,initial-scale=1.0">
+<style>body{{font-family:Arial,sans-serif;direction:rtl;background:#f0f4f8;padding:8px}}
+.wrap{{max-width:640px;margin:0 auto;background:#fff;border-radius:12px;overflow:hidden;box-shadow:0 4px 20px rgba(0,0,0,.1)}}
+.hdr{{background:linear-gradient(135deg,#0F2942,#1a3a6b);padding:20px;text-align:center;color:#FFD700;font-size:1.1rem}}
+.bdy{{padding:22px 20px;font-size:0.93rem;color:#333;line-height:1.9}}
+.box{{background:#f8fafc;border-right:4px solid #0F2942;padding:12px 16px;border-radius:8px;margin:14px 0}}
+.role{{display:inline-block;background:#0F2942;color:#FFD700;padding:3px 12px;border-radius:12px;font-size:0.82rem}}
+.ftr{{background:#f4f6f9;padding:12px;text-align:center;font-size:0.78rem;color:#777;border-top:1px solid #e0e0e0}}
+</style></head><body>
+<div class="wrap">
+<div class="hdr">{title}</div>
+<div class="bdy">
+<p>الأستاذ(ة) الفاضل(ة) <strong>{prof_name}</strong>،</p>
+<p>تحية طيبة وبعد،</p>
+{content}
+<p style="margin-top:12px;">🌐 منصة المذكرات: <a href="https://memoires2026.streamlit.app">memoires2026.streamlit.app</a></p>
+<p style="margin-top:18px;color:#1a3a6b;">تقبلوا تحياتي،<br><strong>مسؤول الميدان — البروفيسور رفاف لخضر</strong></p>
+</div>
+<div class="ftr">كلية الحقوق والعلوم السياسية — جامعة محمد البشير الإبراهيمي، برج بوعريريج</div>
+</div></body></html>"""
+
+def _build_assignment_digest_message(email, prof_name, items):
+    """ملخص التكاليف الجديدة فقط — ليس البرنامج الكامل للأستاذ"""
+    if len(items) == 1:
+        subject = f"برمجة مناقشة مذكرة الماستر رقم {items[0]['رقم المذكرة']}"
+    else:
+        subject = f"📬 تكاليف جديدة — برمجة مناقشة {len(items)} مذكرات ماستر"
+    return _html_message(email, subject, build_takleef_email(prof_name, items),
+                         pdf_name=f"تكاليف_المناقشة_{prof_name.replace(' ','_')}.pdf")
+
 def send_prof_schedule_email(prof_name, items, df_profs):
     """إرسال جدول المناقشات لأستاذ"""
     try:
@@ -3109,27 +5014,80 @@ def send_prof_schedule_email(prof_name, items, df_profs):
         if rows.empty: return False, "غير موجود"
         email = get_email_smart(rows.iloc[0])
         if not email or "@" not in email: return False, "لا بريد"
-        by_day = {}
-        for it in sorted(items, key=lambda x: (x["اليوم"], x["التوقيت"])):
-            by_day.setdefault(it["اليوم"], []).append(it)
-        rows_html = ""
-        for day, its in sorted(by_day.items()):
-            rows_html += f'<tr style="background:#e8f4f8;"><td colspan="4" style="padding:8px;font-weight:900;color:#1e3a5f;">📅 {day}</td></tr>'
-            for it in its:
-                lnk = f'<a href="{it["رابط الملف"]}" style="color:#2F6F7E;">📄</a>' if it.get("رابط الملف","") not in ["","nan"] else "—"
-                rows_html += f'<tr><td style="padding:8px;border-bottom:1px solid #eee;">{it["التوقيت"]}</td><td style="padding:8px;border-bottom:1px solid #eee;">{it["القاعة"]}</td><td style="padding:8px;border-bottom:1px solid #eee;">{it["رقم المذكرة"]}</td><td style="padding:8px;border-bottom:1px solid #eee;">{it["الصفة"]} {lnk}</td></tr>'
-        body = f'''<html dir="rtl"><head><meta charset="UTF-8"><style>body{{font-family:Arial;direction:rtl;background:#f4f4f4;padding:20px}}.c{{background:#fff;padding:28px;border-radius:12px;max-width:700px;margin:auto}}.h{{background:linear-gradient(135deg,#0F2942,#2F6F7E);color:#fff;padding:20px;border-radius:8px;text-align:center;margin-bottom:18px}}table{{width:100%;border-collapse:collapse}}th{{background:#2F6F7E;color:#fff;padding:10px;text-align:right}}</style></head><body><div class="c"><div class="h"><h2>📋 برنامج مناقشاتك</h2><p style="opacity:.9">جامعة محمد البشير الإبراهيمي</p></div><p>الأستاذ(ة) <strong>{prof_name}</strong>، فيما يلي برنامج مناقشاتك: <strong>{len(items)} مناقشة</strong> في <strong>{len(by_day)} يوم</strong>.</p><table><thead><tr><th>التوقيت</th><th>القاعة</th><th>المذكرة</th><th>صفتك</th></tr></thead><tbody>{rows_html}</tbody></table><p style="background:#fff8e1;padding:12px;border-right:4px solid #F59E0B;border-radius:6px;margin-top:16px;">⚠️ يُرجى الحضور قبل الموعد بـ 15 دقيقة.</p><div style="text-align:center;margin:16px 0"><a href="https://memoires2026.streamlit.app" style="background:#2F6F7E;color:#fff;padding:12px 28px;border-radius:8px;text-decoration:none;font-weight:bold">🔗 الدخول للمنصة</a></div></div></body></html>'''
-        msg = MIMEMultipart("alternative")
-        msg["From"] = EMAIL_SENDER
-        msg["To"] = email
-        msg["Subject"] = f"📋 برنامج مناقشاتك — {len(items)} مناقشة في {len(by_day)} يوم"
-        msg.attach(MIMEText(body, "html", "utf-8"))
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as s:
-            s.starttls(); s.login(EMAIL_SENDER, EMAIL_PASSWORD); s.send_message(msg)
+        send_email(_build_prof_schedule_message(email, prof_name, items), template="prof_schedule")
+        # البرنامج الكامل يغني عن تكاليف نفس المذكرات المنتظرة في الملخص
+        drop_digest_items(email, [it["رقم المذكرة"] for it in items])
         return True, f"✅ {email}"
     except Exception as e:
         return False, f"❌ {str(e)}"
 
+# ── ملخص التكاليف: كل تكاليف الأستاذ خلال مدة معيّنة في رسالة واحدة ──
+DIGEST_WINDOW = 15 * 60   # ثوانٍ — أول تكليف ينتظر هذه المدة ليجتمع مع ما يليه
+DIGEST_RETRY_BASE = 60    # ثوانٍ — تتضاعف مع كل فشل في إعداد ملخص أستاذ
+DIGEST_MAX_ATTEMPTS = 5   # بعدها ينتظر الملخص الإرسال اليدوي من الإدارة
+
+def _digest_db():
+    conn = _outbox_db()
+    # (المستلم، المذكرة، الصفة) مفتاح: تعديل نفس التكليف قبل الإرسال يستبدله
+    conn.execute("CREATE TABLE IF NOT EXISTS assignment_digest (recipient TEXT, prof_name TEXT, memo TEXT, role TEXT, item TEXT, queued_at REAL, PRIMARY KEY (recipient, memo, role))")
+    add_missing_columns(conn, "assignment_digest", (("attempts", "INTEGER DEFAULT 0"), ("next_attempt_at", "REAL"), ("last_error", "TEXT")))
+    return conn
+
+def queue_assignment_digest(prof_name, email, item):
+    """إضافة تكليف (بصيغة عناصر برنامج المناقشات) إلى ملخص الأستاذ القادم"""
+    with _digest_db() as conn:
+        conn.execute("INSERT OR REPLACE INTO assignment_digest (recipient, prof_name, memo, role, item, queued_at) VALUES (?,?,?,?,?,?)",
+                     (email, prof_name, str(item["رقم المذكرة"]), item["الصفة"], json.dumps(item, ensure_ascii=False), time_module.time()))
+    get_outbox()._ensure_dispatcher()
+
+def drop_digest_items(email, memos):
+    try:
+        with _digest_db() as conn:
+            conn.executemany("DELETE FROM assignment_digest WHERE recipient=? AND memo=?", [(email, str(m)) for m in memos])
+    except Exception as e:
+        logger.warning(f"تعذّر تحديث الملخص: {e}")
+
+def pending_digest_count():
+    """(عدد التكاليف المنتظرة، عدد الأساتذة، عدد الأساتذة الذين استنفد ملخصهم المحاولات)"""
+    try:
+        with _digest_db() as conn:
+            n, profs = conn.execute("SELECT COUNT(*), COUNT(DISTINCT recipient) FROM assignment_digest").fetchone()
+            failed = conn.execute("SELECT COUNT(DISTINCT recipient) FROM assignment_digest WHERE attempts>=?", (DIGEST_MAX_ATTEMPTS,)).fetchone()[0]
+        return n, profs, failed
+    except Exception: return 0, 0, 0
+
+def flush_assignment_digests(force=False):
+    """إرسال ملخص لكل أستاذ مضى على أقدم تكليف له DIGEST_WINDOW (أو للجميع مع force) → عدد الرسائل.
+    فشل ملخص أستاذ لا يوقف الباقين: يُؤجَّل بـ backoff، وبعد DIGEST_MAX_ATTEMPTS لا يُرسل إلا مع force"""
+    now = time_module.time()
+    cutoff = now - (0 if force else DIGEST_WINDOW)
+    with _digest_db() as conn:
+        rows = conn.execute("SELECT recipient, prof_name, item, queued_at FROM assignment_digest WHERE recipient IN "
+                            "(SELECT recipient FROM assignment_digest GROUP BY recipient HAVING MIN(queued_at) <= ? "
+                            "AND (? OR (MAX(attempts) < ? AND COALESCE(MAX(next_attempt_at), 0) <= ?)))",
+                            (cutoff, force, DIGEST_MAX_ATTEMPTS, now)).fetchall()
+    by_recipient = {}
+    for email, prof_name, item, queued_at in rows:
+        by_recipient.setdefault((email, prof_name), []).append((json.loads(item), queued_at))
+    sent = 0
+    for (email, prof_name), entries in by_recipient.items():
+        try:
+            send_email(_build_assignment_digest_message(email, prof_name, [it for it, _ in entries]), template="assignment_digest")
+        except Exception as e:
+            with _digest_db() as conn:
+                attempts = conn.execute("SELECT MAX(attempts) FROM assignment_digest WHERE recipient=?", (email,)).fetchone()[0] or 0
+                attempts = 1 if force else attempts + 1
+                conn.execute("UPDATE assignment_digest SET attempts=?, next_attempt_at=?, last_error=? WHERE recipient=?",
+                             (attempts, time_module.time() + DIGEST_RETRY_BASE * 2 ** attempts, str(e)[:300], email))
+            logger.error(f"تعذّر إعداد ملخص التكاليف لـ {prof_name} (محاولة {attempts}): {e}")
+            continue
+        with _digest_db() as conn:
+            # تكاليف أُضيفت أو عُدّلت أثناء الإرسال تبقى للملخص القادم
+            conn.executemany("DELETE FROM assignment_digest WHERE recipient=? AND memo=? AND role=? AND queued_at=?",
+                             [(email, str(it["رقم المذكرة"]), it["الصفة"], q) for it, q in entries])
+        sent += 1
+    return sent
+
 def send_student_schedule_email(student_data, memo_num, defense_date, defense_time, defense_room):
     """إرسال موعد المناقشة للطالب"""
     try:
@@ -3143,8 +5101,7 @@ def send_student_schedule_email(student_data, memo_num, defense_date, defense_ti
         msg["To"] = email
         msg["Subject"] = f"📅 موعد مناقشتك — {defense_date} الساعة {defense_time}"
         msg.attach(MIMEText(body, "html", "utf-8"))
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as s:
-            s.starttls(); s.login(EMAIL_SENDER, EMAIL_PASSWORD); s.send_message(msg)
+        send_email(msg, template="student_schedule", memo=memo_num)
         return True, f"✅ {email}"
     except Exception as e:
         return False, f"❌ {str(e)}"
@@ -3154,19 +5111,11 @@ def save_member_observations(memo_number, prof_name, role, observations):
     col_map = {"مشرف":"Z","رئيس لجنة":"AE","مناقش":"AF"}
     col = col_map.get(role, "AE")
     try:
-        df_m = load_memos()
-        row = df_m[df_m["رقم المذكرة"].astype(str).apply(normalize_text)==normalize_text(memo_number)]
-        if row.empty: return False, "❌ غير موجودة"
-        row_idx = row.index[0] + 2
+        row_idx = get_repository().memo_row(memo_number)
+        if row_idx is None: return False, "❌ غير موجودة"
         ts = datetime.now().strftime("%Y-%m-%d %H:%M")
         obs_full = f"[{prof_name}—{role}][{ts}]: {observations}"
-        sheets_service.spreadsheets().values().update(
-            spreadsheetId=MEMOS_SHEET_ID,
-            range=f"Feuille 1!{col}{row_idx}",
-            valueInputOption="USER_ENTERED",
-            body={"values": [[obs_full]]}
-        ).execute()
-        clear_cache_and_reload()
+        write_cells(MEMOS_SHEET_ID, [{"range": f"Feuille 1!{col}{row_idx}", "values": [[obs_full]]}])
         return True, "✅ تم حفظ الملاحظات"
     except Exception as e:
         return False, f"❌ {str(e)}"
@@ -3174,17 +5123,9 @@ def save_member_observations(memo_number, prof_name, role, observations):
 def clear_missing_flag(memo_number):
     """إزالة علامة المفقودة"""
     try:
-        df_memos = load_memos()
-        row = df_memos[df_memos["رقم المذكرة"].astype(str).apply(normalize_text)==normalize_text(memo_number)]
-        if row.empty: return False
-        row_idx = row.index[0] + 2
-        sheets_service.spreadsheets().values().update(
-            spreadsheetId=MEMOS_SHEET_ID,
-            range=f"Feuille 1!AH{row_idx}",
-            valueInputOption="USER_ENTERED",
-            body={"values": [["0"]]}
-        ).execute()
-        clear_cache_and_reload()
+        row_idx = get_repository().memo_row(memo_number)
+        if row_idx is None: return False
+        write_cells(MEMOS_SHEET_ID, [{"range": f"Feuille 1!AH{row_idx}", "values": [["0"]]}])
         return True
     except: return False
 
@@ -3198,8 +5139,7 @@ def send_recovery_email_to_admin(memo_number, memo_title, student1_name, student
         msg["To"] = EMAIL_SENDER
         msg["Subject"] = f"✅ استرجاع مذكرة — رقم {memo_number}"
         msg.attach(MIMEText(body, "html", "utf-8"))
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls(); server.login(EMAIL_SENDER, EMAIL_PASSWORD); server.send_message(msg)
+        send_email(msg, template="recovery", memo=memo_number)
         return True, "✅"
     except Exception as e:
         return False, f"❌ {str(e)}"
@@ -3329,10 +5269,7 @@ body {{ font-family: Arial, sans-serif; direction: rtl; text-align: right; backg
         msg["To"] = email
         msg["Subject"] = "🎓 لجان مناقشة مذكرات الماستر — انطلاق المناقشات 31 ماي 2026"
         msg.attach(MIMEText(body, "html", "utf-8"))
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls()
-            server.login(EMAIL_SENDER, EMAIL_PASSWORD)
-            server.send_message(msg)
+        send_email(msg, template="jury_notification")
         return True, f"✅ {email}"
     except Exception as e:
         return False, f"❌ {str(e)}"
@@ -3342,11 +5279,7 @@ body {{ font-family: Arial, sans-serif; direction: rtl; text-align: right; backg
 def load_memo_exceptions():
     """قراءة استثناءات المذكرات من الشيت"""
     try:
-        result = sheets_service.spreadsheets().values().get(
-            spreadsheetId=MEMOS_SHEET_ID,
-            range="استثناءات_مذكرات!A1:G1000"
-        ).execute()
-        values = result.get('values', [])
+        values = get_sheet_values(MEMOS_SHEET_ID, MEMO_EXC_RANGE)
         if not values or len(values) < 2: return pd.DataFrame()
         headers = values[0]
         rows = values[1:]
@@ -3360,11 +5293,7 @@ def load_memo_exceptions():
 def load_prof_exceptions():
     """قراءة استثناءات الأساتذة من الشيت"""
     try:
-        result = sheets_service.spreadsheets().values().get(
-            spreadsheetId=MEMOS_SHEET_ID,
-            range="استثناءات_أساتذة!A1:L1000"
-        ).execute()
-        values = result.get('values', [])
+        values = get_sheet_values(MEMOS_SHEET_ID, PROF_EXC_RANGE)
         if not values or len(values) < 2: return pd.DataFrame()
         headers = values[0]
         rows = values[1:]
@@ -3386,13 +5315,13 @@ def save_memo_exception(row_data):
             str(row_data.get("أبعد تاريخ","")),
             str(row_data.get("أيام بديلة",""))
         ]]
-        sheets_service.spreadsheets().values().append(
+        api_execute(sheets_service.spreadsheets().values().append(
             spreadsheetId=MEMOS_SHEET_ID,
             range="استثناءات_مذكرات!A:G",
             valueInputOption="USER_ENTERED",
             insertDataOption="INSERT_ROWS",
             body={"values": values}
-        ).execute()
+        ), idempotent=False)
         return True
     except Exception as e:
         return False
@@ -3414,13 +5343,13 @@ def save_prof_exception(row_data):
             str(row_data.get("يقبل 18:00","")),
             str(row_data.get("تجميع الأيام",""))
         ]]
-        sheets_service.spreadsheets().values().append(
+        api_execute(sheets_service.spreadsheets().values().append(
             spreadsheetId=MEMOS_SHEET_ID,
             range="استثناءات_أساتذة!A:L",
             valueInputOption="USER_ENTERED",
             insertDataOption="INSERT_ROWS",
             body={"values": values}
-        ).execute()
+        ), idempotent=False)
         return True
     except Exception as e:
         return False
@@ -3429,10 +5358,10 @@ def delete_exception_row(sheet_name, row_idx):
     """حذف استثناء من الشيت"""
     try:
         # نحذف بكتابة صفوف فارغة
-        sheets_service.spreadsheets().values().clear(
+        api_execute(sheets_service.spreadsheets().values().clear(
             spreadsheetId=MEMOS_SHEET_ID,
             range=f"{sheet_name}!A{row_idx}:F{row_idx}"
-        ).execute()
+        ))
         return True
     except: return False
 
@@ -3616,11 +5545,7 @@ def detect_constraint_conflicts(df_memos, fixed_slots, memo_date_limits, prof_ba
 def load_schedule_days():
     """قراءة أيام الجدولة من الشيت"""
     try:
-        result = sheets_service.spreadsheets().values().get(
-            spreadsheetId=MEMOS_SHEET_ID,
-            range="الأيام!A1:D1000"
-        ).execute()
-        values = result.get('values', [])
+        values = get_sheet_values(MEMOS_SHEET_ID, DAYS_RANGE)
         if not values or len(values) < 2: return [], {}
         headers = values[0]
         days = []
@@ -3645,11 +5570,7 @@ def load_schedule_days():
 def load_schedule_slots():
     """قراءة التوقيتات من الشيت"""
     try:
-        result = sheets_service.spreadsheets().values().get(
-            spreadsheetId=MEMOS_SHEET_ID,
-            range="التوقيت!A1:A100"
-        ).execute()
-        values = result.get('values', [])
+        values = get_sheet_values(MEMOS_SHEET_ID, SLOTS_RANGE)
         slots = [row[0].strip() for row in values[1:] if row and row[0].strip()]
         return slots
     except Exception as e:
@@ -3660,11 +5581,7 @@ def load_schedule_slots():
 def load_schedule_rooms():
     """قراءة القاعات من الشيت"""
     try:
-        result = sheets_service.spreadsheets().values().get(
-            spreadsheetId=MEMOS_SHEET_ID,
-            range="القاعات!A1:A100"
-        ).execute()
-        values = result.get('values', [])
+        values = get_sheet_values(MEMOS_SHEET_ID, ROOMS_RANGE)
         rooms = [row[0].strip() for row in values[1:] if row and row[0].strip()]
         return rooms
     except Exception as e:
@@ -3981,6 +5898,9 @@ def logout():
     st.rerun()
 
 
+apply_snapshot_updates()
+render_data_freshness_banner()
+
 # ================================================================
 # الصفحة الرئيسية
 # ================================================================
@@ -4159,7 +6079,7 @@ elif st.session_state.user_type == "student":
                                 s2_pass=student2_obj if registration_type=="ثنائية" else None
                                 ok,msg=update_registration(st.session_state.note_number,s1,s2_pass,st.session_state.s2_phone_input,st.session_state.s2_nin_input)
                             if ok:
-                                st.success(msg); st.balloons(); clear_cache_and_reload()
+                                st.success(msg); st.balloons()
                                 st.session_state.mode="view"; st.session_state.show_confirmation=False
                                 time_module.sleep(2); st.rerun()
                             else: st.error(msg); st.session_state.show_confirmation=False
@@ -4233,7 +6153,14 @@ elif st.session_state.user_type == "student":
 
             # ── ملاحظات المشرف (تظهر دائماً) ──
           # العمود Z يظهر فقط عند الرفض في الإشعارات
-            if is_missing:
+            _dep_job = get_upload_queue().latest_job(note_num)
+            _dep_job_active = _dep_job is not None and _dep_job["status"] in ("pending", "uploading")
+            # المهمة الفاشلة لا تمنع رفع ملف جديد: يظهر زر إعادة المحاولة ونموذج الرفع معاً
+            if _dep_job is not None and _dep_job["status"] == "failed":
+                render_deposit_job_status(_dep_job)
+            if _dep_job_active:
+                render_deposit_job_status(_dep_job)
+            elif is_missing:
                 st.markdown("""
                 <div style="background:linear-gradient(135deg,#1a0a0a,#3d0f0f);border:4px solid #EF4444;
                             border-radius:24px;padding:48px 36px;margin-bottom:28px;text-align:center;
@@ -4268,37 +6195,31 @@ elif st.session_state.user_type == "student":
                         st.error("❌ الملف ليس PDF حقيقياً")
                     else:
                         if st.button("📤 إعادة رفع المذكرة", type="primary", use_container_width=True, key="btn_recovery_upload"):
-                            with st.spinner("⏳ جاري رفع الملف..."):
-                                ok, link, msg = upload_memo_to_drive(rec_bytes, note_num, memo_info["عنوان المذكرة"])
-                                if ok:
-                                    s, m = save_memo_deposit(note_num, link)
-                                    if s:
-                                        clear_missing_flag(note_num)
-                                        # إيميل للإدارة فقط
-                                        s1_ln, s1_fn = get_student_name_display(st.session_state.student1)
-                                        s1_display = f"{s1_ln} {s1_fn}".strip()
-                                        s2_display = ""
-                                        s2_obj = load_student2_for_memo(memo_info, normalize_text(st.session_state.student1.get("رقم التسجيل","")), load_students())
-                                        if s2_obj:
-                                            s2l, s2f = get_student_name_display(s2_obj)
-                                            s2_display = f"{s2l} {s2f}".strip()
-                                        send_recovery_email_to_admin(note_num, memo_info["عنوان المذكرة"], s1_display, s2_display)
-                                        st.success("✅ تمت إعادة رفع مذكرتك بنجاح!")
-                                        st.balloons()
-                                        clear_cache_and_reload()
-                                        time_module.sleep(2)
-                                        st.rerun()
-                                    else:
-                                        st.error(m)
-                                else:
-                                    st.error(msg)
+                            # إيميل للإدارة فقط — يُرسل بعد اكتمال الرفع
+                            s1_ln, s1_fn = get_student_name_display(st.session_state.student1)
+                            s1_display = f"{s1_ln} {s1_fn}".strip()
+                            s2_display = ""
+                            s2_obj = load_student2_for_memo(memo_info, normalize_text(st.session_state.student1.get("رقم التسجيل","")), load_students())
+                            if s2_obj:
+                                s2l, s2f = get_student_name_display(s2_obj)
+                                s2_display = f"{s2l} {s2f}".strip()
+                            # علامة المفقودة (AH) تُزال مع تحديث الإيداع بعد اكتمال الرفع
+                            s, m = submit_memo_deposit(rec_bytes, note_num, memo_info["عنوان المذكرة"], extra_columns={"AH": "0"},
+                                                       notify={"kind": "recovery", "args": [note_num, memo_info["عنوان المذكرة"], s1_display, s2_display]})
+                            if s:
+                                st.success("✅ تم استلام مذكرتك! جاري رفعها في الخلفية.")
+                                st.balloons()
+                                time_module.sleep(2)
+                                st.rerun()
+                            else:
+                                st.error(m)
 
             elif deposit_status == "مرفوضة":
                 rejection_raw = str(memo_info.get("توقيع المشرف","")).strip()
                 reason_display = rejection_raw.split("السبب:")[-1].strip() if "السبب:" in rejection_raw else "يرجى مراجعة المشرف."
                 st.markdown(f"""<div class="notif-card notif-card-rejected"><div class="notif-icon">🔴</div><div><div class="notif-title notif-title-rejected">المذكرة بحاجة لمراجعة</div><div class="notif-desc"><strong>ملاحظات المشرف:</strong><br>{reason_display}</div></div></div>""", unsafe_allow_html=True)
 
-            if deposit_status in ["", "nan", "مرفوضة"] or not deposit_status:
+            if not _dep_job_active and (deposit_status in ["", "nan", "مرفوضة"] or not deposit_status):
                 deadline_passed = datetime.now() > DEPOSIT_DEADLINE
                 if deadline_passed and not is_extended:
                     st.markdown("""
@@ -4327,24 +6248,20 @@ elif st.session_state.user_type == "student":
                         elif pdf_bytes[:4] != b'%PDF': st.error("❌ الملف ليس PDF حقيقياً — تأكد من الملف")
                         else:
                             if st.button("📤 إيداع المذكرة الآن", type="primary", use_container_width=True):
-                                with st.spinner("⏳ جاري رفع الملف..."):
-                                    ok, link, msg = upload_memo_to_drive(pdf_bytes, note_num, memo_info['عنوان المذكرة'])
-                                    if ok:
-                                        s, m = save_memo_deposit(note_num, link)
-                                        if s:
-                                            s1_ln,s1_fn = get_student_name_display(st.session_state.student1)
-                                            s1_display = f"{s1_ln} {s1_fn}".strip()
-                                            s2_display = ""
-                                            s2_obj_dep = load_student2_for_memo(memo_info, normalize_text(st.session_state.student1.get('رقم التسجيل','')), load_students())
-                                            if s2_obj_dep:
-                                                s2l,s2f = get_student_name_display(s2_obj_dep); s2_display=f"{s2l} {s2f}".strip()
-                                            email_ok, email_msg = send_deposit_email_to_professor(prof_name_m, note_num, memo_info['عنوان المذكرة'], s1_display, s2_display)
-                                            st.success("✅ تم إيداع مذكرتك! سيراجعها المشرف قريباً.")
-                                            if email_ok: st.info("📧 تم إرسال إشعار للمشرف والإدارة.")
-                                            else: st.warning(f"⚠️ فشل إرسال الإيميل للمشرف: {email_msg}")
-                                            st.balloons(); clear_cache_and_reload(); time_module.sleep(2); st.rerun()
-                                        else: st.error(m)
-                                    else: st.error(msg)
+                                s1_ln,s1_fn = get_student_name_display(st.session_state.student1)
+                                s1_display = f"{s1_ln} {s1_fn}".strip()
+                                s2_display = ""
+                                s2_obj_dep = load_student2_for_memo(memo_info, normalize_text(st.session_state.student1.get('رقم التسجيل','')), load_students())
+                                if s2_obj_dep:
+                                    s2l,s2f = get_student_name_display(s2_obj_dep); s2_display=f"{s2l} {s2f}".strip()
+                                # إشعار المشرف والإدارة يُرسل بعد اكتمال الرفع وتحديث الشيت
+                                s, m = submit_memo_deposit(pdf_bytes, note_num, memo_info['عنوان المذكرة'],
+                                                           notify={"kind": "deposit", "args": [prof_name_m, note_num, memo_info['عنوان المذكرة'], s1_display, s2_display]})
+                                if s:
+                                    st.success("✅ تم استلام مذكرتك! يتم رفعها الآن وسيراجعها المشرف قريباً.")
+                                    st.info("📧 سيُرسل إشعار للمشرف والإدارة فور اكتمال الرفع.")
+                                    st.balloons(); time_module.sleep(2); st.rerun()
+                                else: st.error(m)
             elif deposit_status == "مودعة" and not is_missing and not is_extended:
                 st.markdown("""<div class="notif-card notif-card-waiting"><div class="notif-icon">🟡</div><div><div class="notif-title notif-title-waiting">مذكرتك مودعة — في انتظار مراجعة المشرف</div><div class="notif-desc">تم استلام ملفك. سيراجعه المشرف ويوافق أو يرسل ملاحظاته. ستتلقى إشعاراً فور اتخاذ القرار.</div></div></div>""", unsafe_allow_html=True)
                 if deposit_date and deposit_date not in ["","nan"]: st.caption(f"📅 تاريخ الإيداع: {deposit_date}")
@@ -4419,25 +6336,19 @@ elif st.session_state.user_type == "student":
                                 st.error("❌ يجب رفع الملفين معاً")
                             else:
                                 with st.spinner("⏳ جاري الرفع..."):
-                                    _ok1,_l1 = upload_to_drive(_upl_pdf_i.read(), f"مذكرة_نهائية_{_mid_i}.pdf", IDAA_FOLDER_ID, "application/pdf")
-                                    _ok2,_l2 = upload_to_drive(_upl_wrd_i.read(), f"ملخص_{_mid_i}.docx", IDAA_FOLDER_ID, "application/vnd.openxmlformats-officedocument.wordprocessingml.document")
+                                    # الملفان يُرفعان ثم يُشاركان في طلب واحد
+                                    (_ok1,_l1), (_ok2,_l2) = upload_files_to_drive([
+                                        (_upl_pdf_i.read(), f"مذكرة_نهائية_{_mid_i}.pdf", "application/pdf"),
+                                        (_upl_wrd_i.read(), f"ملخص_{_mid_i}.docx", "application/vnd.openxmlformats-officedocument.wordprocessingml.document"),
+                                    ], IDAA_FOLDER_ID)
                                     if _ok1 and _ok2:
-                                        _all_mi=load_memos(); _rni=None
-                                        for _ii,(_, _rri) in enumerate(_all_mi.iterrows()):
-                                            _mki=str(_rri.get("رقم المذكرة","")).strip()
-                                            try: _mki=str(int(float(_mki)))
-                                            except: pass
-                                            if _mki==str(int(float(_mid_i))): _rni=_ii+2; break
+                                        _rni=get_repository().memo_row(_mid_i)
                                         if _rni:
-                                            sheets_service.spreadsheets().values().batchUpdate(
-                                                spreadsheetId=MEMOS_SHEET_ID,
-                                                body={"valueInputOption":"USER_ENTERED","data":[
-                                                    {"range":f"Feuille 1!AQ{_rni}","values":[[_l1]]},
-                                                    {"range":f"Feuille 1!AR{_rni}","values":[[_l2]]},
-                                                    {"range":f"Feuille 1!AV{_rni}","values":[[_dti_idaa.datetime.now().strftime("%Y-%m-%d")]]},
-                                                ]}
-                                            ).execute()
-                                            clear_cache_and_reload()
+                                            write_cells(MEMOS_SHEET_ID, [
+                                                {"range":f"Feuille 1!AQ{_rni}","values":[[_l1]]},
+                                                {"range":f"Feuille 1!AR{_rni}","values":[[_l2]]},
+                                                {"range":f"Feuille 1!AV{_rni}","values":[[_dti_idaa.datetime.now().strftime("%Y-%m-%d")]]},
+                                            ])
                                             st.success("✅ تم الإيداع — في انتظار موافقة المشرف"); st.rerun()
                                     else:
                                         if not _ok1: st.error(f"❌ {_l1}")
@@ -4655,7 +6566,7 @@ elif st.session_state.user_type == "professor":
                                         for k in [f"confirm_step_{memo_id}",f"sig_value_{memo_id}",f"pages_value_{memo_id}"]: st.session_state.pop(k,None)
                                         st.session_state['prof_action']=None
                                         st.success("✅ تمت الموافقة وحُفظ التصريح. تم إشعار الطلبة.")
-                                        st.balloons(); clear_cache_and_reload(); time_module.sleep(2); st.rerun()
+                                        st.balloons(); time_module.sleep(2); st.rerun()
                                     else: st.error(msg)
                     with col_cancel:
                         if st.button("إلغاء",use_container_width=True,key=f"cancel_ap_{memo_id}"):
@@ -5041,20 +6952,11 @@ elif st.session_state.user_type == "professor":
                                 with _c2_dh:
                                     if _at_dh != "نعم":
                                         if st.button("✅ أوافق", key=f"ap_dh_{_mid_dh}", use_container_width=True):
-                                            _all_dh=load_memos(); _rn_dh=None
-                                            for _ii_dh,(_, _rr_dh) in enumerate(_all_dh.iterrows()):
-                                                _mk_dh=str(_rr_dh.get("رقم المذكرة","")).strip()
-                                                try: _mk_dh=str(int(float(_mk_dh)))
-                                                except: pass
-                                                if _mk_dh==str(int(float(_mid_dh))): _rn_dh=_ii_dh+2; break
+                                            _rn_dh=get_repository().memo_row(_mid_dh)
                                             if _rn_dh:
-                                                sheets_service.spreadsheets().values().batchUpdate(
-                                                    spreadsheetId=MEMOS_SHEET_ID,
-                                                    body={"valueInputOption":"USER_ENTERED","data":[
-                                                        {"range":f"Feuille 1!AT{_rn_dh}","values":[["نعم"]]}
-                                                    ]}
-                                                ).execute()
-                                                clear_cache_and_reload()
+                                                write_cells(MEMOS_SHEET_ID, [
+                                                    {"range":f"Feuille 1!AT{_rn_dh}","values":[["نعم"]]}
+                                                ])
                                                 st.success(f"✅ موافقة رئيس القسم على مذكرة {_mid_dh}"); st.rerun()
 
                     if jrole == "مشرف":
@@ -5075,40 +6977,22 @@ elif st.session_state.user_type == "professor":
                                         _bc1,_bc2 = st.columns(2)
                                         with _bc1:
                                             if st.button("✅ أوافق", key=f"ap_sup_{_mid_ap}", use_container_width=True):
-                                                _all_map=load_memos(); _rn_ap=None
-                                                for _ii_ap,(_, _rr_ap) in enumerate(_all_map.iterrows()):
-                                                    _mk_ap=str(_rr_ap.get("رقم المذكرة","")).strip()
-                                                    try: _mk_ap=str(int(float(_mk_ap)))
-                                                    except: pass
-                                                    if _mk_ap==str(int(float(_mid_ap))): _rn_ap=_ii_ap+2; break
+                                                _rn_ap=get_repository().memo_row(_mid_ap)
                                                 if _rn_ap:
-                                                    sheets_service.spreadsheets().values().batchUpdate(
-                                                        spreadsheetId=MEMOS_SHEET_ID,
-                                                        body={"valueInputOption":"USER_ENTERED","data":[
-                                                            {"range":f"Feuille 1!AS{_rn_ap}","values":[["نعم"]]}
-                                                        ]}
-                                                    ).execute()
-                                                    clear_cache_and_reload()
+                                                    write_cells(MEMOS_SHEET_ID, [
+                                                        {"range":f"Feuille 1!AS{_rn_ap}","values":[["نعم"]]}
+                                                    ])
                                                     st.success(f"✅ تمت الموافقة على مذكرة {_mid_ap}")
                                                     st.rerun()
                                         with _bc2:
                                             if st.button("❌ أرفض", key=f"rj_sup_{_mid_ap}", use_container_width=True):
-                                                _all_map2=load_memos(); _rn_ap2=None
-                                                for _ii_ap2,(_, _rr_ap2) in enumerate(_all_map2.iterrows()):
-                                                    _mk_ap2=str(_rr_ap2.get("رقم المذكرة","")).strip()
-                                                    try: _mk_ap2=str(int(float(_mk_ap2)))
-                                                    except: pass
-                                                    if _mk_ap2==str(int(float(_mid_ap))): _rn_ap2=_ii_ap2+2; break
+                                                _rn_ap2=get_repository().memo_row(_mid_ap)
                                                 if _rn_ap2:
-                                                    sheets_service.spreadsheets().values().batchUpdate(
-                                                        spreadsheetId=MEMOS_SHEET_ID,
-                                                        body={"valueInputOption":"USER_ENTERED","data":[
-                                                            {"range":f"Feuille 1!AS{_rn_ap2}","values":[["لا"]]},
-                                                            {"range":f"Feuille 1!AQ{_rn_ap2}","values":[[""]]},
-                                                            {"range":f"Feuille 1!AR{_rn_ap2}","values":[[""]]}
-                                                        ]}
-                                                    ).execute()
-                                                    clear_cache_and_reload()
+                                                    write_cells(MEMOS_SHEET_ID, [
+                                                        {"range":f"Feuille 1!AS{_rn_ap2}","values":[["لا"]]},
+                                                        {"range":f"Feuille 1!AQ{_rn_ap2}","values":[[""]]},
+                                                        {"range":f"Feuille 1!AR{_rn_ap2}","values":[[""]]}
+                                                    ])
                                                     st.warning(f"❌ رُفض إيداع مذكرة {_mid_ap} — سيُعاد فتح الرفع للطالب")
                                                     st.rerun()
 
@@ -5275,6 +7159,35 @@ elif st.session_state.user_type == "admin":
             if st.button("خروج"): logout()
         if not st.session_state.get("is_library", False):
             st.header("📊 لوحة تحكم الإدارة")
+            _sync_pending, _sync_conflicts, _sync_dead = get_sync_queue().status()
+            if _sync_pending or _sync_conflicts:
+                st.caption(f"🔁 {_sync_pending} تحديث في انتظار المزامنة مع Google Sheets" + (f" | ⚠️ {_sync_conflicts} تعارض (احتُفظ بقيمة الشيت)" if _sync_conflicts else ""))
+            if _sync_dead:
+                with st.expander(f"❌ {_sync_dead} تحديث تعذّرت مزامنته بعد {SYNC_MAX_ATTEMPTS} محاولات"):
+                    _dead_rows = get_sync_queue().dead_letters()
+                    st.dataframe(pd.DataFrame([{"الخلية": rng, "القيمة": val, "المحاولات": n, "آخر خطأ": err} for _, _, rng, val, err, n in _dead_rows]),
+                                 use_container_width=True, hide_index=True)
+                    _dc1, _dc2 = st.columns(2)
+                    if _dc1.button("🔁 إعادة المحاولة", use_container_width=True, key="sync_dead_retry"):
+                        get_sync_queue().requeue_dead([r[0] for r in _dead_rows]); st.rerun()
+                    if _dc2.button("🗑️ تجاهلها", use_container_width=True, key="sync_dead_discard"):
+                        get_sync_queue().discard_dead([r[0] for r in _dead_rows]); st.rerun()
+            _uploads = get_upload_queue().status()
+            _saved_mb = get_upload_queue().bytes_saved() / 1048576
+            _mail = get_outbox().status()
+            _uploads_waiting = _uploads.get("pending", 0) + _uploads.get("uploading", 0)
+            if _uploads_waiting or _uploads.get("failed"):
+                st.caption(f"📤 {_uploads_waiting} إيداع قيد الرفع إلى Drive" + (f" | ❌ {_uploads['failed']} فشل رفعه" if _uploads.get("failed") else ""))
+            if _saved_mb >= 1:
+                st.caption(f"🗜️ ضغط ملفات PDF وفّر {_saved_mb:.0f} MB من الرفع والتخزين على Drive")
+            if _mail.get("pending") or _mail.get("failed"):
+                st.caption(f"✉️ {_mail.get('pending', 0)} رسالة في صندوق الصادر | ✅ {_mail.get('sent', 0)} أُرسلت" + (f" | ⏭️ {_mail['skipped']} مكررة تُخطيت" if _mail.get("skipped") else "") + (f" | ❌ {_mail['failed']} فشلت" if _mail.get("failed") else ""))
+            if _mail.get("failed"):
+                with st.expander(f"❌ رسائل فشل إرسالها ({_mail['failed']})"):
+                    for _rid, _to, _subj, _err in get_outbox().failures():
+                        st.caption(f"#{_rid} — {_to} — {_subj} — {_err}")
+                    if st.button("🔁 إعادة إرسال الرسائل الفاشلة", key="outbox_retry_failed"):
+                        st.success(f"✅ أُعيدت {get_outbox().retry_failed()} رسالة إلى الطابور"); st.rerun()
     
             st.markdown("<br>", unsafe_allow_html=True)
             df_prof_memos = load_prof_memos()
@@ -5359,20 +7272,11 @@ elif st.session_state.user_type == "admin":
                         else:
                             if st.button("✅ منح تبرئة المكتبة", type="primary", key=f"lib_{_lmid}", use_container_width=True):
                                 with st.spinner("⏳ جاري الحفظ..."):
-                                    _all_lib=load_memos(); _rn_lib=None
-                                    for _il,(_, _rl) in enumerate(_all_lib.iterrows()):
-                                        _mkl=str(_rl.get("رقم المذكرة","")).strip()
-                                        try: _mkl=str(int(float(_mkl)))
-                                        except: pass
-                                        if _mkl==str(int(float(_lmid))): _rn_lib=_il+2; break
+                                    _rn_lib=get_repository().memo_row(_lmid)
                                     if _rn_lib:
-                                        sheets_service.spreadsheets().values().batchUpdate(
-                                            spreadsheetId=MEMOS_SHEET_ID,
-                                            body={"valueInputOption":"USER_ENTERED","data":[
-                                                {"range":f"Feuille 1!AU{_rn_lib}","values":[["نعم"]]}
-                                            ]}
-                                        ).execute()
-                                        clear_cache_and_reload()
+                                        write_cells(MEMOS_SHEET_ID, [
+                                            {"range":f"Feuille 1!AU{_rn_lib}","values":[["نعم"]]}
+                                        ])
                                         st.success(f"✅ تبرئة المكتبة لمذكرة {_lmid}"); st.rerun()
 
 
@@ -5467,7 +7371,7 @@ elif st.session_state.user_type == "admin":
                 st.session_state["_send_fmt_val"] = _send_fmt
 
                 if st.button("📧 إرسال التكاليف", type="primary", use_container_width=True, key="send_takleef"):
-                    _sent = 0; _failed = []
+                    _sent = 0; _failed = []; _skipped = []
                     _progress = st.progress(0)
                     _status = st.empty()
 
@@ -5565,7 +7469,6 @@ elif st.session_state.user_type == "admin":
                         )
 
                         try:
-                            import smtplib
                             from email.mime.multipart import MIMEMultipart
                             from email.mime.text import MIMEText
                             from email.mime.base import MIMEBase
@@ -5596,21 +7499,21 @@ elif st.session_state.user_type == "admin":
                                         _ok = True; _msg = "تم + PDF"
                                     except Exception as _pdf_err:
                                         _failed.append(f"PDF فشل: {_pdf_err}")
-                                with smtplib.SMTP_SSL("smtp.gmail.com", 465) as _srv:
-                                    _srv.login(EMAIL_SENDER, EMAIL_PASSWORD)
-                                    _srv.sendmail(EMAIL_SENDER, _email_to, _msg_em.as_string())
-                                _ok, _msg = True, "تم"
+                                if send_email(_msg_em, [_email_to], template="takleef") is None:
+                                    _skipped.append(_prof_name); _ok, _msg = None, "مكررة"
+                                else: _ok, _msg = True, "تم"
                         except Exception as _ex_em:
                             _ok, _msg = False, str(_ex_em)
 
                         if _ok: _sent += 1
-                        else: _failed.append(f"{_prof_name}: {_msg}")
+                        elif _ok is False: _failed.append(f"{_prof_name}: {_msg}")
 
                         _progress.progress(int((_pi+1)/len(_profs_to_send)*100))
                         _status.text(f"جاري الإرسال... {_pi+1}/{len(_profs_to_send)}")
 
                     _progress.empty(); _status.empty()
-                    if _sent > 0: st.success(f"✅ تم إرسال {_sent} تكليف بنجاح")
+                    if _sent > 0: st.success(f"✅ أُضيف {_sent} تكليف إلى صندوق الصادر — يُرسل تباعاً في الخلفية")
+                    if _skipped: st.info(f"⏭️ تُخطي {len(_skipped)} تكليف أُرسل سابقاً: " + " | ".join(_skipped[:5]))
                     if _failed: st.warning("⚠️ فشل: " + " | ".join(_failed[:5]))
 
                 st.markdown("---")
@@ -5648,38 +7551,11 @@ elif st.session_state.user_type == "admin":
                     _slot_tk1  = str(_row_tk1.get(_col_x_tk,"")).strip()
                     _room_tk1  = str(_row_tk1.get(_col_y_tk,"")).strip()
                     _link_tk1  = str(_row_tk1.get("رابط الملف","")).strip()
-                    _students_label = "الطالب(ة)" if not _s2_tk1 or _s2_tk1 in ["","nan"] else "الطالبَين"
                     _students_names = _s1_tk1 + (f" — {_s2_tk1}" if _s2_tk1 and _s2_tk1 not in ["","nan"] else "")
 
                     def _build_email_tk1(prof_name, role_ar):
-                        _link_btn = f'<a href="{_link_tk1}" style="color:#1a3a6b;font-weight:bold;">👁️ معاينة المذكرة</a>' if _link_tk1 and _link_tk1 not in ["","nan"] else ""
-                        return f"""<!DOCTYPE html><html dir="rtl" lang="ar">
-<head><meta charset="UTF-8"><meta name="viewport" content="width=device-width,initial-scale=1.0">
-<style>body{{font-family:Arial,sans-serif;direction:rtl;background:#f0f4f8;padding:8px}}
-.wrap{{max-width:640px;margin:0 auto;background:#fff;border-radius:12px;overflow:hidden;box-shadow:0 4px 20px rgba(0,0,0,.1)}}
-.hdr{{background:linear-gradient(135deg,#0F2942,#1a3a6b);padding:20px;text-align:center;color:#FFD700;font-size:1.1rem}}
-.bdy{{padding:22px 20px;font-size:0.93rem;color:#333;line-height:1.9}}
-.box{{background:#f8fafc;border-right:4px solid #0F2942;padding:12px 16px;border-radius:8px;margin:14px 0}}
-.role{{display:inline-block;background:#0F2942;color:#FFD700;padding:3px 12px;border-radius:12px;font-size:0.82rem}}
-.ftr{{background:#f4f6f9;padding:12px;text-align:center;font-size:0.78rem;color:#777;border-top:1px solid #e0e0e0}}
-</style></head><body>
-<div class="wrap">
-<div class="hdr">📋 برمجة مناقشة مذكرة الماستر</div>
-<div class="bdy">
-<p>الأستاذ(ة) الفاضل(ة) <strong>{prof_name}</strong>،</p>
-<p>تحية طيبة وبعد،</p>
-<p>نُحيطكم علمًا بأنه تمّت برمجة مناقشة مذكرة الماستر رقم <strong>{_mid_tk1}</strong>، الموسومة بـ:</p>
-<div class="box"><strong>« {_title_tk1} »</strong></div>
-<p>من إعداد {_students_label}: <strong>{_students_names}</strong><br>
-وتحت إشراف الأستاذ(ة): <strong>{_sup_tk1}</strong></p>
-<p>وذلك يوم <strong>{_date_tk1}</strong> على الساعة <strong>{_slot_tk1}</strong> بقاعة <strong>{_room_tk1}</strong>،
-بصفتكم <span class="role">{role_ar}</span></p>
-{f'<p style="margin-top:14px;">{_link_btn}</p>' if _link_btn else ""}
-<p style="margin-top:12px;">🌐 منصة المذكرات: <a href="https://memoires2026.streamlit.app">memoires2026.streamlit.app</a></p>
-<p style="margin-top:18px;color:#1a3a6b;">تقبلوا تحياتي،<br><strong>مسؤول الميدان — البروفيسور رفاف لخضر</strong></p>
-</div>
-<div class="ftr">كلية الحقوق والعلوم السياسية — جامعة محمد البشير الإبراهيمي، برج بوعريريج</div>
-</div></body></html>"""
+                        return build_takleef_email(prof_name, [{"رقم المذكرة":_mid_tk1,"العنوان":_title_tk1,"الطلبة":_students_names,"المشرف":_sup_tk1,
+                                                                "اليوم":_date_tk1,"التوقيت":_slot_tk1,"القاعة":_room_tk1,"الصفة":role_ar,"رابط الملف":_link_tk1}])
 
                     def _build_student_email_tk1(student_name):
                         return f"""<!DOCTYPE html><html dir="rtl" lang="ar">
@@ -5731,32 +7607,46 @@ elif st.session_state.user_type == "admin":
                         _em_show = _rec["بريد"] if _rec["بريد"] else "⚠️ لا بريد"
                         st.caption(f"{_icon} {_rec['اسم']} — {_rec['صفة']} — {_em_show}")
 
+                    _digest_tk1 = st.checkbox(f"📬 تجميع تكاليف الأساتذة في ملخص واحد لكل أستاذ — لا يُرسل فوراً بل بعد {DIGEST_WINDOW//60} دقيقة من أول تكليف", value=False, key="tk1_digest")
                     if st.button("📧 إرسال التكليف للجميع", type="primary", use_container_width=True, key="send_tk1_all"):
-                        import smtplib
                         from email.mime.multipart import MIMEMultipart
                         from email.mime.text import MIMEText
-                        _sent_tk1=0; _fail_tk1=[]
+                        _sent_tk1=0; _fail_tk1=[]; _skip_tk1=[]; _dig_tk1=0
                         _prog_tk1=st.progress(0); _stat_tk1=st.empty()
                         for _pi, _rec in enumerate(_recipients_tk1):
                             if not _rec["بريد"]:
                                 _fail_tk1.append(f"{_rec['اسم']} (لا بريد)"); continue
+                            if _digest_tk1 and _rec["نوع"]=="أستاذ":
+                                try:
+                                    queue_assignment_digest(_rec["اسم"], _rec["بريد"], {"رقم المذكرة":_mid_tk1,"العنوان":_title_tk1,"الطلبة":_students_names,"المشرف":_sup_tk1,
+                                                                                     "اليوم":_date_tk1,"التوقيت":_slot_tk1,"القاعة":_room_tk1,"الصفة":_rec["صفة"],"رابط الملف":_link_tk1})
+                                    _dig_tk1+=1
+                                except Exception as _etk1:
+                                    _fail_tk1.append(f"{_rec['اسم']}: {_etk1}")
+                                continue
                             try:
                                 _html_tk1 = _build_email_tk1(_rec["اسم"],_rec["صفة"]) if _rec["نوع"]=="أستاذ" else _build_student_email_tk1(_rec["اسم"])
                                 _msg_tk1=MIMEMultipart("alternative")
                                 _msg_tk1["Subject"]=f"برمجة مناقشة مذكرة الماستر رقم {_mid_tk1}"
                                 _msg_tk1["From"]=EMAIL_SENDER; _msg_tk1["To"]=_rec["بريد"]
                                 _msg_tk1.attach(MIMEText(_html_tk1,"html","utf-8"))
-                                with smtplib.SMTP_SSL("smtp.gmail.com",465) as _srv_tk1:
-                                    _srv_tk1.login(EMAIL_SENDER,EMAIL_PASSWORD)
-                                    _srv_tk1.sendmail(EMAIL_SENDER,_rec["بريد"],_msg_tk1.as_string())
-                                _sent_tk1+=1
+                                if send_email(_msg_tk1, [_rec["بريد"]], template="takleef_memo", memo=_mid_tk1) is None: _skip_tk1.append(_rec["اسم"])
+                                else: _sent_tk1+=1
                             except Exception as _etk1:
                                 _fail_tk1.append(f"{_rec['اسم']}: {_etk1}")
                             _prog_tk1.progress(int((_pi+1)/len(_recipients_tk1)*100))
                             _stat_tk1.text(f"جاري الإرسال... {_pi+1}/{len(_recipients_tk1)}")
                         _prog_tk1.empty(); _stat_tk1.empty()
-                        if _sent_tk1>0: st.success(f"✅ تم إرسال {_sent_tk1} رسالة")
+                        if _sent_tk1>0: st.success(f"✅ أُضيفت {_sent_tk1} رسالة إلى صندوق الصادر — تُرسل تباعاً في الخلفية")
+                        if _dig_tk1>0: st.success(f"📬 أُضيف {_dig_tk1} تكليف إلى ملخصات الأساتذة — لم يُرسل بعد، يصل خلال {DIGEST_WINDOW//60} دقيقة (أو اضغط «إرسال الملخصات الآن»)")
+                        if _skip_tk1: st.info(f"⏭️ تُخطيت {len(_skip_tk1)} رسالة أُرسلت سابقاً: " + " | ".join(_skip_tk1[:5]))
                         if _fail_tk1: st.warning("⚠️ فشل: " + " | ".join(_fail_tk1[:5]))
+                    _dig_n, _dig_profs, _dig_failed = pending_digest_count()
+                    if _dig_n:
+                        st.caption(f"📬 {_dig_n} تكليف في انتظار الملخص لـ {_dig_profs} أستاذ"
+                                   + (f" | ❌ {_dig_failed} ملخص تعذّر إعداده بعد {DIGEST_MAX_ATTEMPTS} محاولات — أعد الإرسال يدوياً" if _dig_failed else ""))
+                        if st.button("📨 إرسال الملخصات الآن", key="tk1_flush_digest"):
+                            st.success(f"✅ أُضيف {flush_assignment_digests(force=True)} ملخص إلى صندوق الصادر")
 
 
         # ================================================================
@@ -5850,15 +7740,7 @@ elif st.session_state.user_type == "admin":
                     if st.button("💾 حفظ التحديثات", type="primary", use_container_width=True, key="siyar_save"):
                         with st.spinner("⏳ جاري الحفظ..."):
                             # ابحث عن رقم الصف
-                            _all_m = load_memos()
-                            _row_map_s = {}
-                            for _i_s, (_, _rw_s) in enumerate(_all_m.iterrows()):
-                                _mk = str(_rw_s.get("رقم المذكرة","")).strip()
-                                try: _mk = str(int(float(_mk)))
-                                except: pass
-                                if _mk: _row_map_s[_mk] = _i_s + 2
-
-                            _rn_s = _row_map_s.get(str(_sel_mid_s))
+                            _rn_s = get_repository().memo_row(_sel_mid_s)
                             if not _rn_s:
                                 st.error("❌ لم يوجد الصف")
                             else:
@@ -5879,11 +7761,7 @@ elif st.session_state.user_type == "admin":
                                     else:
                                         st.error(f"❌ فشل رفع PDF: {_link_pdf}")
 
-                                sheets_service.spreadsheets().values().batchUpdate(
-                                    spreadsheetId=MEMOS_SHEET_ID,
-                                    body={"valueInputOption": "USER_ENTERED", "data": _upd_siyar}
-                                ).execute()
-                                clear_cache_and_reload()
+                                write_cells(MEMOS_SHEET_ID, _upd_siyar)
                                 st.success(f"✅ تم تحديث المذكرة {_sel_mid_s}")
                                 st.rerun()
 
@@ -5921,25 +7799,15 @@ elif st.session_state.user_type == "admin":
                     st.dataframe(_pd_s.DataFrame(_seq_data).head(10), use_container_width=True)
                     if st.button("🚀 استيراد إلى الشيت", type="primary", use_container_width=True, key="do_import_seq"):
                         with st.spinner("⏳ جاري الاستيراد..."):
-                            _am = load_memos()
-                            _rm = {}
-                            for _i_s, (_, _rw_s) in enumerate(_am.iterrows()):
-                                _mk_s = str(_rw_s.get("رقم المذكرة","")).strip()
-                                try: _mk_s = str(int(float(_mk_s)))
-                                except: pass
-                                if _mk_s: _rm[_mk_s] = _i_s + 2
+                            _repo_s = get_repository()
                             _upd_s = []; _nf_s = []
                             for _d_s in _seq_data:
-                                _rn_s = _rm.get(_d_s['رقم المذكرة'])
+                                _rn_s = _repo_s.memo_row(_d_s['رقم المذكرة'])
                                 if not _rn_s: _nf_s.append(_d_s['رقم المذكرة']); continue
                                 _upd_s.append({"range": f"Feuille 1!AM{_rn_s}", "values": [[_d_s['رقم المحضر']]]})
                             if _upd_s:
-                                for _i2_s in range(0, len(_upd_s), 100):
-                                    sheets_service.spreadsheets().values().batchUpdate(
-                                        spreadsheetId=MEMOS_SHEET_ID,
-                                        body={"valueInputOption": "USER_ENTERED", "data": _upd_s[_i2_s:_i2_s+100]}
-                                    ).execute()
-                                clear_cache_and_reload()
+                                with SheetWriteBuffer() as _buf_s: _buf_s.extend(MEMOS_SHEET_ID, _upd_s)
+                                SheetWriteBuffer.raise_on_failure(_buf_s.report)
                                 st.success(f"✅ تم استيراد {len(_seq_data)-len(_nf_s)} رقم محضر!")
                                 if _nf_s: st.warning(f"⚠️ لم توجد في الشيت: {_nf_s[:10]}")
                             else:
@@ -5972,10 +7840,10 @@ elif st.session_state.user_type == "admin":
                     if st.button("🚀 استيراد إلى شيت الطلبة", type="primary", use_container_width=True, key="do_import_stud"):
                         with st.spinner("⏳ جاري الاستيراد..."):
                             # قراءة شيت الطلبة
-                            _st_res = sheets_service.spreadsheets().values().get(
+                            _st_res = api_execute(sheets_service.spreadsheets().values().get(
                                 spreadsheetId=STUDENTS_SHEET_ID,
                                 range="Feuille 1!A1:V5000"
-                            ).execute()
+                            ))
                             _st_vals = _st_res.get('values', [])
                             # بناء خريطة رقم التسجيل (عمود C = index 2) → رقم الصف
                             _reg_map_t = {}
@@ -5989,12 +7857,8 @@ elif st.session_state.user_type == "admin":
                                 if not _rn_t: _nf_t.append(_d_t['رقم التسجيل']); continue
                                 _upd_t.append({"range": f"Feuille 1!V{_rn_t}", "values": [[_d_t['رقم الملف']]]})
                             if _upd_t:
-                                for _i2_t in range(0, len(_upd_t), 100):
-                                    sheets_service.spreadsheets().values().batchUpdate(
-                                        spreadsheetId=STUDENTS_SHEET_ID,
-                                        body={"valueInputOption": "USER_ENTERED", "data": _upd_t[_i2_t:_i2_t+100]}
-                                    ).execute()
-                                clear_cache_and_reload()
+                                with SheetWriteBuffer() as _buf_t: _buf_t.extend(STUDENTS_SHEET_ID, _upd_t)
+                                SheetWriteBuffer.raise_on_failure(_buf_t.report)
                                 st.success(f"✅ تم تحديث {len(_stud_data)-len(_nf_t)} طالب!")
                                 if _nf_t: st.warning(f"⚠️ لم يُوجد رقم تسجيلهم: {_nf_t[:10]}")
                             else:
@@ -6131,7 +7995,7 @@ elif st.session_state.user_type == "admin":
                 
                 # زر تحديث الإعدادات
                 if st.button("🔄 تحديث من الشيت", key="refresh_settings", use_container_width=False):
-                    st.cache_data.clear()
+                    clear_cache_and_reload()
                     st.rerun()
 
                 st.markdown("---")
@@ -6177,7 +8041,7 @@ elif st.session_state.user_type == "admin":
                                 })
                                 if ok:
                                     st.success("✅ تم الحفظ!")
-                                    st.cache_data.clear()
+                                    invalidate_datasets("memo_exc")
                                     st.rerun()
                             else:
                                 st.error("❌ أدخل رقم المذكرة")
@@ -6349,7 +8213,7 @@ elif st.session_state.user_type == "admin":
                                     if _ok:
                                         st.success("✅ تم الحفظ!")
                                         del st.session_state["ai_extracted"]
-                                        st.cache_data.clear()
+                                        invalidate_datasets("prof_exc")
                                         st.rerun()
                                     else:
                                         st.error("❌ فشل الحفظ")
@@ -6400,7 +8264,7 @@ elif st.session_state.user_type == "admin":
                                 })
                                 if ok:
                                     st.success("✅ تم الحفظ!")
-                                    st.cache_data.clear()
+                                    invalidate_datasets("prof_exc")
                                     st.rerun()
                             else:
                                 st.error("❌ اختر اسم الأستاذ")
@@ -6541,35 +8405,21 @@ elif st.session_state.user_type == "admin":
                                 _, conflicts_j2, memo_members_j2 = build_conflict_matrix(ready_memos_j)
                                 _pbd2 = st.session_state.get("_j_ban_days", {})
                                 _pad2 = st.session_state.get("_j_allow_days", {})
-                                _fix2 = _constraints[0] if "_constraints" in dir() else {}
 
                                 # ── مرحلة ملء ذكية: استغلال الفراغات ──
-                                _occ2 = {sv: m for m, sv in cur.items() if sv}
-                                _pbusy2 = {}
-                                _pdc2 = {}
-                                for _m2, _sv2 in cur.items():
-                                    if not _sv2: continue
-                                    _d2, _s2, _r2 = _sv2
-                                    for _p2 in memo_members_j2.get(_m2, set()):
-                                        _pbusy2[(_d2, _s2, _p2)] = _m2
-                                        _pdc2[(_p2, _d2)] = _pdc2.get((_p2, _d2), 0) + 1
-
-                                _can2, _ = make_can_place(_occ2, _pbusy2, _pdc2, memo_members_j2,
-                                    _fix2, {}, _pbd2, {}, {}, {}, set(), set(), {}, {}, sl_j, None)
-                                _place2 = make_place_fn(cur, _occ2, _pbusy2, _pdc2, memo_members_j2, {}, {})
+                                _state2 = ConstraintModel(memo_members_j2, dy_j, sl_j, rm_j,
+                                    prof_banned_days=_pbd2).new_state().load(cur)
+                                cur = _state2.schedule
 
                                 # ابحث عن المذكرات غير المجدولة وضعها في الفراغات
                                 _unscheduled = [m for m, sv in cur.items() if not sv]
                                 _filled = 0
                                 for _umid in _unscheduled:
-                                    for _uday in sorted(dy_j, key=lambda d: sum(1 for sv in cur.values() if sv and sv[0]==d)):
-                                        for _uslot in sl_j:
-                                            for _uroom in rm_j:
-                                                if _can2(_umid, _uday, _uslot, _uroom, log=False):
-                                                    _place2(_umid, _uday, _uslot, _uroom)
-                                                    _filled += 1; break
-                                            else: continue; break
-                                        else: continue; break
+                                    _udays = sorted(dy_j, key=lambda d: sum(1 for sv in cur.values() if sv and sv[0]==d))
+                                    _cell = _state2.first_fit(_umid, _udays, sl_j, rm_j)
+                                    if _cell:
+                                        _state2.place(_umid, *_cell)
+                                        _filled += 1
 
                                 # احمل القيود الكاملة
                                 _df_memo_exc_i = load_memo_exceptions()
@@ -6818,7 +8668,6 @@ elif st.session_state.user_type == "admin":
                                                 for pf,prog_f in prof_prog.items():
                                                     ok_p,_ = send_prof_schedule_email(pf, prog_f, df_profs_j)
                                                     if ok_p: sent_p += 1
-                                                    time_module.sleep(0.3)
                                                 sent_s = 0
                                                 for mf,sf in final_j.items():
                                                     if not sf: continue
@@ -6837,7 +8686,7 @@ elif st.session_state.user_type == "admin":
                                                 for k in ["j_schedule","j_score","j_unplaced","j_confirm_step"]:
                                                     st.session_state.pop(k,None)
                                                 st.success(f"🎉 تم! حُفظ | أُرسل لـ {sent_p} أستاذ | أُشعر {sent_s} طالب")
-                                                st.balloons(); clear_cache_and_reload(); time_module.sleep(2); st.rerun()
+                                                st.balloons(); time_module.sleep(2); st.rerun()
                                             else: st.error(msg_j)
                             with cb_j:
                                 if st.button("إلغاء", use_container_width=True, key="j_cancel"):